@@ -0,0 +1,316 @@
+"""
+Scoring the clients of new eviction filings as they are matched, instead of waiting for the weekly predict forward.
+
+New rows of the eviction match table are queued in acdhs_experiments.incremental_scoring_queue, either:
+    - by a trigger on the table, which also notifies the listener (--listen, Postgres LISTEN/NOTIFY), or
+    - by polling the table for matches filed since its high-water mark (the latest filing date already queued,
+      minus --lookback-days for the late loads). Polling also works when the matching recreates the table (and drops the trigger).
+
+The cohort of an as_of_date has the filings before it, so a match filed today stays queued and is scored the next day.
+The listener precomputes the features of only the queued clients that are in the production model's cohort today
+(the delta precompute restricted to them, see pretriage/delta_precompute.py), builds their matrix with the same code
+as predict_forward, scores it with the model it keeps loaded and upserts the scores into acdhs_production.predictions.
+The scores are not ranked, and the features imputed with a cohort mean use the mean of the scored clients, so they can
+differ a little from the weekly batch's.
+
+It only needs the pretriage and triage tables and the rg_staff role, so it can run against a local Postgres
+(with --database-creds pointing to it):
+
+    python -m pipeline.incremental_scoring -m <model_id> --listen
+    python -m pipeline.incremental_scoring -m <model_id> --poll-seconds 300
+    python -m pipeline.incremental_scoring -m <model_id> --once
+"""
+import argparse
+import logging
+import select
+import time
+from datetime import date
+
+import pandas as pd
+from triage.component.catwalk.storage import ProjectStorage
+
+from pipeline.pretriage.delta_precompute import run_delta_precompute
+from pipeline.utils.model_cache import model_storage_engine
+from pipeline.utils.production_matrices import ProductionModel, CachingPredictor, build_production_matrix, cohort_table_model
+from pipeline.utils.production_predictions import upsert_scores
+from pipeline.utils.tree_inference import compiled_model_storage_engine
+from pipeline.utils.utils import get_db_engine
+from pipeline.utils.project_constants import PROJECT_PATH, EXPERIMENT_METADATA_SCHEMA
+
+
+MATCHES_TABLE = 'pretriage.eviction_client_matches_id'
+QUEUE_TABLE = f'{EXPERIMENT_METADATA_SCHEMA}.incremental_scoring_queue'
+COHORT_TABLE = 'pretriage.incremental_scoring_cohort'
+FEATURES_SCHEMA = 'triage_incremental_scoring'
+NOTIFY_CHANNEL = 'eviction_matches_inserted'
+
+
+def create_queue_table(db_engine):
+    q = f'''
+        create schema if not exists {EXPERIMENT_METADATA_SCHEMA};
+
+        create table if not exists {QUEUE_TABLE} (
+            client_id bigint,
+            matter_id varchar,
+            filingdt date,
+            queued_at timestamp default now(),
+            scored_at timestamp
+        );
+
+        create unique index if not exists incremental_scoring_queue_client_id_matter_id_idx on {QUEUE_TABLE} (client_id, matter_id);
+        create index if not exists incremental_scoring_queue_scored_at_idx on {QUEUE_TABLE} (scored_at);
+    '''
+
+    with db_engine.begin() as conn:
+        conn.execute(q)
+
+
+def install_trigger(db_engine):
+    """ Queue the rows inserted in the matches table and notify the listener, in the inserting transaction """
+    q = f'''
+        create or replace function {EXPERIMENT_METADATA_SCHEMA}.queue_eviction_matches() returns trigger as $$
+        begin
+            insert into {QUEUE_TABLE} (client_id, matter_id, filingdt)
+                select distinct client_id, matter_id::varchar, filingdt::date from inserted_matches
+            on conflict (client_id, matter_id) do nothing;
+
+            perform pg_notify('{NOTIFY_CHANNEL}', '');
+            return null;
+        end;
+        $$ language plpgsql;
+
+        drop trigger if exists queue_eviction_matches on {MATCHES_TABLE};
+
+        create trigger queue_eviction_matches
+            after insert on {MATCHES_TABLE}
+            referencing new table as inserted_matches
+            for each statement execute procedure {EXPERIMENT_METADATA_SCHEMA}.queue_eviction_matches();
+    '''
+
+    logging.info(f'Installing the trigger queuing the new rows of {MATCHES_TABLE}')
+    with db_engine.begin() as conn:
+        conn.execute(q)
+
+
+def queue_new_matches(db_engine, lookback_days=30):
+    """ Queue the matches filed since the high-water mark of the queue that are not queued yet
+
+        Returns:
+            (int) the number of queued matches
+    """
+    q = f'''
+        insert into {QUEUE_TABLE} (client_id, matter_id, filingdt)
+            select distinct m.client_id, m.matter_id::varchar, m.filingdt::date
+            from {MATCHES_TABLE} m
+            where m.filingdt >= coalesce((select max(filingdt) from {QUEUE_TABLE}), current_date) - interval '{int(lookback_days)} days'
+            and m.filingdt <= current_date
+        on conflict (client_id, matter_id) do nothing
+    '''
+
+    with db_engine.begin() as conn:
+        queued = conn.execute(q).rowcount
+
+    if queued:
+        logging.info(f'Queued {queued} new matches of {MATCHES_TABLE}')
+
+    return queued
+
+
+class IncrementalScorer:
+    """ The production model, loaded once, scoring the queued clients
+
+        Args:
+            db_engine: SQLAlchemy engine
+            model_id (int): triage model id of the production model
+            project_path (str): Where the models and matrices are stored
+            max_staleness_days (int): The precompute fails if an upstream table has no rows in this many days
+    """
+
+    def __init__(self, db_engine, model_id, project_path=PROJECT_PATH, max_staleness_days=14):
+        self.db_engine = db_engine
+        self.model_id = model_id
+        self.max_staleness_days = max_staleness_days
+
+        project_storage = ProjectStorage(project_path)
+        self.matrix_storage_engine = project_storage.matrix_storage_engine()
+        self.production_model = ProductionModel(db_engine, model_id)
+        self.train_matrix_columns = self.matrix_storage_engine.get_store(self.production_model.train_matrix_uuid).columns()
+
+        predictor = CachingPredictor(
+            model_storage_engine=model_storage_engine(project_storage),
+            db_engine=db_engine,
+            rank_order='best',
+            compiled_model_storage_engine=compiled_model_storage_engine(project_storage)
+        )
+        self.model = predictor.load_model(model_id)
+
+        # the cohort of the matrix is the (precomputed) cohort of the queued clients
+        self.incremental_model = cohort_table_model(self.production_model, COHORT_TABLE, 'incremental')
+
+    def score_queue(self):
+        """ Score the clients of the queued matches filed before today as of today and mark them as scored
+
+            Returns:
+                (int) the number of scored clients
+        """
+        as_of_date = str(date.today())
+
+        # the cohort of an as_of_date has the filings before it: the matches filed today stay queued until tomorrow
+        scorable = f"scored_at is null and (filingdt is null or filingdt < '{as_of_date}'::date)"
+        queue = pd.read_sql(f'select client_id, max(queued_at)::varchar as queued_at from {QUEUE_TABLE} where {scorable} group by client_id', self.db_engine)
+        if queue.empty:
+            return 0
+
+        client_ids = queue.client_id.tolist()
+        logging.info(f'Scoring {len(client_ids)} clients of new eviction matches as of {as_of_date}')
+
+        start = time.perf_counter()
+        run_delta_precompute(
+            self.db_engine,
+            as_of_date,
+            self.production_model.experiment_config,
+            self.max_staleness_days,
+            entity_ids=client_ids,
+            cohort_table=COHORT_TABLE
+        )
+
+        cohort_size = pd.read_sql(f'select count(*) from {COHORT_TABLE}', self.db_engine).iloc[0, 0]
+        if cohort_size:
+            matrix_uuid = build_production_matrix(
+                self.db_engine,
+                self.matrix_storage_engine,
+                self.incremental_model,
+                as_of_date,
+                matrix_id=f"{as_of_date}_model_id_{self.model_id}_incremental_{time.strftime('%H%M%S')}",
+                features_schema_name=FEATURES_SCHEMA
+            )
+            X = self.matrix_storage_engine.get_store(matrix_uuid).matrix_with_sorted_columns(self.train_matrix_columns)
+
+            scores = pd.DataFrame({
+                'model_id': self.model_id,
+                'entity_id': X.index.get_level_values('entity_id'),
+                'as_of_date': as_of_date,
+                'score': self.model.predict_proba(X)[:, 1],
+                'matrix_uuid': matrix_uuid,
+            })
+            client_hashes = pd.read_sql(
+                f'select client_id as entity_id, client_hash from pretriage.client_id_mapping where client_id in (select entity_id from {COHORT_TABLE})',
+                self.db_engine
+            )
+            upsert_scores(self.db_engine, scores.merge(client_hashes, on='entity_id', how='left'))
+
+        # the clients that are not in the cohort (e.g. the filing doesn't qualify) are done too
+        with self.db_engine.begin() as conn:
+            conn.execute(
+                f'''
+                update {QUEUE_TABLE} set scored_at = now()
+                where {scorable} and client_id in ({', '.join(str(int(c)) for c in client_ids)}) and queued_at <= %s::timestamp
+                ''',
+                (queue.queued_at.max(),)
+            )
+
+        logging.info(f'Scored {cohort_size} of the {len(client_ids)} queued clients (the others are not in the cohort) in {time.perf_counter() - start:.1f} seconds')
+
+        return cohort_size
+
+
+def listen(scorer, timeout_seconds=300):
+    """ Score the queue whenever the trigger notifies new matches (and every timeout_seconds, in case a notification was missed) """
+    connection = scorer.db_engine.raw_connection()
+    connection.set_isolation_level(0)  # autocommit, so the notifications are delivered
+    connection.cursor().execute(f'listen {NOTIFY_CHANNEL};')
+    logging.info(f'Listening on {NOTIFY_CHANNEL}')
+
+    try:
+        while True:
+            scorer.score_queue()
+            if select.select([connection.connection], [], [], timeout_seconds) != ([], [], []):
+                connection.connection.poll()
+                # one run for all the notifications received until now
+                connection.connection.notifies.clear()
+    finally:
+        connection.close()
+
+
+def poll(scorer, interval_seconds=300, lookback_days=30):
+    """ Queue the new matches and score them every interval_seconds """
+    while True:
+        queue_new_matches(scorer.db_engine, lookback_days)
+        scorer.score_queue()
+        time.sleep(interval_seconds)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Score the clients of new eviction filings as they are matched")
+
+    parser.add_argument(
+        "-m",
+        "--model_id",
+        type=int,
+        help='triage model id of the production model',
+        required=True
+    )
+
+    parser.add_argument(
+        "--listen",
+        action='store_true',
+        help=f'Install a trigger on {MATCHES_TABLE} and score on its notifications (instead of polling)'
+    )
+
+    parser.add_argument(
+        "--once",
+        action='store_true',
+        help='Queue the new matches, score them and exit'
+    )
+
+    parser.add_argument(
+        "--poll-seconds",
+        type=int,
+        default=300,
+        help='How often to poll for new matches (with --listen, how often to check the queue without a notification)'
+    )
+
+    parser.add_argument(
+        "--lookback-days",
+        type=int,
+        default=30,
+        help='When polling, also queue the matches filed up to this many days before the latest queued filing'
+    )
+
+    parser.add_argument(
+        "--max-staleness-days",
+        type=int,
+        default=14,
+        help='Fail if an upstream table has no rows in this many days before today'
+    )
+
+    parser.add_argument(
+        "--database-creds",
+        type=str,
+        help='YAML file with the credentials of the database (e.g. a local Postgres), instead of the PG environment variables'
+    )
+
+    parser.add_argument(
+        "--project-path",
+        type=str,
+        default=PROJECT_PATH,
+        help='Where the models and matrices are stored'
+    )
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    db_engine = get_db_engine(args.database_creds)
+    create_queue_table(db_engine)
+    scorer = IncrementalScorer(db_engine, args.model_id, args.project_path, args.max_staleness_days)
+
+    if args.once:
+        queue_new_matches(db_engine, args.lookback_days)
+        scorer.score_queue()
+    elif args.listen:
+        install_trigger(db_engine)
+        listen(scorer, args.poll_seconds)
+    else:
+        poll(scorer, args.poll_seconds, args.lookback_days)
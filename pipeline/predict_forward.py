@@ -1,7 +1,7 @@
 """
 This script will run the preselected ML model to generate the list of clients for outreach for the trial. 
 We have already selected models through audition and postmodeling, narrowed it down to one model group
-Use the Retrainer module in triage to retrain the model using data until the prediction date
+Use the Retrainer module in triage to retrain the model using data until the prediction date (reusing the train matrices, see utils/retrain.py)
 """
 import logging
 import pandas as pd
@@ -9,12 +9,21 @@ import argparse
 
 from datetime import datetime
 
-from triage.predictlist import Retrainer, predict_forward_with_existed_model
-from triage.predictlist.utils import experiment_config_from_model_group_id
-
-from pretriage.current_eviction_features import generate_current_eviction_features
-from pipeline.pretriage.non_entity_id_aggregate_features import generate_location_level_eviction_aggregates, generate_landlord_level_eviction_aggregates
-
+from triage.predictlist.utils import experiment_config_from_model_id
+from triage.component.catwalk.storage import ProjectStorage
+from triage.component.results_schema import upgrade_db
+
+from pipeline.pretriage.current_eviction_features import generate_current_eviction_features
+from pipeline.pretriage.static_features import generate_static_features
+from pipeline.pretriage.days_since_features import generate_days_since_features
+from pipeline.pretriage.interval_features import rebuild_interval_feature_tables
+from pipeline.pretriage.delta_precompute import run_delta_precompute, check_upstream_freshness, check_precompute_freshness, upstream_watermarks, refresh_eviction_aggregates, record_precomputed_tables
+
+from pipeline.utils.model_cache import model_storage_engine
+from pipeline.utils.production_matrices import ProductionModel, CachingPredictor, build_production_matrix, experiment_model_id
+from pipeline.utils.production_predictions import upsert_predictions, record_prediction_watermarks, last_prediction_watermarks
+from pipeline.utils.retrain import MatrixReuseRetrainer
+from pipeline.utils.tree_inference import compiled_model_storage_engine
 from pipeline.utils.utils import get_db_engine
 from pipeline.utils.project_constants import PROJECT_PATH, LOGS_PATH
 
@@ -33,64 +42,14 @@ logger.addHandler(fh)
 def write_to_acdhs_production(db_engine, model_id, as_of_date):
     '''
         write predictios to the acdhs_production schema
+        model_id can be a list, to copy the predictions of several models on the as_of_date at once
+        rerunning a model on the same day replaces its predictions of that day (see utils/production_predictions.py)
     '''
-
-    q = '''
-    
-        set role 'rg_staff';
-
-        create schema if not exists acdhs_production;
-
-        create table if not exists acdhs_production.predictions (
-            model_id int,
-            client_hash varchar,
-            entity_id bigint,
-            as_of_date date,
-            prediction_date date,
-            score float,
-            rank_abs_no_ties int,
-            rank_pct_no_ties float,
-            rank_abs_with_ties int,
-            rank_pct_with_ties float,
-            matrix_uuid text,
-            label_value int,
-            test_label_timespan interval
-        );
-
-        create index on acdhs_production.predictions(entity_id);
-        create index on acdhs_production.predictions(as_of_date);
-        create index on acdhs_production.predictions(prediction_date);
-    '''
+    model_ids = list(model_id) if isinstance(model_id, (list, tuple, set)) else [model_id]
 
     logging.info('Making sure the acdhs_production schema and predictions table exist!')
-    with db_engine.begin() as conn:
-        conn.execute(q)
-
-
-    insert_q = f"""
-        insert into acdhs_production.predictions
-            select 
-                model_id,
-                client_hash,
-                entity_id,
-                as_of_date::date,
-                current_date as prediction_date,
-                score,
-                rank_abs_no_ties,
-                rank_pct_no_ties,
-                rank_abs_with_ties,
-                rank_pct_with_ties,
-                matrix_uuid,
-                label_value,
-                test_label_timespan
-            from triage_production.predictions p join pretriage.client_id_mapping cim on p.entity_id = cim.client_id 
-            where model_id = {model_id} and as_of_date = '{as_of_date}'::date 
-            order by score desc
-        ;
-    """
-    with db_engine.begin() as conn:
-        conn.execute(insert_q)
-    
+    upsert_predictions(db_engine, model_ids, as_of_date)
+
 
 def model_group_id_from_model_id(db_engine, model_id):
     
@@ -100,7 +59,26 @@ def model_group_id_from_model_id(db_engine, model_id):
         where model_id = {model_id}
     '''
     
-    return pd.read_sql(q, db_engine).iloc[0, 0]
+    # an int, numpy's can't be a query parameter
+    return int(pd.read_sql(q, db_engine).iloc[0, 0])
+
+
+def last_retrained_model_id(db_engine, model_group_id, prediction_date):
+    ''' The model of the last retrain of the model group up to the prediction date, None if it wasn't retrained up to it '''
+
+    q = f'''
+        select m.model_id
+        from triage_metadata.models m
+            join triage_metadata.triage_runs r on m.built_in_triage_run = r.id and r.run_type = 'retrain'
+            join triage_metadata.retrain re on r.run_hash = re.retrain_hash
+        where m.model_group_id = {model_group_id}
+        and re.prediction_date = '{prediction_date}'::date
+        order by m.run_time desc
+        limit 1
+    '''
+    model_ids = pd.read_sql(q, db_engine).model_id.tolist()
+
+    return int(model_ids[0]) if model_ids else None
 
 
 def model_id_from_model_group_id_train_end_time(db_engine, model_group_id, train_end_time):
@@ -142,11 +120,25 @@ def predict_forward_no_retrain(db_engine, project_path, prediction_date, model_i
 
     logging.info(f' Using model_id {model_id} for predicting as of {prediction_date}')
 
-    predict_forward_with_existed_model(
+    # the steps of triage's predict_forward_with_existed_model, with the model loaded through the local cache
+    upgrade_db(db_engine=db_engine)
+    project_storage = ProjectStorage(project_path)
+    matrix_storage_engine = project_storage.matrix_storage_engine()
+
+    production_model = ProductionModel(db_engine, model_id)
+    matrix_uuid = build_production_matrix(db_engine, matrix_storage_engine, production_model, prediction_date)
+
+    predictor = CachingPredictor(
+        model_storage_engine=model_storage_engine(project_storage),
         db_engine=db_engine,
+        rank_order='best',
+        compiled_model_storage_engine=compiled_model_storage_engine(project_storage)
+    )
+    predictor.predict(
         model_id=model_id,
-        project_path=project_path,
-        as_of_date=prediction_date
+        matrix_store=matrix_storage_engine.get_store(matrix_uuid),
+        misc_db_parameters={},
+        train_matrix_columns=matrix_storage_engine.get_store(production_model.train_matrix_uuid).columns()
     )
 
     logging.info('Successfully generated predictions and written to triage_production.predictions')
@@ -160,56 +152,205 @@ def predict_forward_no_retrain(db_engine, project_path, prediction_date, model_i
 
 def predict_forward_with_retrain(db_engine, prediction_date, model_group_id, project_path):
     """ Given a model_group_id and a prediction date, retrain the an instance of the model group using data until the prediction date
-        and generate predictions as of the prediction_date
+
+        The rows of the training history that are in a train matrix of the model group are reused, only the newest
+        as_of_dates are built (see utils/retrain.py). The predictions are generated by run_predict_forward with the new model.
 
         Args:
             db_engine()
             prediction_date (str): 
             model_group_id (int):
             project_path
+
+        Returns:
+            (int) the model_id of the retrained model
     """
-    
-    # Todo -- Add the functionality to submit a model id here (we can fetch the model group id from that). This way, we can have a consistent interface to both
-    # predict forward cases
-    
-    retrain_obj = Retrainer(
+    retrain_obj = MatrixReuseRetrainer(
         db_engine=db_engine,
         project_path=project_path,
         model_group_id=model_group_id
     )
     
     logging.info(f'Retraining the model upto {prediction_date}')
-    retrain_obj.retrain(prediction_date)
+    return retrain_obj.retrain(prediction_date)['retrain_model_id']
     
-    logging.info(f'Generating predictions as of {prediction_date}')
-    retrain_obj.predict(prediction_date)
     
+def precompute_features(db_engine, prediction_date, feature_aggregations):
+    """ Rebuild the precomputed feature tables for the prediction date
+        Args:
+            db_engine: sqlalchemy engine
+            prediction_date (str): Date as of which the predictions are generated
+            feature_aggregations (List[dict]): The feature groups of the experiment config(s) of the models
+
+        Returns:
+            (dict) the watermarks of the upstream tables the features were built from
+    """
+    watermarks = upstream_watermarks(db_engine, prediction_date)
+
+    # Precomputed feature tables, with the clients and events since the last run
+    generate_static_features(db_engine)
+    generate_days_since_features(db_engine, [prediction_date])
+    rebuild_interval_feature_tables(db_engine, feature_aggregations, [prediction_date])
     
-def run_predict_forward(prediction_date, project_path, model_id, retrain=False, model_group_id=None, train_end_time=None, is_test_run=False):
+    generate_current_eviction_features(db_engine, start_date=prediction_date, end_date=prediction_date) # default interval is 1 month
+
+    record_precomputed_tables(db_engine, prediction_date, watermarks, feature_aggregations)
+
+    # Aggregating stats for location attributes and landlords, if the evictions changed since they were last built
+    refresh_eviction_aggregates(db_engine, watermarks)
+
+    return watermarks
+
+
+def predict_forward_batch(db_engine, project_path, pairs, test_run=False, max_staleness_days=14, force=False):
+    """ Generate predictions for many (model_id, as_of_date) pairs, e.g. to backfill or to compare models.
+
+        The upstream tables are checked for every date before anything runs, as in run_predict_forward: it fails if they
+        are stale, and skips the pairs that already have predictions made from the same upstream data (unless force is set).
+        The features are precomputed once per date, and the matrix of a date is built once for all the models with the
+        same cohort, feature definitions and feature columns (ProductionModel.feature_set_key). Then every model is loaded
+        once and scores all its matrices, and the predictions of each date are copied to acdhs_production in one insert.
+
+        Args:
+            db_engine: sqlachemy engine
+            project_path (str): Where the model objects are and the matrices are saved
+            pairs (List[Tuple[int, str]]): (model_id, as_of_date 'YYYY-MM-DD') pairs
+            test_run (bool): If set, predictions are only written to triage_production
+            max_staleness_days (int): Fail if an upstream table has no rows in this many days before a date
+            force (bool): Predict the pairs even if they already have predictions from the same upstream data
+    """
+    pairs = sorted(set((int(model_id), str(as_of_date)) for model_id, as_of_date in pairs))
+    if not pairs:
+        raise ValueError('No (model_id, as_of_date) pairs to predict!')
+
+    watermarks = {as_of_date: check_upstream_freshness(db_engine, as_of_date, max_staleness_days) for as_of_date in sorted(set(d for _, d in pairs))}
+
+    if not (force or test_run):
+        predicted = [(model_id, d) for model_id, d in pairs if last_prediction_watermarks(db_engine, model_id, d) == watermarks[d]]
+        if predicted:
+            logging.info(f'{len(predicted)} (model, date) pairs already have predictions from the same upstream data, skipping them: {predicted}')
+        pairs = [pair for pair in pairs if pair not in predicted]
+
+        if not pairs:
+            logging.info('Every (model, date) pair already has predictions from the same upstream data, nothing to do')
+            return
+
+    upgrade_db(db_engine=db_engine)
+    project_storage = ProjectStorage(project_path)
+    matrix_storage_engine = project_storage.matrix_storage_engine()
+
+    models = {model_id: ProductionModel(db_engine, model_id) for model_id in sorted(set(model_id for model_id, _ in pairs))}
+    as_of_dates = sorted(set(as_of_date for _, as_of_date in pairs))
+
+    logging.info(f'Predicting {len(pairs)} (model, date) pairs: {len(models)} models on {len(as_of_dates)} dates')
+
+    # 1. One precompute per date and one matrix per date and feature set
+    matrix_uuids, precomputed_at = dict(), dict()
+    for as_of_date in as_of_dates:
+        date_models = [models[model_id] for model_id, d in pairs if d == as_of_date]
+        feature_aggregations = [group for m in date_models for group in m.experiment_config['feature_aggregations']]
+        precompute_features(db_engine, as_of_date, feature_aggregations)
+        precomputed_at[as_of_date] = check_precompute_freshness(db_engine, as_of_date, watermarks[as_of_date], feature_aggregations)
+
+        for production_model in date_models:
+            key = production_model.feature_set_key
+            if (as_of_date, key) not in matrix_uuids:
+                matrix_uuids[(as_of_date, key)] = build_production_matrix(
+                    db_engine,
+                    matrix_storage_engine,
+                    production_model,
+                    as_of_date,
+                    matrix_id=f'{as_of_date}_feature_set_{key}_risklist'
+                )
+            else:
+                logging.info(f'Model {production_model.model_id} shares the matrix {matrix_uuids[(as_of_date, key)]}')
+
+    logging.info(f'Built {len(matrix_uuids)} matrices for {len(pairs)} (model, date) pairs')
+
+    # 2. Every model is loaded once, and scores the matrices of all its dates
+    predictor = CachingPredictor(
+        model_storage_engine=model_storage_engine(project_storage),
+        db_engine=db_engine,
+        rank_order='best',
+        compiled_model_storage_engine=compiled_model_storage_engine(project_storage)
+    )
+    for model_id, production_model in models.items():
+        train_matrix_columns = matrix_storage_engine.get_store(production_model.train_matrix_uuid).columns()
+
+        for as_of_date in [d for m, d in pairs if m == model_id]:
+            logging.info(f'Generating predictions using Model {model_id}, as of {as_of_date}')
+            predictor.predict(
+                model_id=model_id,
+                matrix_store=matrix_storage_engine.get_store(matrix_uuids[(as_of_date, production_model.feature_set_key)]),
+                misc_db_parameters={},
+                train_matrix_columns=train_matrix_columns
+            )
+
+    logging.info('Successfully generated predictions and written to triage_production.predictions')
+
+    if not test_run:
+        logging.info('Copying predictions to the acdhs_production schema...')
+        for as_of_date in as_of_dates:
+            date_model_ids = [model_id for model_id, d in pairs if d == as_of_date]
+            write_to_acdhs_production(db_engine, date_model_ids, as_of_date)
+            record_prediction_watermarks(db_engine, date_model_ids, as_of_date, watermarks[as_of_date], precomputed_at[as_of_date])
+
+    logging.info(f'Batch predict forward of {len(pairs)} (model, date) pairs succesfully completed!')
+
+
+def run_predict_forward(prediction_date, project_path, model_id, retrain=False, model_group_id=None, train_end_time=None, is_test_run=False, delta=False, max_staleness_days=14, force=False):
     """ Run the predict forward pipeline
+
+        The upstream tables are checked before anything runs: it fails if they are stale, and does nothing if the
+        model already has predictions on the prediction date made from the same upstream data (unless force is set).
+        With retrain, the model of the last retrain of the group up to the prediction date is checked, before retraining.
+        It also fails if a precomputed table the model reads was not built from the current upstream data.
+
         Args:
             prediction_date (str): Date as of which the predictions are generated
             project_path (str): Where the model object is or new model should be saved
-            retrain (bool): Whether to retrain the model (need to provide a model_group_id)
+            retrain (bool): Whether to retrain the model group (of model_group_id, or of model_id) up to the prediction date
+                and predict with the new model
             model_id (int): triage Model ID to use for generating prediction
             model_group_id (int, optional)     
+            delta (bool): Only precompute the features of the prediction date's cohort, keeping the history of the
+                precomputed tables and reusing the aggregate tables if their sources didn't change (see pretriage/delta_precompute.py)
+            max_staleness_days (int): Fail if an upstream table has no rows in this many days before the prediction date
+            force (bool): Precompute and predict even if the upstream data didn't change since the last predictions
     """
     
-    # Retrain True case is not handled yet
+    db_engine = get_db_engine()
+
+    watermarks = check_upstream_freshness(db_engine, prediction_date, max_staleness_days)
+
     if retrain:
-        logging.warning('This case is not handled yet, exiting!')
+        if model_group_id is None:
+            if model_id is None:
+                raise ValueError('Either the model_id or model_group_id need to be provided to retrain!')
+            model_group_id = model_group_id_from_model_id(db_engine, model_id)
+
+        # the last retrain up to the prediction date is reused if the upstream data didn't change since it predicted
+        retrained_model_id = last_retrained_model_id(db_engine, model_group_id, prediction_date)
+        if not (force or is_test_run) and retrained_model_id is not None and last_prediction_watermarks(db_engine, retrained_model_id, prediction_date) == watermarks:
+            logging.info(f'Model group {model_group_id} was already retrained up to {prediction_date} (model {retrained_model_id}) and predicted from the same upstream data {watermarks}, nothing to do')
+            return
+
+        model_id = predict_forward_with_retrain(db_engine, prediction_date, model_group_id, project_path)
+
+    # a retrained model has the experiment config of its model group's last split
+    experiment_config = experiment_config_from_model_id(db_engine, experiment_model_id(db_engine, model_id))
+
+    if not (force or is_test_run) and last_prediction_watermarks(db_engine, model_id, prediction_date) == watermarks:
+        logging.info(f'Model {model_id} already has predictions as of {prediction_date} from the same upstream data {watermarks}, nothing to do')
         return
 
-    db_engine = get_db_engine()
-    
-    generate_current_eviction_features(db_engine, start_date=prediction_date, end_date=prediction_date) # default interval is 1 month
-    levels = ['city', 'districtcourtno', 'zip_cd']
-    for level in levels:
-        # Aggregating stats for location attributes
-        generate_location_level_eviction_aggregates(db_engine, level)
-        
-    # Aggregating stats for landlords
-    generate_landlord_level_eviction_aggregates(db_engine)
+    if delta:
+        logging.info(f'Precomputing the features of the cohort as of {prediction_date} only')
+        run_delta_precompute(db_engine, prediction_date, experiment_config, max_staleness_days)
+    else:
+        precompute_features(db_engine, prediction_date, experiment_config['feature_aggregations'])
+
+    precomputed_at = check_precompute_freshness(db_engine, prediction_date, watermarks, experiment_config['feature_aggregations'])
     
     logging.info(f'Generating predictions using Model {model_id}, as of {prediction_date} ')
     predict_forward_no_retrain(
@@ -219,6 +360,9 @@ def run_predict_forward(prediction_date, project_path, model_id, retrain=False,
         model_id=model_id,
         test_run=is_test_run
     )
+
+    if not is_test_run:
+        record_prediction_watermarks(db_engine, [model_id], prediction_date, watermarks, precomputed_at)
         
 
 if __name__ == '__main__':
@@ -229,8 +373,8 @@ if __name__ == '__main__':
         "-m",
         "--model_id",
         type=int,
-        help='triage model id for generating predictions (int)',
-        required=True
+        nargs='+',
+        help='triage model id(s) for generating predictions (int). With several ids and/or dates, every model predicts on every date in one batch'
     )
     
 
@@ -238,8 +382,14 @@ if __name__ == '__main__':
         "-d",
         "--as_of_date",
         type=str,
-        help='Prediction date',
-        required=True
+        nargs='+',
+        help='Prediction date(s)'
+    )
+
+    parser.add_argument(
+        "--pairs",
+        type=str,
+        help='CSV file with model_id and as_of_date columns, the (model, date) pairs to predict in one batch (instead of -m and -d)'
     )
 
     parser.add_argument(
@@ -250,19 +400,85 @@ if __name__ == '__main__':
         help='whether this is a test run. If set, predictions are only written to the triage_production schema not to acdhs_production'  
     )
     
-    args = parser.parse_args()
-    
-    run_predict_forward(
-        prediction_date=args.as_of_date,
-        project_path=PROJECT_PATH,
-        model_id=args.model_id,
-        is_test_run=args.testrun_flag
+    parser.add_argument(
+        "--delta",
+        action='store_true',
+        help='Only precompute the features of the prediction date\'s cohort, reusing the history and unchanged aggregate tables'
     )
-    
-    
-
 
+    parser.add_argument(
+        "--max-staleness-days",
+        type=int,
+        default=14,
+        help='Fail if an upstream table has no rows in this many days before the prediction date'
+    )
 
+    parser.add_argument(
+        "--force",
+        action='store_true',
+        help='Predict even if the model already has predictions on the date from the same upstream data'
+    )
 
+    parser.add_argument(
+        "--retrain",
+        action='store_true',
+        help='Retrain the model group of -m (or -g) up to the prediction date, reusing its train matrices, and predict with the new model'
+    )
 
+    parser.add_argument(
+        "-g",
+        "--model_group_id",
+        type=int,
+        help='With --retrain, the model group to retrain (instead of the model group of -m)'
+    )
+    
+    args = parser.parse_args()
 
+    if args.retrain:
+        if args.as_of_date is None or len(args.as_of_date) != 1 or (args.model_group_id is None and (args.model_id is None or len(args.model_id) != 1)):
+            parser.error('--retrain needs a single -d and either -g or a single -m')
+
+        run_predict_forward(
+            prediction_date=args.as_of_date[0],
+            project_path=PROJECT_PATH,
+            model_id=args.model_id[0] if args.model_id else None,
+            retrain=True,
+            model_group_id=args.model_group_id,
+            is_test_run=args.testrun_flag,
+            delta=args.delta,
+            max_staleness_days=args.max_staleness_days,
+            force=args.force
+        )
+    else:
+        if args.pairs is not None:
+            pairs = pd.read_csv(args.pairs, dtype={'as_of_date': str})[['model_id', 'as_of_date']].itertuples(index=False)
+        elif args.model_id is not None and args.as_of_date is not None:
+            pairs = [(model_id, as_of_date) for model_id in args.model_id for as_of_date in args.as_of_date]
+        else:
+            parser.error('Either --pairs or both -m and -d are required')
+        pairs = list(pairs)
+
+        if len(pairs) == 1:
+            run_predict_forward(
+                prediction_date=pairs[0][1],
+                project_path=PROJECT_PATH,
+                model_id=pairs[0][0],
+                is_test_run=args.testrun_flag,
+                delta=args.delta,
+                max_staleness_days=args.max_staleness_days,
+                force=args.force
+            )
+        else:
+            if args.delta:
+                parser.error('--delta is for a single model and date')
+
+            predict_forward_batch(
+                db_engine=get_db_engine(),
+                project_path=PROJECT_PATH,
+                pairs=pairs,
+                test_run=args.testrun_flag,
+                max_staleness_days=args.max_staleness_days,
+                force=args.force
+            )
+    
+    
@@ -1,7 +1,7 @@
 
 import pandas as pd
-from pretriage.precompute_features import generate_most_recent_features
-from pretriage.precompute_features import generate_aggregate_most_recent_features
+from pipeline.pretriage.precompute_features import generate_most_recent_features
+from pipeline.pretriage.precompute_features import generate_aggregate_most_recent_features
 
 
 def _generate_date_series(engine, start_date, end_date, interval):
@@ -16,7 +16,19 @@ def _generate_date_series(engine, start_date, end_date, interval):
 
     return pd.read_sql(q, engine).as_of_dates.tolist()
 
-def generate_current_eviction_features(engine, start_date, end_date, interval='1 month'):
+def generate_current_eviction_features(engine, start_date, end_date, interval='1 month', entity_filter=None, append=False, replace_filter=None):
+    """ The most recent eviction case (filing, disposition, order for possession and landlord stats) of every client, for every as_of_date
+
+        Args:
+            engine: SQLAlchemy engine
+            start_date (str): The first as_of_date
+            end_date (str): The last as_of_date
+            interval (str): The interval between the as_of_dates
+            entity_filter (str, optional): A condition on the client_id of the eviction matches (ecmi), e.g. a cohort.
+                Can contain an {as_of_date} placeholder
+            append (bool): Replace only the rows of these as_of_dates in the existing tables, keeping the other dates
+            replace_filter (str, optional): When appending, a condition on entity_id: only the rows of these entities are replaced
+    """
 
     ## filingdt features, specific to eviction
     source_table = 'pretriage.eviction_client_matches_id ecmi left join clean.eviction_landlords el on ecmi.matter_id = el.matter_id'
@@ -53,6 +65,9 @@ def generate_current_eviction_features(engine, start_date, end_date, interval='1
         distinct_on_column=distinct_on_column,
         quantities=quantities,
         as_of_dates=as_of_dates,
+        entity_filter=entity_filter,
+        append=append,
+        replace_filter=replace_filter,
         target_table='pretriage.most_recent_eviction'
     )
     
@@ -82,6 +97,9 @@ def generate_current_eviction_features(engine, start_date, end_date, interval='1
         distinct_on_column=distinct_on_column,
         quantities=quantities,
         as_of_dates=as_of_dates,
+        entity_filter=entity_filter,
+        append=append,
+        replace_filter=replace_filter,
         target_table='pretriage.most_recent_eviction_dspndt'
     )
 
@@ -107,6 +125,9 @@ def generate_current_eviction_features(engine, start_date, end_date, interval='1
         distinct_on_column=distinct_on_column,
         quantities=quantities,
         as_of_dates=as_of_dates,
+        entity_filter=entity_filter,
+        append=append,
+        replace_filter=replace_filter,
         target_table='pretriage.most_recent_eviction_ofpdt'
     )
 
@@ -172,5 +193,8 @@ def generate_current_eviction_features(engine, start_date, end_date, interval='1
         distinct_on_column=distinct_on_column,
         quantities=quantities,
         as_of_dates=as_of_dates,
+        entity_filter=entity_filter,
+        append=append,
+        replace_filter=replace_filter,
         target_table='pretriage.most_recent_eviction_landlord'
     )
\ No newline at end of file
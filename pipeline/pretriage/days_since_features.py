@@ -0,0 +1,150 @@
+import logging
+
+import pandas as pd
+
+
+# (event_type, source table, date column, condition) of every event stream with a days since feature.
+# The table gets a days_since_<event_type> column (days since the most recent event before the as_of_date)
+EVENT_STREAMS = [
+    ('eviction', 'pretriage.eviction_client_matches_id', 'filingdt', None),
+    ('dspn', 'pretriage.eviction_client_matches_id', 'dispositiondt', None),
+    ('ofp', 'pretriage.eviction_client_matches_id', 'ofp_issue_dt', None),
+    ('hl', 'pretriage.homelessness_id', 'program_end_dt', None),
+    ('bh', 'pretriage.cmu_behavioral_health_prm_id', 'event_end_date', None),
+    ('bh_f99', 'pretriage.cmu_behavioral_health_prm_id', 'event_end_date', "diagnosis_category_code = 'F99'"),
+    ('bh_304', 'pretriage.cmu_behavioral_health_prm_id', 'event_end_date', "diagnosis_category_code = '304'"),
+    ('bh_f11', 'pretriage.cmu_behavioral_health_prm_id', 'event_end_date', "diagnosis_category_code = 'F11'"),
+    ('bh_296', 'pretriage.cmu_behavioral_health_prm_id', 'event_end_date', "diagnosis_category_code = '296'"),
+    ('bh_311', 'pretriage.cmu_behavioral_health_prm_id', 'event_end_date', "diagnosis_category_code = '311'"),
+    ('bh_f10', 'pretriage.cmu_behavioral_health_prm_id', 'event_end_date', "diagnosis_category_code = 'F10'"),
+    ('bh_f32', 'pretriage.cmu_behavioral_health_prm_id', 'event_end_date', "diagnosis_category_code = 'F32'"),
+    ('bh_303', 'pretriage.cmu_behavioral_health_prm_id', 'event_end_date', "diagnosis_category_code = '303'"),
+    ('bh_295', 'pretriage.cmu_behavioral_health_prm_id', 'event_end_date', "diagnosis_category_code = '295'"),
+    ('bh_f12', 'pretriage.cmu_behavioral_health_prm_id', 'event_end_date', "diagnosis_category_code = 'F12'"),
+    ('bh_f31', 'pretriage.cmu_behavioral_health_prm_id', 'event_end_date', "diagnosis_category_code = 'F31'"),
+    ('bh_f33', 'pretriage.cmu_behavioral_health_prm_id', 'event_end_date', "diagnosis_category_code = 'F33'"),
+    ('bh_f41', 'pretriage.cmu_behavioral_health_prm_id', 'event_end_date', "diagnosis_category_code = 'F41'"),
+    ('bh_f25', 'pretriage.cmu_behavioral_health_prm_id', 'event_end_date', "diagnosis_category_code = 'F25'"),
+    ('bh_f60', 'pretriage.cmu_behavioral_health_prm_id', 'event_end_date', "diagnosis_category_code = 'F60'"),
+    ('bh_rehab', 'pretriage.cmu_behavioral_health_prm_id', 'event_end_date', "event_type = 'SUD IP REHAB'"),
+    ('bh_crisis', 'pretriage.cmu_behavioral_health_prm_id', 'event_end_date', "event_type = 'MH CRISIS'"),
+    ('bh_detox', 'pretriage.cmu_behavioral_health_prm_id', 'event_end_date', "event_type = 'SUD IP DETOX'"),
+    ('bh_emerg', 'pretriage.cmu_behavioral_health_prm_id', 'event_end_date', "event_type = 'MH EMERGENCY'"),
+    ('bh_assess', 'pretriage.cmu_behavioral_health_prm_id', 'event_end_date', "event_type = 'SUD ASSESSMENT'"),
+    ('bh_inpatient', 'pretriage.cmu_behavioral_health_prm_id', 'event_end_date', "event_type = 'MH INPATIENT'"),
+    ('mh', 'pretriage.cmu_mh_prm_id', 'event_end_date', None),
+    ('mh_mobile', 'pretriage.cmu_mh_prm_id', 'event_end_date', "event_type = 'MH CRISIS MOBILE'"),
+    ('mh_resident', 'pretriage.cmu_mh_prm_id', 'event_end_date', "event_type = 'MH CRISIS RESIDENTIAL'"),
+    ('mh_phone', 'pretriage.cmu_mh_prm_id', 'event_end_date', "event_type = 'MH CRISIS TELEPHONE'"),
+    ('mh_walkin', 'pretriage.cmu_mh_prm_id', 'event_end_date', "event_type = 'MH CRISIS WALK-IN'"),
+    ('mh_emerg', 'pretriage.cmu_mh_prm_id', 'event_end_date', "event_type = 'MH EMERGENCY'"),
+    ('mh_inpatient', 'pretriage.cmu_mh_prm_id', 'event_end_date', "event_type = 'MH INPATIENT'"),
+    ('phin', 'pretriage.public_housing_id', 'moveindate', None),
+    ('phout', 'pretriage.public_housing_id', 'moveoutdate_new', None),
+    ('ph_start', 'pretriage.cmu_physical_health_prm_id', 'svc_start_dt', None),
+    ('phys_end', 'pretriage.cmu_physical_health_prm_id', 'svc_end_dt_new', None),
+    ('pr_start', 'pretriage.program_involvement_id', 'program_start_dt', None),
+    ('elig_begin', 'pretriage.state_programs_consolidated_id', 'elig_begin_date', None),
+    ('contact', 'pretriage.link_contacts_id', 'contact_date', None),
+    ('referral', 'pretriage.link_coordinated_entry_id', 'referral_date', None),
+    ('paymnt', 'pretriage.rental_assistance_id', 'paymnt_dt', None),
+    ('subm', 'pretriage.rental_assistance_application_id', 'submitted_dt', None),
+    ('elig', 'pretriage.rental_assistance_application_id', 'elig_detrmn_dt', None),
+    ('eff', 'pretriage.address_feed_id', 'eff_date', None),
+]
+
+# event types that also use the days since their first event (the `max` metric of their feature groups)
+FIRST_EVENT_TYPES = ['referral', 'paymnt', 'subm', 'eff']
+
+
+def generate_days_since_features(engine, as_of_dates, target_table='pretriage.days_since_events', entity_filter=None, replace_filter=None):
+    """ One wide table with the days since the last event of every event stream, per entity and as_of_date.
+        Meant to be run before a triage experiment and used as the `from_obj` of the *_days_since feature groups.
+
+        Each of those feature groups used to scan its own source table for every as_of_date. Here all the
+        streams are stacked into (entity_id, event_type, event_date) and sorted once: every event is the last
+        one of its type until the next event, so it is joined only to the as_of_dates in between.
+
+        The rows have knowledge_date = as_of_date - 1 day so triage picks them up for their as_of_date, and the
+        feature groups select their as_of_date's row with `case when as_of_date = '{collate_date}'::date ...`.
+        triage's query of an as_of_date reads that date's rows only (see utils/precomputed_aggregations.py).
+        Entities without an event before the as_of_date have no value, and are imputed as before.
+
+        The table is created if it doesn't exist, and only the rows of the as_of_dates are replaced: the experiments,
+        predict forwards, retrains and services reading the same table keep the rows of their dates.
+
+        Args:
+            engine: SQLAlchemy engine
+            as_of_dates (List[str]): The as_of_dates of the experiment ('YYYY-MM-DD'). Features of other dates are not computed
+            target_table (str): The name of the table to create (<schema_name>.<table_name>)
+            entity_filter (str, optional): A condition on client_id restricting the events of every stream (e.g. to a cohort)
+            replace_filter (str, optional): A condition on entity_id: only the rows of these entities are replaced
+                (e.g. when the entity_filter keeps some entities of the cohort)
+    """
+
+    events = '\n                union all\n'.join(
+        f'''                select client_id as entity_id, '{event_type}' as event_type, {date_column}::date as event_date
+                from {source_table}
+                where {date_column} is not null{f' and {condition}' if condition else ''}{f' and {entity_filter}' if entity_filter else ''}'''
+        for event_type, source_table, date_column, condition in EVENT_STREAMS
+    )
+
+    columns = [
+        f"min(d.as_of_date - s.event_date) filter (where s.event_type = '{event_type}') as days_since_{event_type}"
+        for event_type, _, _, _ in EVENT_STREAMS
+    ] + [
+        f"max(d.as_of_date - s.first_event_date) filter (where s.event_type = '{event_type}') as days_since_first_{event_type}"
+        for event_type in FIRST_EVENT_TYPES
+    ]
+    columns = ',\n                '.join(columns)
+
+    dates = ', '.join(f"'{as_of_date}'" for as_of_date in sorted(set(as_of_dates)))
+
+    features = f'''
+            with events as (
+{events}
+            ),
+            spans as (
+                select
+                    entity_id,
+                    event_type,
+                    event_date,
+                    lead(event_date) over w as next_event_date,
+                    min(event_date) over w as first_event_date
+                from (select distinct entity_id, event_type, event_date from events) e
+                window w as (partition by entity_id, event_type order by event_date rows between unbounded preceding and unbounded following)
+            ),
+            as_of_dates as (
+                select unnest(array[{dates}]::date[]) as as_of_date
+            )
+            select
+                s.entity_id,
+                d.as_of_date,
+                d.as_of_date - 1 as knowledge_date,
+                {columns}
+            from spans s join as_of_dates d
+            on d.as_of_date > s.event_date and (s.next_event_date is null or d.as_of_date <= s.next_event_date)
+            group by s.entity_id, d.as_of_date
+    '''
+
+    q = ''
+    if not pd.read_sql(f"select to_regclass('{target_table}') is not null", engine).iloc[0, 0]:
+        q += f'''
+        create table {target_table} as ({features} limit 0);
+
+        create index on {target_table}(entity_id, as_of_date);
+        create index on {target_table}(knowledge_date);
+
+        alter table {target_table} owner to rg_staff;
+        '''
+
+    q += f'''
+        delete from {target_table} where as_of_date in ({dates}){f' and {replace_filter}' if replace_filter else ''};
+
+        insert into {target_table} {features};
+    '''
+
+    logging.info(q)
+
+    with engine.begin() as conn:
+        conn.execute(q)
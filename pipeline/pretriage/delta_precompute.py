@@ -0,0 +1,337 @@
+"""
+Precomputing the features of a single new as_of_date (the weekly predict forward) without rebuilding the history.
+
+The full precompute recreates the most recent eviction tables with only the prediction date, and rebuilds the
+location and landlord aggregates from all the eviction cases every time. Here:
+    - the upstream tables are checked first, and nothing runs if they are stale
+    - the most recent eviction and days since tables get the rows of the prediction date's cohort appended
+      (the rows of the other as_of_dates are kept)
+    - a partial run (e.g. the incremental scoring of a few clients) only replaces the rows of its entities, and reuses
+      the static and interval tables (that hold every entity) if they were built for the prediction date from the
+      current upstream data
+    - the aggregate tables are only rebuilt when their source tables changed since they were last built,
+      which is recorded in acdhs_experiments.precompute_log
+
+Every precompute (delta or full) records the watermarks its tables were built from in the log, and predict_forward
+refuses to score if a table the model's features read was not built from the current upstream data.
+"""
+import json
+import logging
+import os
+from datetime import date
+
+import pandas as pd
+
+from triage.predictlist.utils import cohort_config_from_label_config
+
+from pipeline.pretriage.current_eviction_features import generate_current_eviction_features
+from pipeline.pretriage.days_since_features import generate_days_since_features
+from pipeline.pretriage.interval_features import rebuild_interval_feature_tables, interval_feature_tables
+from pipeline.pretriage.non_entity_id_aggregate_features import generate_location_level_eviction_aggregates, generate_landlord_level_eviction_aggregates
+from pipeline.pretriage.static_features import generate_static_features
+from pipeline.utils.project_constants import CODE_BASEPATH, EXPERIMENT_METADATA_SCHEMA
+
+
+# (table, date column) of the tables the eviction features and aggregates are built from.
+# The latest date in a table before the prediction date is its watermark
+UPSTREAM_TABLES = [
+    ('clean.eviction', 'filingdt'),
+    ('pretriage.eviction_client_matches_id', 'filingdt'),
+    # the programs that started or ended (greatest ignores the null end dates)
+    ('pretriage.homelessness_id', 'greatest(program_start_dt, program_end_dt)'),
+]
+
+# aggregate table -> the function (re)building it
+AGGREGATE_TABLES = {
+    'pretriage.eviction_aggregates_at_city_level': lambda engine: generate_location_level_eviction_aggregates(engine, 'city'),
+    'pretriage.eviction_aggregates_at_districtcourtno_level': lambda engine: generate_location_level_eviction_aggregates(engine, 'districtcourtno'),
+    'pretriage.eviction_aggregates_at_zip_cd_level': lambda engine: generate_location_level_eviction_aggregates(engine, 'zip_cd'),
+    'pretriage.landlord_level_eviction_aggregates': lambda engine: generate_landlord_level_eviction_aggregates(engine),
+}
+
+# the precomputed tables that don't depend on the as_of_date, and the ones holding the rows of the prediction date
+STATIC_TABLES = ['pretriage.static_client_demographics', 'pretriage.static_age_at_involvement']
+DATED_TABLES = [
+    'pretriage.days_since_events',
+    'pretriage.most_recent_eviction',
+    'pretriage.most_recent_eviction_dspndt',
+    'pretriage.most_recent_eviction_ofpdt',
+    'pretriage.most_recent_eviction_landlord',
+]
+
+
+def _create_precompute_log_table(engine, schema=EXPERIMENT_METADATA_SCHEMA):
+    q = f'''
+        create schema if not exists {schema};
+
+        create table if not exists {schema}.precompute_log (
+            target_table varchar,
+            as_of_date date,
+            watermarks jsonb,
+            finished_at timestamp default now()
+        );
+    '''
+
+    with engine.begin() as conn:
+        conn.execute(q)
+
+
+def _record_precompute(engine, target_table, watermarks, as_of_date=None):
+    with engine.begin() as conn:
+        conn.execute(
+            f'''
+            insert into {EXPERIMENT_METADATA_SCHEMA}.precompute_log (target_table, as_of_date, watermarks)
+            values (%s, %s, %s)
+            ''',
+            (target_table, as_of_date, json.dumps(watermarks))
+        )
+
+
+def _last_precompute(engine, target_table, as_of_date=None):
+    """ (watermarks, finished_at) of the last build of the target table (for the as_of_date, if given), (None, None) if it never was """
+    as_of_date_condition = f"and as_of_date = '{as_of_date}'::date" if as_of_date else ''
+    q = f'''
+        select watermarks::text, finished_at::varchar
+        from {EXPERIMENT_METADATA_SCHEMA}.precompute_log
+        where target_table = '{target_table}' {as_of_date_condition}
+        order by finished_at desc
+        limit 1
+    '''
+    last = pd.read_sql(q, engine)
+
+    if last.empty:
+        return None, None
+
+    return json.loads(last.iloc[0, 0]), last.iloc[0, 1]
+
+
+def _last_watermarks(engine, target_table):
+    """ The watermarks of the source tables when the target table was last built, None if it never was """
+    return _last_precompute(engine, target_table)[0]
+
+
+def upstream_watermarks(engine, prediction_date):
+    """ The latest date before the prediction date of every upstream table
+
+        Returns:
+            (dict) table -> 'YYYY-MM-DD' (None if the table has no rows before the prediction date)
+    """
+    q = '\n        union all\n'.join(
+        f'''select '{table}' as source_table, max({date_column})::date::varchar as watermark from {table} where {date_column} < '{prediction_date}'::date'''
+        for table, date_column in UPSTREAM_TABLES
+    )
+
+    watermarks = pd.read_sql(q, engine)
+
+    return dict(zip(watermarks.source_table, watermarks.watermark))
+
+
+def check_upstream_freshness(engine, prediction_date, max_staleness_days=14):
+    """ Raise an error if an upstream table has no data in the max_staleness_days before the prediction date,
+        or if the client matches are behind the eviction filings (the matching wasn't run after the last load)
+
+        Returns:
+            (dict) the watermarks of the upstream tables
+    """
+    watermarks = upstream_watermarks(engine, prediction_date)
+    prediction_date_ = date.fromisoformat(prediction_date)
+
+    stale = list()
+    for table, watermark in watermarks.items():
+        if watermark is None:
+            stale.append(f'{table} has no rows before {prediction_date}')
+        elif (prediction_date_ - date.fromisoformat(watermark)).days > max_staleness_days:
+            stale.append(f'{table} was last updated on {watermark}')
+
+    if (watermarks['pretriage.eviction_client_matches_id'] or '') < (watermarks['clean.eviction'] or ''):
+        stale.append(
+            f"pretriage.eviction_client_matches_id ends on {watermarks['pretriage.eviction_client_matches_id']} "
+            f"but clean.eviction has filings until {watermarks['clean.eviction']} (rerun the client matching)"
+        )
+
+    if stale:
+        raise ValueError(
+            f'Stale upstream tables for a prediction date of {prediction_date} '
+            f'(more than {max_staleness_days} days old): ' + '; '.join(stale)
+        )
+
+    logging.info(f'Upstream tables are fresh: {watermarks}')
+
+    return watermarks
+
+
+def precomputed_tables(feature_aggregations):
+    """ The pretriage tables the features of an experiment config are read from """
+    return STATIC_TABLES + DATED_TABLES + list(AGGREGATE_TABLES) + interval_feature_tables(feature_aggregations)
+
+
+def record_precomputed_tables(engine, prediction_date, watermarks, feature_aggregations, dated_tables=True):
+    """ Record in the precompute log that the tables of the prediction date (all but the aggregates, which
+        refresh_eviction_aggregates records) were built from the upstream tables at these watermarks
+
+        Args:
+            dated_tables (bool): Also record the tables of the cohort's rows (DATED_TABLES), which a partial run only
+                builds for some entities
+    """
+    _create_precompute_log_table(engine)
+    for target_table in STATIC_TABLES:
+        _record_precompute(engine, target_table, watermarks)
+    for target_table in interval_feature_tables(feature_aggregations) + (DATED_TABLES if dated_tables else []):
+        _record_precompute(engine, target_table, watermarks, as_of_date=prediction_date)
+
+
+def record_precomputed_dates(engine, target_tables, as_of_dates):
+    """ Record in the precompute log that the rows of these as_of_dates of the dated tables were built, each from
+        the upstream tables at their watermarks before the as_of_date (e.g. the days since table of an experiment)
+    """
+    _create_precompute_log_table(engine)
+    for as_of_date in sorted(set(as_of_dates)):
+        watermarks = upstream_watermarks(engine, as_of_date)
+        for target_table in target_tables:
+            _record_precompute(engine, target_table, watermarks, as_of_date=as_of_date)
+
+
+def _population_tables_fresh(engine, prediction_date, watermarks, feature_aggregations):
+    """ Whether the static and interval tables (that hold every entity) were built for the prediction date from these watermarks """
+    return (
+        all(_last_precompute(engine, target_table)[0] == watermarks for target_table in STATIC_TABLES)
+        and all(_last_precompute(engine, target_table, prediction_date)[0] == watermarks for target_table in interval_feature_tables(feature_aggregations))
+    )
+
+
+def check_precompute_freshness(engine, prediction_date, watermarks, feature_aggregations):
+    """ Raise an error if a precomputed table was not built for the prediction date from the current upstream data
+        (it was never built, or the upstream tables changed since)
+
+        Returns:
+            (dict) table -> when it was last built
+    """
+    _create_precompute_log_table(engine)
+
+    dated_tables = DATED_TABLES + interval_feature_tables(feature_aggregations)
+
+    finished_at, stale = dict(), list()
+    for target_table in precomputed_tables(feature_aggregations):
+        table_watermarks, finished_at[target_table] = _last_precompute(
+            engine, target_table, as_of_date=prediction_date if target_table in dated_tables else None
+        )
+        if table_watermarks is None:
+            stale.append(f'{target_table} was never built' + (f' for {prediction_date}' if target_table in dated_tables else ''))
+        elif table_watermarks != watermarks:
+            stale.append(f'{target_table} was built on {finished_at[target_table]} from {table_watermarks}')
+
+    if stale:
+        raise ValueError(f'Precomputed tables are stale for the upstream data {watermarks}: ' + '; '.join(stale))
+
+    return finished_at
+
+
+def cohort_query(experiment_config, as_of_date):
+    """ The query of the cohort of an experiment config on an as_of_date
+
+        Uses the cohort query, or the entities of the label query if there isn't one (as triage's predict forward does)
+    """
+    cohort_config = experiment_config.get('cohort_config')
+    if cohort_config is None:
+        label_config = dict(experiment_config['label_config'])
+        if 'filepath' in label_config:
+            with open(os.path.join(CODE_BASEPATH, label_config.pop('filepath'))) as f:
+                label_config['query'] = f.read()
+        cohort_config = cohort_config_from_label_config(label_config)
+
+    if 'filepath' in cohort_config:
+        with open(os.path.join(CODE_BASEPATH, cohort_config['filepath'])) as f:
+            query = f.read()
+    else:
+        query = cohort_config['query']
+
+    return query.replace('{as_of_date}', as_of_date)
+
+
+def generate_cohort_table(engine, experiment_config, as_of_date, target_table='pretriage.predict_forward_cohort', entity_ids=None):
+    """ The entity_ids of the cohort on the as_of_date, used to restrict the precomputed features to the entities that are scored
+
+        Args:
+            entity_ids (list, optional): Only keep these entities of the cohort
+    """
+    entity_condition = f"where entity_id in ({', '.join(str(int(e)) for e in entity_ids)})" if entity_ids else ''
+    q = f'''
+        drop table if exists {target_table};
+
+        create table {target_table} as (
+            select distinct entity_id from ({cohort_query(experiment_config, as_of_date)}) as cohort
+            {entity_condition}
+        );
+
+        create index on {target_table}(entity_id);
+
+        alter table {target_table} owner to rg_staff;
+    '''
+
+    logging.info(q)
+
+    with engine.begin() as conn:
+        conn.execute(q)
+
+
+def refresh_eviction_aggregates(engine, watermarks):
+    """ Rebuild the location and landlord aggregate tables whose source tables changed since they were last built """
+    for target_table, generate in AGGREGATE_TABLES.items():
+        if _last_watermarks(engine, target_table) == watermarks:
+            logging.info(f'{target_table} is up to date with {watermarks}, reusing it')
+            continue
+
+        logging.info(f'Rebuilding {target_table}')
+        generate(engine)
+        _record_precompute(engine, target_table, watermarks)
+
+
+def run_delta_precompute(engine, prediction_date, experiment_config, max_staleness_days=14, entity_ids=None, cohort_table='pretriage.predict_forward_cohort'):
+    """ Precompute the feature tables of one prediction date for the cohort of a model's experiment config
+
+        Args:
+            engine: SQLAlchemy engine
+            prediction_date (str): The as_of_date of the predictions ('YYYY-MM-DD')
+            experiment_config (dict): The experiment config the model was trained with
+            max_staleness_days (int): The maximum number of days between the latest row of an upstream table and the prediction date
+            entity_ids (list, optional): Only precompute the features of these entities of the cohort. The rows of the
+                other entities are kept, and the dated tables are not recorded as built for the prediction date
+            cohort_table (str): Where the entities of the cohort are stored
+
+        Returns:
+            (dict) the watermarks of the upstream tables the features were built from
+    """
+    watermarks = check_upstream_freshness(engine, prediction_date, max_staleness_days)
+    _create_precompute_log_table(engine)
+
+    generate_cohort_table(engine, experiment_config, prediction_date, cohort_table, entity_ids)
+
+    feature_aggregations = experiment_config['feature_aggregations']
+    if entity_ids and _population_tables_fresh(engine, prediction_date, watermarks, feature_aggregations):
+        logging.info(f'The static and interval tables are up to date for {prediction_date} with {watermarks}, reusing them')
+    else:
+        generate_static_features(engine)
+        rebuild_interval_feature_tables(engine, feature_aggregations, [prediction_date])
+
+    # a partial run only replaces the rows of its entities
+    replace_filter = f'entity_id in (select entity_id from {cohort_table})' if entity_ids else None
+
+    generate_days_since_features(
+        engine,
+        [prediction_date],
+        entity_filter=f'client_id in (select entity_id from {cohort_table})',
+        replace_filter=replace_filter
+    )
+    generate_current_eviction_features(
+        engine,
+        start_date=prediction_date,
+        end_date=prediction_date,
+        entity_filter=f'ecmi.client_id in (select entity_id from {cohort_table})',
+        append=True,
+        replace_filter=replace_filter
+    )
+    refresh_eviction_aggregates(engine, watermarks)
+
+    record_precomputed_tables(engine, prediction_date, watermarks, feature_aggregations, dated_tables=not entity_ids)
+
+    return watermarks
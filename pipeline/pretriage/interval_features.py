@@ -0,0 +1,268 @@
+import hashlib
+import json
+import logging
+import re
+
+import pandas as pd
+
+from pipeline.utils.project_constants import EXPERIMENT_METADATA_SCHEMA
+
+
+# metrics whose value over the single precomputed row of an entity is the value of the precomputed column
+PRECOMPUTABLE_METRICS = ('min', 'max', 'sum', 'avg')
+
+PRECOMPUTED_TABLE_PREFIX = 'pretriage.interval_features_'
+
+
+def is_precomputable(feature_group):
+    """ Whether a feature group can be replaced by a precomputed table without changing its feature names or values
+
+        Only groups with more than one interval and plain aggregates (no categoricals) with min/max/sum/avg metrics.
+        A `count` over the single precomputed row would be 1, and the categoricals have their own imputation.
+    """
+    if len(feature_group.get('intervals', ['all'])) < 2:
+        return False
+
+    if feature_group.get('categoricals') or feature_group.get('array_categoricals'):
+        return False
+
+    aggregates = feature_group.get('aggregates', [])
+    return len(aggregates) > 0 and all(metric in PRECOMPUTABLE_METRICS for aggregate in aggregates for metric in aggregate['metrics'])
+
+
+def _quantities(aggregate):
+    """ (name, SQL expression) of the quantities of an aggregate """
+    quantity = aggregate['quantity']
+    if isinstance(quantity, dict):
+        return list(quantity.items())
+    return [(quantity, quantity)]
+
+
+def _column_name(i, metric, interval):
+    return f'q{i}_{metric}_{interval}'
+
+
+def build_interval_feature_table(engine, feature_group, as_of_dates, target_table, feature_start_time=None):
+    """ Compute every aggregate of a feature group for all its intervals and all the as_of_dates in one scan.
+        Meant to be run before a triage experiment, the table is read by the feature group returned by precomputed_feature_group.
+
+        triage computes the intervals of a group together, but runs one query (and one scan of the from_obj) per as_of_date.
+        Here the from_obj is joined to all the as_of_dates at once and every interval is a conditional aggregate (filter)
+        over the same rows. There is one row per entity and as_of_date, with knowledge_date = as_of_date - 1 day, and
+        triage's query of an as_of_date reads that date's rows only (see utils/precomputed_aggregations.py).
+
+        The table is created if it doesn't exist, and only the rows of the as_of_dates are replaced: the experiments
+        (and the predict forwards and retrains) reading the same table keep the rows of their dates.
+
+        Args:
+            engine: SQLAlchemy engine
+            feature_group (dict): The feature group config (as in configs/feature_groups), see is_precomputable
+            as_of_dates (List[str]): The as_of_dates to compute the features for ('YYYY-MM-DD')
+            target_table (str): The name of the table (<schema_name>.<table_name>)
+            feature_start_time (str, optional): Events before this date are ignored, as triage does with the temporal config's feature_start_time
+    """
+    knowledge_date_column = feature_group['knowledge_date_column']
+    intervals = feature_group['intervals']
+
+    columns = list()
+    i = 0
+    for aggregate in feature_group['aggregates']:
+        for _, expression in _quantities(aggregate):
+            for metric in aggregate['metrics']:
+                for interval in intervals:
+                    quantity = expression.replace("'{collate_date}'", 'd.as_of_date').replace('{collate_date}', 'd.as_of_date').replace('{collate_interval}', interval)
+                    column = f'{metric}({quantity})'
+                    if interval != 'all':
+                        column += f" filter (where s.{knowledge_date_column} >= d.as_of_date - interval '{interval}')"
+                    columns.append(f'{column} as "{_column_name(i, metric, interval)}"')
+            i += 1
+    columns = ',\n                '.join(columns)
+
+    join_condition = f's.{knowledge_date_column} < d.as_of_date'
+    if 'all' not in intervals:
+        greatest = ', '.join(f"interval '{interval}'" for interval in intervals)
+        join_condition += f' and s.{knowledge_date_column} >= d.as_of_date - greatest({greatest})'
+    if feature_start_time is not None:
+        join_condition += f" and s.{knowledge_date_column} >= '{feature_start_time}'::date"
+
+    dates = ', '.join(f"'{as_of_date}'" for as_of_date in sorted(set(as_of_dates)))
+
+    features = f'''
+            with as_of_dates as (
+                select unnest(array[{dates}]::date[]) as as_of_date
+            )
+            select
+                s.entity_id,
+                d.as_of_date,
+                d.as_of_date - 1 as knowledge_date,
+                {columns}
+            from (select * from {feature_group['from_obj'].strip()}) s join as_of_dates d
+            on {join_condition}
+            group by s.entity_id, d.as_of_date
+    '''
+
+    q = ''
+    if not pd.read_sql(f"select to_regclass('{target_table}') is not null", engine).iloc[0, 0]:
+        q += f'''
+        create table {target_table} as ({features} limit 0);
+
+        create index on {target_table}(entity_id, as_of_date);
+        create index on {target_table}(knowledge_date);
+
+        alter table {target_table} owner to rg_staff;
+        '''
+
+    q += f'''
+        delete from {target_table} where as_of_date in ({dates});
+
+        insert into {target_table} {features};
+    '''
+
+    logging.info(q)
+
+    with engine.begin() as conn:
+        conn.execute(q)
+
+
+def precomputed_feature_group(feature_group, target_table):
+    """ The feature group config that reads the table of build_interval_feature_table
+
+        The prefix, intervals, quantity names, metrics and imputation are the same, so are the feature names. Every
+        quantity reads the column of its metric for the interval triage is computing, in the row of the as_of_date.
+    """
+    aggregates = list()
+    i = 0
+    for aggregate in feature_group['aggregates']:
+        for name, _ in _quantities(aggregate):
+            for metric in aggregate['metrics']:
+                column = _column_name(i, metric, '{collate_interval}')
+                precomputed = {
+                    'quantity': {name: f'''case when as_of_date = '{{collate_date}}'::date then "{column}" end'''},
+                    'metrics': [metric],
+                }
+                if 'imputation' in aggregate:
+                    precomputed['imputation'] = aggregate['imputation']
+                if 'coltype' in aggregate:
+                    precomputed['coltype'] = aggregate['coltype']
+                aggregates.append(precomputed)
+            i += 1
+
+    precomputed_group = {
+        'prefix': feature_group['prefix'],
+        'from_obj': f"(select * from {target_table}) as {feature_group['prefix']}_precomputed",
+        'knowledge_date_column': 'knowledge_date',
+        'intervals': feature_group['intervals'],
+        'aggregates': aggregates,
+    }
+    if 'aggregates_imputation' in feature_group:
+        precomputed_group['aggregates_imputation'] = feature_group['aggregates_imputation']
+
+    return precomputed_group
+
+
+def precomputed_table_name(feature_group, feature_start_time=None):
+    """ The table of a feature group's definition: the groups of experiments with another definition (e.g. other intervals) get their own """
+    definition = json.dumps({'feature_group': feature_group, 'feature_start_time': feature_start_time}, sort_keys=True, default=str)
+
+    return f"{PRECOMPUTED_TABLE_PREFIX}{feature_group['prefix']}_{hashlib.md5(definition.encode()).hexdigest()[:8]}"
+
+
+def _create_precomputed_feature_groups_table(engine, schema=EXPERIMENT_METADATA_SCHEMA):
+    q = f'''
+        create schema if not exists {schema};
+
+        create table if not exists {schema}.precomputed_feature_groups (
+            target_table varchar primary key,
+            prefix varchar,
+            feature_group jsonb,
+            feature_start_time date,
+            recorded_at timestamp default now()
+        );
+    '''
+
+    with engine.begin() as conn:
+        conn.execute(q)
+
+
+def precompute_interval_feature_groups(engine, feature_aggregations, as_of_dates, feature_start_time=None):
+    """ Replace the multi-interval feature groups that can be precomputed by groups reading their precomputed table
+
+        The original definition of every replaced group is kept in acdhs_experiments.precomputed_feature_groups,
+        so the tables can be rebuilt for other dates (see rebuild_interval_feature_tables). The tables are named after
+        the prefix and a hash of the definition, so experiments with the same definition share a table.
+
+        Args:
+            engine: SQLAlchemy engine
+            feature_aggregations (List[dict]): The feature groups of the experiment config
+            as_of_dates (List[str]): The as_of_dates of the experiment ('YYYY-MM-DD')
+            feature_start_time (str, optional): The temporal config's feature_start_time
+
+        Returns:
+            (List[dict]) the feature groups, with the precomputed ones replaced
+    """
+    _create_precomputed_feature_groups_table(engine)
+
+    precomputed_aggregations = list()
+    n_precomputed = 0
+    for feature_group in feature_aggregations:
+        if not is_precomputable(feature_group):
+            precomputed_aggregations.append(feature_group)
+            continue
+
+        target_table = precomputed_table_name(feature_group, feature_start_time)
+        logging.info(f"Precomputing the {len(feature_group['intervals'])} intervals of {feature_group['prefix']} in {target_table}")
+        build_interval_feature_table(engine, feature_group, as_of_dates, target_table, feature_start_time)
+
+        with engine.begin() as conn:
+            conn.execute(
+                f'''
+                insert into {EXPERIMENT_METADATA_SCHEMA}.precomputed_feature_groups (target_table, prefix, feature_group, feature_start_time)
+                values (%s, %s, %s, %s)
+                on conflict (target_table) do update
+                set prefix = excluded.prefix, feature_group = excluded.feature_group, feature_start_time = excluded.feature_start_time, recorded_at = now()
+                ''',
+                (target_table, feature_group['prefix'], json.dumps(feature_group), feature_start_time)
+            )
+
+        precomputed_aggregations.append(precomputed_feature_group(feature_group, target_table))
+        n_precomputed += 1
+
+    logging.info(f'Precomputed {n_precomputed} of {len(feature_aggregations)} feature groups')
+
+    return precomputed_aggregations
+
+
+def interval_feature_tables(feature_aggregations):
+    """ The precomputed tables read by the feature groups of an experiment config """
+    return [
+        match.group(0)
+        for match in (re.search(rf'{re.escape(PRECOMPUTED_TABLE_PREFIX)}\w+', feature_group['from_obj']) for feature_group in feature_aggregations)
+        if match is not None
+    ]
+
+
+def rebuild_interval_feature_tables(engine, feature_aggregations, as_of_dates):
+    """ Build the rows of other as_of_dates (e.g. in predict_forward) in the precomputed tables read by the feature groups of an experiment config
+
+        Args:
+            engine: SQLAlchemy engine
+            feature_aggregations (List[dict]): The feature groups of the experiment config the model was trained with
+            as_of_dates (List[str]): The as_of_dates to compute the features for ('YYYY-MM-DD')
+    """
+    target_tables = interval_feature_tables(feature_aggregations)
+    if not target_tables:
+        return
+
+    q = f'''
+        select target_table, feature_group, feature_start_time::varchar
+        from {EXPERIMENT_METADATA_SCHEMA}.precomputed_feature_groups
+        where target_table in ({', '.join(f"'{t}'" for t in target_tables)})
+    '''
+    definitions = pd.read_sql(q, engine)
+
+    missing = set(target_tables) - set(definitions.target_table)
+    if missing:
+        raise ValueError(f'No recorded definition for the precomputed feature tables {missing}')
+
+    for row in definitions.itertuples():
+        build_interval_feature_table(engine, row.feature_group, as_of_dates, row.target_table, row.feature_start_time)
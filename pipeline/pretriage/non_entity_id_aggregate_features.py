@@ -112,8 +112,9 @@ def generate_landlord_level_eviction_aggregates(engine, table_schema='pretriage'
         conn.execute(q)
 
  
-engine = get_db_engine()
-aggregate_levels = ['city', 'districtcourtno', 'zip_cd']
+if __name__ == '__main__':
+    engine = get_db_engine()
+    aggregate_levels = ['city', 'districtcourtno', 'zip_cd']
 
-for agg in aggregate_levels:
-    generate_location_level_eviction_aggregates(engine, agg)
\ No newline at end of file
+    for agg in aggregate_levels:
+        generate_location_level_eviction_aggregates(engine, agg)
@@ -20,7 +20,44 @@ def assume_role(dbapi_con, connection_record):
     logging.debug(f'Listened for connection and changed role to {cur.fetchone()[0]}')
 
 
-def generate_most_recent_features(engine, from_obj, source_columns, date_column, distinct_on_column, quantities, as_of_dates, target_table, db_role=None):
+def _entity_filter_condition(entity_filter, as_of_date):
+    """ The entity filter of an as_of_date as an additional condition of a where clause """
+    if entity_filter is None:
+        return ''
+
+    return f"\n            and {entity_filter.replace('{as_of_date}', as_of_date)}"
+
+
+def _target_table_query(target_table, temp_tables, as_of_dates, append=False, set_role_statement='', replace_filter=None):
+    """ The query creating the target table from the temp tables of the as_of_dates.
+        When appending, only the rows of the as_of_dates (and of the entities of the replace_filter) are replaced
+        in the target table (created if it doesn't exist)
+    """
+    union = 'UNION ALL'.join(f'''
+        select * from {tt}
+        ''' for tt in temp_tables)
+
+    if not append:
+        return f'''
+    DROP TABLE IF EXISTS {target_table};
+    
+    {set_role_statement}
+    
+    CREATE TABLE {target_table} as ({union});'''
+
+    dates = ', '.join(f"'{as_of_date}'::date" for as_of_date in as_of_dates)
+
+    return f'''
+    {set_role_statement}
+
+    CREATE TABLE IF NOT EXISTS {target_table} as (select * from {temp_tables[0]} limit 0);
+
+    DELETE FROM {target_table} where knowledge_date in ({dates}){f' and {replace_filter}' if replace_filter else ''};
+
+    INSERT INTO {target_table} {union};'''
+
+
+def generate_most_recent_features(engine, from_obj, source_columns, date_column, distinct_on_column, quantities, as_of_dates, target_table, db_role=None, entity_filter=None, append=False, replace_filter=None):
     """ Generating a feature table that contains information about a "most recent" event. 
         Meant as a function to run prior to running a triage eperiment and outputs a table that can be used as a `from_obj` in the feature config. 
         Currently triage deosn't allow a natural way of creating these types of features in the feature config directly.  
@@ -36,6 +73,12 @@ def generate_most_recent_features(engine, from_obj, source_columns, date_column,
                 These will be the knowledge dates in the triage feature calculation
             target_table (str): The name of the final table we want to create (has to be in the format <schema_name>.<table_name>)
             db_role (str, optional): The database role name to use for table creation 
+            entity_filter (str, optional): A condition on the from_obj rows restricting the entities (e.g., to a cohort).
+                Can contain an {as_of_date} placeholder, which is replaced with each as_of_date
+            append (bool): Replace only the rows of the as_of_dates in an existing target table instead of recreating it,
+                so the rows of other as_of_dates are kept
+            replace_filter (str, optional): When appending, a condition on the entity_id of the target table's rows:
+                only the rows of these entities are replaced (e.g. when the entity_filter keeps some entities of the cohort)
     """
     
     query_template = ""
@@ -51,7 +94,7 @@ def generate_most_recent_features(engine, from_obj, source_columns, date_column,
             select 
             {source_columns} 
             from {from_obj}
-            where {date_column} < '{as_of_date}'::date
+            where {date_column} < '{as_of_date}'::date{entity_filter}
         )
         select distinct on ({distinct_on_column})
             {quantities},
@@ -81,7 +124,8 @@ def generate_most_recent_features(engine, from_obj, source_columns, date_column,
             date_column=date_column,
             distinct_on_column=distinct_on_column,
             quantities=quantites_formatted,
-            as_of_date=as_of_date
+            as_of_date=as_of_date,
+            entity_filter=_entity_filter_condition(entity_filter, as_of_date)
         )
 
         logger.info(f'Creating the temp table {table_name}:')
@@ -99,23 +143,7 @@ def generate_most_recent_features(engine, from_obj, source_columns, date_column,
     if db_role is not None:
         set_role_statement = f"set role '{db_role}';"
 
-    q = f'''
-    DROP TABLE IF EXISTS {target_table};
-    
-    {set_role_statement}
-    
-    CREATE TABLE {target_table} as (
-    '''
-
-    for i, tt in enumerate(temp_tables):
-        if i > 0 :
-            q+= 'UNION ALL'
-        
-        q += f'''
-        select * from {tt}
-        '''
-    
-    q += ');'
+    q = _target_table_query(target_table, temp_tables, as_of_dates, append, set_role_statement, replace_filter)
 
     logger.info(q)
 
@@ -139,7 +167,7 @@ def generate_most_recent_features(engine, from_obj, source_columns, date_column,
     
 
 
-def generate_aggregate_most_recent_features(engine, base_table_name, from_obj, source_columns, source_groupby_column, date_column, agg_quantities, agg_groupby_column, agg_source_table, distinct_on_column, quantities, as_of_dates, target_table):
+def generate_aggregate_most_recent_features(engine, base_table_name, from_obj, source_columns, source_groupby_column, date_column, agg_quantities, agg_groupby_column, agg_source_table, distinct_on_column, quantities, as_of_dates, target_table, entity_filter=None, append=False, replace_filter=None):
     """ Generating a feature table that contains aggregated information about a "most recent" event. 
         Meant as a function to run prior to running a triage eperiment and outputs a table that can be used as a `from_obj` in the feature config. 
         Currently triage deosn't allow a natural way of creating these types of features in the feature config directly.  
@@ -154,6 +182,11 @@ def generate_aggregate_most_recent_features(engine, base_table_name, from_obj, s
             as_of_dates (List[str]): A list of as_of_dates for which we want to caluclate the features. 
                 These will be the knowledge dates in the triage feature calculation
             target_table (str): The name of the final table we want to create (has to be in the format <schema_name>.<table_name>)
+            entity_filter (str, optional): A condition on the agg_source_table rows restricting the entities (e.g., to a cohort).
+                The aggregates are still calculated over all the from_obj rows. Can contain an {as_of_date} placeholder
+            append (bool): Replace only the rows of the as_of_dates in an existing target table instead of recreating it
+            replace_filter (str, optional): When appending, a condition on the entity_id of the target table's rows:
+                only the rows of these entities are replaced
     """
     
     query_template= """
@@ -177,7 +210,7 @@ def generate_aggregate_most_recent_features(engine, base_table_name, from_obj, s
             {quantities},
             '{as_of_date}'::date as knowledge_date
         from {agg_source_table}
-        where {date_column} < '{as_of_date}'::date
+        where {date_column} < '{as_of_date}'::date{entity_filter}
         order by {distinct_on_column}, {date_column} desc
     )
     """
@@ -208,7 +241,8 @@ def generate_aggregate_most_recent_features(engine, base_table_name, from_obj, s
             as_of_date=as_of_date,
             agg_quantities=agg_quantities,
             agg_groupby_column=agg_groupby_column,
-            agg_source_table=agg_source_table
+            agg_source_table=agg_source_table,
+            entity_filter=_entity_filter_condition(entity_filter, as_of_date)
         )
 
         logger.info(f'Creating the temp table {table_name}:')
@@ -222,21 +256,7 @@ def generate_aggregate_most_recent_features(engine, base_table_name, from_obj, s
 
     logger.info('All temp tables created. Creating the final table...')
 
-    q = f'''
-    DROP TABLE IF EXISTS {target_table};
-
-    CREATE TABLE {target_table} as (
-    '''
-
-    for i, tt in enumerate(temp_tables):
-        if i > 0 :
-            q+= 'UNION ALL'
-        
-        q += f'''
-        select * from {tt}
-        '''
-    
-    q += ');'
+    q = _target_table_query(target_table, temp_tables, as_of_dates, append, replace_filter=replace_filter)
 
     logger.info(q)
 
@@ -0,0 +1,105 @@
+import logging
+
+
+def generate_static_demographics(engine, target_table='pretriage.static_client_demographics'):
+    """ One row per client with the attributes that don't change over time (date of birth, gender, race).
+        Meant to be run before a triage experiment and used as the `from_obj` of the demo feature group.
+
+        The demo features used to read a distinct on over the whole client feed, which was evaluated again
+        for every as_of_date. The age is still calculated by triage for each as_of_date from the date of birth.
+
+        Args:
+            engine: SQLAlchemy engine
+            target_table (str): The name of the table to create (<schema_name>.<table_name>)
+    """
+
+    q = f'''
+        drop table if exists {target_table};
+
+        create table {target_table} as (
+            with clients as (
+                select distinct on (client_hash)
+                *
+                from clean.client_feed
+            )
+            select
+                greatest(dob, '2011-01-01'::date) as knowledge_date,
+                dob,
+                client_id as entity_id,
+                gender,
+                race
+            from clients c join pretriage.client_id_mapping cid using(client_hash)
+        );
+
+        create index on {target_table}(entity_id);
+        create index on {target_table}(knowledge_date);
+
+        alter table {target_table} owner to rg_staff;
+    '''
+
+    logging.info(q)
+
+    with engine.begin() as conn:
+        conn.execute(q)
+
+
+def generate_static_age_at_involvement(engine, target_table='pretriage.static_age_at_involvement'):
+    """ The program involvements that lower the minimum age (and minimum adult age) of a client at involvement.
+        Meant to be run before a triage experiment and used as the `from_obj` of the age_if feature group.
+
+        The age_if features are the minimum age over the involvements before an as_of_date. That minimum only
+        changes at the involvements that set a new low (ordered by start date), so keeping only those rows gives
+        the same features from a couple of rows per client instead of every involvement.
+
+        Args:
+            engine: SQLAlchemy engine
+            target_table (str): The name of the table to create (<schema_name>.<table_name>)
+    """
+
+    q = f'''
+        drop table if exists {target_table};
+
+        create table {target_table} as (
+            with involvements as (
+                select
+                    client_id as entity_id,
+                    program_start_dt,
+                    curr_age,
+                    case when curr_age >= 18 then curr_age else null end as adult_age_if
+                from pretriage.program_involvement_consolidated_id
+            ),
+            running_minimums as (
+                select
+                    *,
+                    min(curr_age) over w as previous_min_age,
+                    min(adult_age_if) over w as previous_min_adult_age
+                from involvements
+                window w as (partition by entity_id order by program_start_dt rows between unbounded preceding and 1 preceding)
+            )
+            select
+                entity_id,
+                program_start_dt,
+                curr_age,
+                adult_age_if
+            from running_minimums
+            where previous_min_age is null
+            or curr_age < previous_min_age
+            or (adult_age_if is not null and (previous_min_adult_age is null or adult_age_if < previous_min_adult_age))
+        );
+
+        create index on {target_table}(entity_id);
+        create index on {target_table}(program_start_dt);
+
+        alter table {target_table} owner to rg_staff;
+    '''
+
+    logging.info(q)
+
+    with engine.begin() as conn:
+        conn.execute(q)
+
+
+def generate_static_features(engine):
+    """ Precompute the tables of the time-invariant feature groups (demo, age_if) """
+    generate_static_demographics(engine)
+    generate_static_age_at_involvement(engine)
@@ -5,12 +5,12 @@ import pandas as pd
 import yaml
 
 import nbformat as nbf
-import shutil
 
 from datetime import date
 from datetime import datetime
 from triage.experiments import SingleThreadedExperiment, MultiCoreExperiment
 from triage.component.timechop.timechop import Timechop
+from triage.component.catwalk.storage import CSVMatrixStore
 from triage import create_engine
 from sqlalchemy.engine.url import URL
 from sqlalchemy.event import listens_for
@@ -30,9 +30,27 @@ for path in paths:
 from utils.utils import read_yaml
 from utils.project_constants import PROJECT_PATH, LOGS_PATH, EXPERIMENT_CONFIG_PATH, CODE_BASEPATH
 from pretriage.current_eviction_features import generate_current_eviction_features
+from pretriage.static_features import generate_static_features
+from pretriage.days_since_features import generate_days_since_features
+from pretriage.interval_features import precompute_interval_feature_groups
 # from pipeline.pretriage.deprecated.create_eviction_aggregate_tables import create_aggregate_tables
 
+from pipeline.pretriage.delta_precompute import record_precomputed_dates
 from pipeline.pretriage.non_entity_id_aggregate_features import generate_location_level_eviction_aggregates, generate_landlord_level_eviction_aggregates
+from pipeline.utils.grid_pruning import run_experiment_with_grid_pruning
+from pipeline.utils.cpu_budget import plan_cpu_budget, apply_cpu_plan, log_cpu_plan, check_cpu_oversubscription, bigtrain_classnames
+from pipeline.utils.experiment_estimates import experiment_as_of_dates, estimate_experiment_cost, log_experiment_estimate
+from pipeline.utils.performance_ledger import measure, record_timings, instrument_experiment
+from pipeline.utils.precomputed_aggregations import PrecomputedFeatureGenerator
+from pipeline.utils.warm_start import add_warm_start_models, run_experiment_with_warm_start
+from pipeline.utils.arrow_matrix_store import ArrowMatrixStore
+from pipeline.utils.sparse_matrices import SparseArrowMatrixStore, report_sparse_savings
+from pipeline.utils.wrapped_estimators import wrap_grid
+from pipeline.utils.feature_pruning import pruning_options, record_pruned_features_of
+from pipeline.utils.split_progress import run_experiment_newest_first
+from pipeline.utils.work_queue import run_coordinator, run_worker
+from pipeline.utils.utils import get_db_engine
+from pipeline.utils.experiment_report import generate_experiment_report, generate_experiment_report_in_background
 
 logger = logging.getLogger()
 logger.setLevel(logging.DEBUG)
@@ -45,18 +63,7 @@ fh.setFormatter(formatter)
 logger.addHandler(fh)
 # logger.addHandler(logging.StreamHandler())
 
-def generate_experiment_report():
-    template_path = 'notebooks/triage_reports/triage_summary_report_template.ipynb'
-
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M')
-    output_path = f'notebooks/triage_reports/triage_summary_report_{timestamp}.ipynb'
-
-    shutil.copyfile(template_path, output_path)
-
-    os.system(f'jupyter nbconvert --execute --inplace --to notebook {output_path}')
-    os.system(f'jupyter nbconvert  {output_path} --to html')
-
-def run_experiment(configfile_path, labelconfig_path=None, label_name=None, model_comment=None, feature_config_path=None, replace=False, save_predictions=False, n_jobs=1, only_validate=False, n_timesplits=None, run_precomputes=False):
+def run_experiment(configfile_path, labelconfig_path=None, label_name=None, model_comment=None, feature_config_path=None, replace=False, save_predictions=False, n_jobs=1, only_validate=False, n_timesplits=None, run_precomputes=False, prune_grid=False, prune_splits_per_round=2, prune_keep_fraction=0.5, plan_cpu=True, estimate_only=False, report='inline', report_formats=('notebook', 'html'), warm_start=False, warm_start_rounds=100, arrow_matrices=False, sparse_matrices=False, negative_fraction=None, precompute_intervals=False, role='local', n_local_workers=0, newest_first=False):
 
     logger.info(f'Reading the config file at {configfile_path}')
     config = read_yaml(configfile_path)
@@ -92,6 +99,44 @@ def run_experiment(configfile_path, labelconfig_path=None, label_name=None, mode
                 compute_recent_eviction_features = True
                 break
     
+    if warm_start and prune_grid:
+        raise ValueError('Warm start trains every split of the grid in order, it cannot be combined with grid pruning')
+
+    if warm_start and (sparse_matrices or pruning_options(config) or negative_fraction is not None):
+        raise ValueError('The warm-start models are not wrapped, they cannot be combined with sparse matrices, feature pruning or negative downsampling')
+
+    if newest_first and (warm_start or prune_grid or role == 'coordinator'):
+        raise ValueError('Newest first ordering cannot be combined with warm start, grid pruning or the coordinator role')
+
+    if role == 'coordinator' and (warm_start or prune_grid):
+        raise ValueError('The coordinator queues every split and model group at once, it cannot be combined with warm start or grid pruning')
+
+    # Boosted models continue from the previous split's booster, next to their cold copies for comparison
+    if warm_start:
+        config['grid_config'] = add_warm_start_models(config['grid_config'], f'{PROJECT_PATH}/warm_start_boosters', extra_rounds=warm_start_rounds)
+
+    # The mostly-zero columns are kept sparse in the matrices and handed to the estimators as CSR
+    if sparse_matrices:
+        config['grid_config'] = wrap_grid(config['grid_config'], sparse_input=True)
+
+    # Drop the (near) constant and duplicate columns of every training matrix before fitting
+    if pruning_options(config):
+        config['grid_config'] = wrap_grid(config['grid_config'], **pruning_options(config))
+
+    # Fast iteration: train on all the positives and a fraction of the (weighted) negatives
+    if negative_fraction is not None:
+        config['grid_config'] = wrap_grid(config['grid_config'], negative_fraction=negative_fraction)
+        config['model_comment'] = f"{config.get('model_comment', '')}_negatives_downsampled_{negative_fraction}".lstrip('_')
+
+    # Assign estimator threads so that the parallel processes don't oversubscribe the cores
+    n_bigtrain_jobs = 1
+    if plan_cpu:
+        cpu_plan = plan_cpu_budget(config['grid_config'], n_processes=n_jobs)
+        log_cpu_plan(cpu_plan)
+        config['grid_config'] = apply_cpu_plan(config['grid_config'], cpu_plan)
+        n_jobs = cpu_plan['n_processes']
+        n_bigtrain_jobs = cpu_plan['n_bigtrain_processes']
+
     # assume group role to ensure shared permissions
     @listens_for(Engine, "connect")
     def assume_role(dbapi_con, connection_record):
@@ -116,55 +161,134 @@ def run_experiment(configfile_path, labelconfig_path=None, label_name=None, mode
 
     db_engine = create_engine(db_url)
 
-    # if we need to compute recent eviction features
-    if compute_recent_eviction_features:
-        timechop = Timechop(**config['temporal_config'])
-        result = timechop.chop_time()
-        start_date = min([x['train_matrix']['first_as_of_time'] for x in result] + [y['first_as_of_time'] for x in result for y in x['test_matrices']])
-        end_date = max([x['train_matrix']['last_as_of_time'] for x in result] + [y['last_as_of_time'] for x in result for y in x['test_matrices']])
-        generate_current_eviction_features(db_engine, start_date, end_date) # default interval is 1 month
-        
-        levels = ['city', 'districtcourtno', 'zip_cd']
-        for level in levels:
-            # Aggregating stats for location attributes
-            generate_location_level_eviction_aggregates(db_engine, level)
-            
-        # Aggregating stats for landlords
-        generate_landlord_level_eviction_aggregates(db_engine)
-        
-        # create_aggregate_tables(db_engine)
+    # Dry run: count the work and estimate the cost from previous runs without running anything
+    if estimate_only:
+        logger.addHandler(logging.StreamHandler())
+        estimate = estimate_experiment_cost(config, db_engine, PROJECT_PATH, n_jobs=n_jobs, n_timesplits=n_timesplits)
+        log_experiment_estimate(estimate)
+        return estimate
+
+    # time-invariant attributes (demographics, age at involvement) are precomputed once per client
+    compute_static_features = any(
+        'pretriage.static_' in from_obj
+        for from_obj in [d.get('from_obj', '') for d in config['feature_aggregations']] + [config.get('bias_audit_config', {}).get('from_obj_table', '')]
+    )
+
+    # the days since the last event of every source are precomputed in one table for all the *_days_since groups
+    compute_days_since_features = any('pretriage.days_since_events' in d.get('from_obj', '') for d in config['feature_aggregations'])
 
+    # if we need to compute recent eviction features
+    precompute_timing = None
+    if compute_recent_eviction_features or compute_static_features or compute_days_since_features or precompute_intervals:
+        with measure() as precompute_timing:
+            if compute_static_features:
+                generate_static_features(db_engine)
+
+            if compute_days_since_features:
+                generate_days_since_features(db_engine, experiment_as_of_dates(config['temporal_config'], n_timesplits))
+                record_precomputed_dates(db_engine, ['pretriage.days_since_events'], experiment_as_of_dates(config['temporal_config'], n_timesplits))
+
+            # all the intervals and as_of_dates of the multi-interval groups in one scan per group
+            if precompute_intervals:
+                config['feature_aggregations'] = precompute_interval_feature_groups(
+                    db_engine,
+                    config['feature_aggregations'],
+                    experiment_as_of_dates(config['temporal_config'], n_timesplits),
+                    feature_start_time=config['temporal_config'].get('feature_start_time')
+                )
+
+            if compute_recent_eviction_features:
+                timechop = Timechop(**config['temporal_config'])
+                result = timechop.chop_time()
+                start_date = min([x['train_matrix']['first_as_of_time'] for x in result] + [y['first_as_of_time'] for x in result for y in x['test_matrices']])
+                end_date = max([x['train_matrix']['last_as_of_time'] for x in result] + [y['last_as_of_time'] for x in result for y in x['test_matrices']])
+                generate_current_eviction_features(db_engine, start_date, end_date) # default interval is 1 month
+
+                levels = ['city', 'districtcourtno', 'zip_cd']
+                for level in levels:
+                    # Aggregating stats for location attributes
+                    generate_location_level_eviction_aggregates(db_engine, level)
+
+                # Aggregating stats for landlords
+                generate_landlord_level_eviction_aggregates(db_engine)
+
+                # create_aggregate_tables(db_engine)
+
+    # Matrices are loaded from memory-mapped float32 feather files (written next to the CSVs on first load)
+    matrix_storage_class = ArrowMatrixStore if arrow_matrices else CSVMatrixStore
+    if sparse_matrices:
+        matrix_storage_class = SparseArrowMatrixStore
+
+    # The wrapped and warm-started random forests and boosted trees are trained in triage's bigtrain batch too
     if n_jobs > 1:
         experiment = MultiCoreExperiment(
             config=config,
             db_engine=db_engine,
             n_processes=n_jobs,
+            n_bigtrain_processes=n_bigtrain_jobs,
             n_db_processes=2,
             project_path=PROJECT_PATH,
+            matrix_storage_class=matrix_storage_class,
             replace=replace,
-            save_predictions=save_predictions
+            save_predictions=save_predictions,
+            additional_bigtrain_classnames=bigtrain_classnames(config['grid_config'])
         )
     else:
         experiment = SingleThreadedExperiment(
             config=config,
             db_engine=db_engine,
             project_path=PROJECT_PATH,
+            matrix_storage_class=matrix_storage_class,
             replace=replace,
-            save_predictions=save_predictions
+            save_predictions=save_predictions,
+            additional_bigtrain_classnames=bigtrain_classnames(config['grid_config'])
         )
     
     if n_timesplits is not None:
         # Providing the option to run only the last(most recent) n timesplits in the experiment
         experiment.split_definitions = experiment.split_definitions[-n_timesplits:]
 
+    # The feature groups reading a precomputed table read the rows of their as_of_date only
+    experiment.feature_generator.__class__ = PrecomputedFeatureGenerator
+
+    # Record the time, CPU and memory of every phase (and model) of this run
+    instrument_experiment(experiment)
+    record_pruned_features_of(experiment)
+    if precompute_timing is not None:
+        record_timings(db_engine, [dict(precompute_timing, experiment_hash=experiment.experiment_hash, run_id=experiment.run_id, phase='precompute')])
+
     experiment.validate()
+    check_cpu_oversubscription(config['grid_config'], n_processes=n_jobs, n_bigtrain_processes=n_bigtrain_jobs)
 
     if only_validate:
         return 
     
-    experiment.run()
-    
-    generate_experiment_report()
+    if prune_grid:
+        # Train all model groups on the most recent splits and only carry the best ones to older splits
+        run_experiment_with_grid_pruning(
+            experiment,
+            n_recent_splits=prune_splits_per_round,
+            keep_fraction=prune_keep_fraction
+        )
+    elif warm_start:
+        # Splits are trained oldest to newest so that the boosters can be continued
+        run_experiment_with_warm_start(experiment)
+    elif newest_first:
+        # Every split is built, trained and evaluated before the next (older) one
+        run_experiment_newest_first(experiment)
+    elif role == 'coordinator':
+        # Matrix builds and model training are claimed from the queue by workers (on this or other hosts)
+        run_coordinator(experiment, n_local_workers=n_local_workers)
+    else:
+        experiment.run()
+
+    if sparse_matrices:
+        report_sparse_savings(db_engine, experiment.matrix_storage_engine, list(experiment.matrix_build_tasks.keys()))
+
+    if report == 'inline':
+        generate_experiment_report(output_formats=report_formats)
+    elif report == 'background':
+        generate_experiment_report_in_background(output_formats=report_formats)
 
 
 if __name__ == '__main__':
@@ -175,8 +299,8 @@ if __name__ == '__main__':
         "-c",
         "--configfile",
         type=str,
-        help='Name of the config file (Not the full path)',
-        required=True
+        help='Name of the config file (Not the full path). Not needed for --role worker',
+        required=False
     )
 
     parser.add_argument(
@@ -184,7 +308,7 @@ if __name__ == '__main__':
         "--njobs",
         type=int,
         help='Number of concurrent jobs to run',
-        required=True
+        required=False
     )
 
     parser.add_argument(
@@ -242,11 +366,136 @@ if __name__ == '__main__':
         help="number of validation splits",
         required=False
     )
-    
+
+    parser.add_argument(
+        "--prune-grid",
+        dest='prune_grid_flag',
+        action='store_true',
+        help='Whether to prune the model grid by successive halving over the time splits (most recent splits first)'
+    )
+
+    parser.add_argument(
+        "--prune-splits",
+        type=int,
+        default=2,
+        help='Number of time splits evaluated in each grid pruning round',
+        required=False
+    )
+
+    parser.add_argument(
+        "--prune-keep",
+        type=float,
+        default=0.5,
+        help='Fraction of model groups carried to the next (older) grid pruning round',
+        required=False
+    )
+
+    parser.add_argument(
+        "--no-cpu-plan",
+        dest='no_cpu_plan_flag',
+        action='store_true',
+        help='Whether to keep the thread counts of the grid as they are instead of planning them from the number of cores and jobs'
+    )
+
+    parser.add_argument(
+        "--estimate",
+        dest='estimate_flag',
+        action='store_true',
+        help='Whether to only count the work of the config and estimate its wall time and disk use (dry run)'
+    )
+
+    parser.add_argument(
+        "--warm-start",
+        dest='warm_start_flag',
+        action='store_true',
+        help='Whether to add warm-started copies of the boosted models that continue from the previous split\'s booster'
+    )
+
+    parser.add_argument(
+        "--warm-start-rounds",
+        type=int,
+        default=100,
+        help='Boosting rounds the warm-started models add on each split',
+        required=False
+    )
+
+    parser.add_argument(
+        "--arrow-matrices",
+        dest='arrow_matrices_flag',
+        action='store_true',
+        help='Whether to load the matrices from memory-mapped float32 feather files instead of parsing the CSVs'
+    )
+
+    parser.add_argument(
+        "--sparse-matrices",
+        dest='sparse_matrices_flag',
+        action='store_true',
+        help='Whether to keep the mostly-zero matrix columns sparse (CSR) from storage to the estimators that accept it'
+    )
+
+    parser.add_argument(
+        "--negative-fraction",
+        type=float,
+        help='Fraction of the negatives (per as_of_date) to train on, for fast iteration runs. The negatives are weighted to keep the scores calibrated',
+        required=False
+    )
+
+    parser.add_argument(
+        "--newest-first",
+        dest='newest_first_flag',
+        action='store_true',
+        help='Whether to build, train and evaluate one split at a time starting from the most recent one (progress in acdhs_experiments.split_progress)'
+    )
+
+    parser.add_argument(
+        "--role",
+        type=str,
+        choices=['local', 'coordinator', 'worker'],
+        default='local',
+        help='local runs the whole experiment here. coordinator runs the database steps and queues the matrices and models for workers, worker runs queued tasks (of any experiment)'
+    )
+
+    parser.add_argument(
+        "--local-workers",
+        type=int,
+        default=0,
+        help='Number of worker processes the coordinator starts on this host'
+    )
+
+    parser.add_argument(
+        "--precompute-intervals",
+        dest='precompute_intervals_flag',
+        action='store_true',
+        help='Whether to precompute the multi-interval feature groups (all intervals and as_of_dates in one scan) into tables triage reads'
+    )
+
+    parser.add_argument(
+        "--report",
+        type=str,
+        choices=['inline', 'background', 'none'],
+        default='inline',
+        help='Whether to generate the summary report notebook after the experiment, in a detached process that run.py does not wait for, or not at all'
+    )
+
+    parser.add_argument(
+        "--report-formats",
+        type=str,
+        nargs='+',
+        default=['notebook', 'html'],
+        help='Formats of the summary report (nbconvert exporter names, e.g. notebook html pdf)'
+    )
     
     args = parser.parse_args()
 
     print(args)
+
+    if args.role == 'worker':
+        # the experiment configs come from the queue
+        run_worker(get_db_engine())
+        sys.exit(0)
+
+    if args.configfile is None or args.njobs is None:
+        parser.error('--configfile and --njobs are required (except for --role worker)')
     
     if args.featureconfig_flag:
         feature_config_path=f'{EXPERIMENT_CONFIG_PATH}/feature_groups/'
@@ -269,7 +518,23 @@ if __name__ == '__main__':
         n_jobs=args.njobs, 
         only_validate=False,
         n_timesplits=args.splits,
-        run_precomputes=False
+        run_precomputes=False,
+        prune_grid=args.prune_grid_flag,
+        prune_splits_per_round=args.prune_splits,
+        prune_keep_fraction=args.prune_keep,
+        plan_cpu=not args.no_cpu_plan_flag,
+        estimate_only=args.estimate_flag,
+        report=args.report,
+        report_formats=args.report_formats,
+        warm_start=args.warm_start_flag,
+        warm_start_rounds=args.warm_start_rounds,
+        arrow_matrices=args.arrow_matrices_flag,
+        sparse_matrices=args.sparse_matrices_flag,
+        negative_fraction=args.negative_fraction,
+        precompute_intervals=args.precompute_intervals_flag,
+        role=args.role,
+        n_local_workers=args.local_workers,
+        newest_first=args.newest_first_flag
     )
     
     
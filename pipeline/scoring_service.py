@@ -0,0 +1,437 @@
+"""
+A local HTTP service scoring clients with the production model as of today, for the cases filed after the weekly
+predict forward (e.g. an outreach worker asking about a new eviction filing).
+
+The service keeps the model (its compiled form if there is one), the columns of its train matrix and the production
+matrix of today warm in memory. The matrix is built with the same code as predict_forward (the delta precompute of the
+cohort and triage's feature generation and imputation, see utils/production_matrices.py), so the scores are the ones
+the batch would give. The whole cohort is scored when the matrix is built, and ranked like the batch (triage's ranks
+without ties), so a request is a lookup. The matrix is rebuilt in the background when the upstream tables get new rows
+(checked every --refresh-minutes, and on the first request of a new day); requests use the previous scores until the
+new ones replace them. An entity that is not in the scored cohort (e.g. its case was filed after the last build) is
+scored on demand: the delta precompute and the matrix of only that entity, which is then ranked in the cohort.
+
+    python -m pipeline.scoring_service -m <model_id> [--port 8765]
+
+    curl 'localhost:8765/score?entity_id=123&entity_id=456'
+    curl 'localhost:8765/score?client_hash=abc'
+    curl -X POST localhost:8765/score -d '{"entity_ids": [123, 456]}'
+    curl localhost:8765/health
+"""
+import argparse
+import json
+import logging
+import threading
+import time
+from datetime import date, datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+import pandas as pd
+from triage.component.catwalk.storage import ProjectStorage
+
+from pipeline.pretriage.delta_precompute import run_delta_precompute, upstream_watermarks
+from pipeline.utils.model_cache import model_storage_engine
+from pipeline.utils.production_matrices import ProductionModel, CachingPredictor, build_production_matrix, cohort_table_model
+from pipeline.utils.tree_inference import compiled_model_storage_engine
+from pipeline.utils.utils import get_db_engine
+from pipeline.utils.project_constants import PROJECT_PATH
+
+
+# the largest batch of entities a request can score
+MAX_BATCH_SIZE = 1000
+
+# the service's own cohort and feature tables, so a rebuild doesn't overwrite the ones of a running predict_forward
+COHORT_TABLE = 'pretriage.scoring_service_cohort'
+FEATURES_SCHEMA = 'triage_scoring_service'
+
+# the tables of the entities scored on demand, so they don't overwrite the ones of a rebuild running in the background
+ON_DEMAND_COHORT_TABLE = 'pretriage.scoring_service_on_demand_cohort'
+ON_DEMAND_FEATURES_SCHEMA = 'triage_scoring_service_on_demand'
+
+
+def rank_no_ties(scores):
+    """ triage's ranks without ties (rank_abs_no_ties and rank_pct_no_ties) of a Series of scores
+
+        As triage's Predictor: by descending score, the ties in the order of the matrix, and the percentile of the
+        absolute rank (which has no ties, so it is rank / number of scores). triage's matrix builder sorts the rows of
+        the matrix as text, so the ties are in the text order of their entity_ids (e.g. 13 before 135 before 14).
+    """
+    in_matrix_order = scores.sort_index(key=lambda entity_ids: entity_ids.astype(str), kind='mergesort')
+    ordered = in_matrix_order.sort_values(ascending=False, kind='mergesort', na_position='last')
+    rank_abs = pd.Series(np.arange(1, len(ordered) + 1), index=ordered.index).reindex(scores.index)
+
+    return pd.DataFrame({'score': scores, 'rank_abs_no_ties': rank_abs, 'rank_pct_no_ties': rank_abs / len(scores)})
+
+
+class ScoringService:
+    """ The production model and the scores of today's cohort, kept in memory
+
+        Args:
+            db_engine: SQLAlchemy engine
+            model_id (int): triage model id of the production model
+            project_path (str): Where the models and matrices are stored
+            max_staleness_days (int): The precompute fails if an upstream table has no rows in this many days
+    """
+
+    def __init__(self, db_engine, model_id, project_path=PROJECT_PATH, max_staleness_days=14):
+        self.db_engine = db_engine
+        self.model_id = model_id
+        self.max_staleness_days = max_staleness_days
+
+        project_storage = ProjectStorage(project_path)
+        self.matrix_storage_engine = project_storage.matrix_storage_engine()
+        self.production_model = ProductionModel(db_engine, model_id)
+        self.train_matrix_columns = self.matrix_storage_engine.get_store(self.production_model.train_matrix_uuid).columns()
+
+        start = time.perf_counter()
+        predictor = CachingPredictor(
+            model_storage_engine=model_storage_engine(project_storage),
+            db_engine=db_engine,
+            rank_order='best',
+            compiled_model_storage_engine=compiled_model_storage_engine(project_storage)
+        )
+        self.model = predictor.load_model(model_id)
+        logging.info(f'Loaded model {model_id} in {time.perf_counter() - start:.1f} seconds')
+
+        self.on_demand_model = cohort_table_model(self.production_model, ON_DEMAND_COHORT_TABLE, 'on_demand')
+
+        # the state (as_of_date, scores, ...) is replaced as a whole, so a request reads either the old or the new one.
+        # _lock guards the start of a build and the swaps, _on_demand_lock the on-demand tables
+        self._lock = threading.Lock()
+        self._on_demand_lock = threading.Lock()
+        self._builder = None
+        self._state = None
+
+    def _score_matrix(self, matrix_uuid):
+        """ The scores of the entities of a production matrix """
+        X = self.matrix_storage_engine.get_store(matrix_uuid).matrix_with_sorted_columns(self.train_matrix_columns)
+        return pd.Series(self.model.predict_proba(X)[:, 1], index=X.index.get_level_values('entity_id'), name='score')
+
+    def _client_hashes(self, cohort_table):
+        return pd.read_sql(
+            f'select client_id as entity_id, client_hash from pretriage.client_id_mapping where client_id in (select entity_id from {cohort_table})',
+            self.db_engine
+        ).set_index('client_hash').entity_id
+
+    def _build(self, as_of_date, watermarks):
+        """ Precompute the features of the cohort on the as_of_date, build its matrix and score it """
+        start = time.perf_counter()
+        run_delta_precompute(
+            self.db_engine,
+            as_of_date,
+            self.production_model.experiment_config,
+            self.max_staleness_days,
+            cohort_table=COHORT_TABLE
+        )
+        matrix_uuid = build_production_matrix(
+            self.db_engine,
+            self.matrix_storage_engine,
+            self.production_model,
+            as_of_date,
+            matrix_id=f'{as_of_date}_model_id_{self.model_id}_on_demand',
+            features_schema_name=FEATURES_SCHEMA
+        )
+
+        scores = rank_no_ties(self._score_matrix(matrix_uuid))
+        client_hashes = self._client_hashes(COHORT_TABLE)
+
+        logging.info(f'Scored the {len(scores)} clients of the cohort as of {as_of_date} in {time.perf_counter() - start:.1f} seconds')
+
+        return {
+            'as_of_date': as_of_date,
+            'watermarks': watermarks,
+            'built_at': datetime.now().isoformat(timespec='seconds'),
+            'matrix_uuid': matrix_uuid,
+            'scores': scores,
+            'client_hashes': client_hashes,
+        }
+
+    def _build_and_swap(self, as_of_date, watermarks):
+        try:
+            state = self._build(as_of_date, watermarks)
+        except Exception:
+            logging.exception(f'Building the scores as of {as_of_date} failed, keeping the previous ones')
+            return
+
+        with self._lock:
+            self._state = state
+
+    def refresh(self, force=False, wait=False):
+        """ Rebuild today's scores in the background if the day or the upstream tables changed since they were built
+
+            One build runs at a time, and requests keep using the previous scores until it is done.
+
+            Args:
+                force (bool): rebuild even if the scores are up to date
+                wait (bool): wait for the build to finish. Always waits when there are no scores yet
+
+            Returns:
+                (dict) the current state, None if there are no scores (the first build failed)
+        """
+        as_of_date = str(date.today())
+        watermarks = upstream_watermarks(self.db_engine, as_of_date)
+
+        with self._lock:
+            state = self._state
+            if not force and state is not None and state['as_of_date'] == as_of_date and state['watermarks'] == watermarks:
+                return state
+
+            builder = self._builder
+            if builder is None or not builder.is_alive():
+                logging.info(f'Building the scores as of {as_of_date} from {watermarks}')
+                builder = threading.Thread(target=self._build_and_swap, args=(as_of_date, watermarks), daemon=True)
+                builder.start()
+                self._builder = builder
+
+        if wait or state is None:
+            builder.join()
+
+        return self._state
+
+    def _score_on_demand(self, state, entity_ids):
+        """ Score entities that are not in the state's cohort as of its as_of_date, and rank them in the cohort
+
+            The entities that are in the cohort now (e.g. filed after the scores were built) are added to the state.
+
+            Returns:
+                (dict) the state with their scores, the same state if none of them is in the cohort
+        """
+        as_of_date = state['as_of_date']
+        logging.info(f'Scoring {len(entity_ids)} entities that are not in the cohort of the scores as of {as_of_date}')
+
+        with self._on_demand_lock:
+            run_delta_precompute(
+                self.db_engine,
+                as_of_date,
+                self.production_model.experiment_config,
+                self.max_staleness_days,
+                entity_ids=entity_ids,
+                cohort_table=ON_DEMAND_COHORT_TABLE
+            )
+            if not pd.read_sql(f'select count(*) from {ON_DEMAND_COHORT_TABLE}', self.db_engine).iloc[0, 0]:
+                return state
+
+            matrix_uuid = build_production_matrix(
+                self.db_engine,
+                self.matrix_storage_engine,
+                self.on_demand_model,
+                as_of_date,
+                matrix_id=f"{as_of_date}_model_id_{self.model_id}_on_demand_{time.strftime('%H%M%S')}",
+                features_schema_name=ON_DEMAND_FEATURES_SCHEMA
+            )
+            scores = self._score_matrix(matrix_uuid)
+            client_hashes = self._client_hashes(ON_DEMAND_COHORT_TABLE)
+
+        with self._lock:
+            # a rebuild that finished in the meantime has them already (or is of another day)
+            current = self._state
+            if current['as_of_date'] != as_of_date or current['matrix_uuid'] != state['matrix_uuid']:
+                return current
+
+            new_scores = scores[~scores.index.isin(current['scores'].index)]
+            self._state = dict(
+                current,
+                scores=rank_no_ties(pd.concat([current['scores'].score, new_scores])),
+                client_hashes=pd.concat([current['client_hashes'], client_hashes[~client_hashes.index.isin(current['client_hashes'].index)]]),
+            )
+
+            return self._state
+
+    def score(self, entity_ids=(), client_hashes=()):
+        """ The scores as of today of entities (or clients, by client_hash)
+
+            Returns:
+                (dict) the as_of_date, the cohort size and a result per entity. The entities that are not in the scored
+                cohort are scored on demand, and the ones that are not in the model's cohort today get not_in_cohort
+                instead of a score
+        """
+        if len(entity_ids) + len(client_hashes) > MAX_BATCH_SIZE:
+            raise ValueError(f'At most {MAX_BATCH_SIZE} entities can be scored in a request')
+
+        state = self._state
+        if state is None or state['as_of_date'] != str(date.today()):
+            state = self.refresh()
+        if state is None:
+            raise RuntimeError('There are no scores, building them failed (see the log)')
+
+        # clients are looked up by hash in the mapping when they are not in the scored cohort
+        hash_entity_ids = {h: state['client_hashes'][h] for h in client_hashes if h in state['client_hashes'].index}
+        unknown_hashes = [h for h in client_hashes if h not in hash_entity_ids]
+        if unknown_hashes:
+            mapping = pd.read_sql(
+                'select client_hash, client_id from pretriage.client_id_mapping where client_hash in %(hashes)s',
+                self.db_engine,
+                params={'hashes': tuple(unknown_hashes)}
+            )
+            hash_entity_ids.update(zip(mapping.client_hash, mapping.client_id))
+
+        requested = [('entity_id', int(e), int(e)) for e in entity_ids]
+        requested += [('client_hash', h, int(hash_entity_ids[h]) if h in hash_entity_ids else None) for h in client_hashes]
+
+        missing = sorted({entity_id for _, _, entity_id in requested if entity_id is not None and entity_id not in state['scores'].index})
+        if missing:
+            state = self._score_on_demand(state, missing)
+
+        results = list()
+        for key, value, entity_id in requested:
+            result = {key: value, 'entity_id': entity_id}
+            if entity_id is None or entity_id not in state['scores'].index:
+                result['not_in_cohort'] = True
+            else:
+                row = state['scores'].loc[entity_id]
+                result.update({
+                    'score': float(row.score),
+                    'rank_abs_no_ties': int(row.rank_abs_no_ties),
+                    'rank_pct_no_ties': float(row.rank_pct_no_ties),
+                })
+            results.append(result)
+
+        return {
+            'model_id': self.model_id,
+            'as_of_date': state['as_of_date'],
+            'cohort_size': len(state['scores']),
+            'results': results,
+        }
+
+    def health(self):
+        state = self._state or {}
+        return {
+            'model_id': self.model_id,
+            'as_of_date': state.get('as_of_date'),
+            'built_at': state.get('built_at'),
+            'watermarks': state.get('watermarks'),
+            'matrix_uuid': state.get('matrix_uuid'),
+            'cohort_size': len(state['scores']) if state else 0,
+        }
+
+
+def _refresh_periodically(service, interval_seconds):
+    while True:
+        time.sleep(interval_seconds)
+        try:
+            service.refresh()
+        except Exception:
+            logging.exception('Refreshing the scores failed, keeping the previous ones')
+
+
+class ScoringRequestHandler(BaseHTTPRequestHandler):
+    """ GET /score?entity_id=..&client_hash=.., POST /score {"entity_ids": [..], "client_hashes": [..]} and GET /health """
+
+    service = None
+
+    def _respond(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _score(self, entity_ids, client_hashes):
+        if not entity_ids and not client_hashes:
+            return self._respond(400, {'error': 'No entity_id or client_hash to score'})
+        try:
+            self._respond(200, self.service.score(entity_ids, client_hashes))
+        except ValueError as e:
+            self._respond(400, {'error': str(e)})
+        except Exception as e:
+            logging.exception('Scoring failed')
+            self._respond(500, {'error': str(e)})
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/health':
+            return self._respond(200, self.service.health())
+        if url.path != '/score':
+            return self._respond(404, {'error': f'Unknown path {url.path}'})
+
+        params = parse_qs(url.query)
+        self._score(params.get('entity_id', []), params.get('client_hash', []))
+
+    def do_POST(self):
+        if urlparse(self.path).path != '/score':
+            return self._respond(404, {'error': f'Unknown path {self.path}'})
+
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or '{}')
+        except json.JSONDecodeError as e:
+            return self._respond(400, {'error': f'Invalid JSON: {e}'})
+
+        self._score(body.get('entity_ids', []), body.get('client_hashes', []))
+
+    def log_message(self, format, *args):
+        logging.info(f'{self.address_string()} {format % args}')
+
+
+def serve(model_id, host='127.0.0.1', port=8765, project_path=PROJECT_PATH, refresh_minutes=30, max_staleness_days=14):
+    """ Load the model, build today's scores and serve them until interrupted """
+    service = ScoringService(get_db_engine(), model_id, project_path, max_staleness_days)
+    service.refresh(wait=True)
+
+    if refresh_minutes:
+        threading.Thread(target=_refresh_periodically, args=(service, refresh_minutes * 60), daemon=True).start()
+
+    ScoringRequestHandler.service = service
+    server = ThreadingHTTPServer((host, port), ScoringRequestHandler)
+    logging.info(f'Scoring with model {model_id} on http://{host}:{port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Serve the scores of the production model as of today")
+
+    parser.add_argument(
+        "-m",
+        "--model_id",
+        type=int,
+        help='triage model id of the production model',
+        required=True
+    )
+
+    parser.add_argument(
+        "--host",
+        type=str,
+        default='127.0.0.1',
+        help='Address to listen on (local only by default)'
+    )
+
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=8765,
+        help='Port to listen on'
+    )
+
+    parser.add_argument(
+        "--refresh-minutes",
+        type=int,
+        default=30,
+        help='How often to check the upstream tables for new rows and rebuild the scores (0 to only rebuild on a new day)'
+    )
+
+    parser.add_argument(
+        "--max-staleness-days",
+        type=int,
+        default=14,
+        help='Fail if an upstream table has no rows in this many days before today'
+    )
+
+    parser.add_argument(
+        "--project-path",
+        type=str,
+        default=PROJECT_PATH,
+        help='Where the models and matrices are stored'
+    )
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    serve(args.model_id, args.host, args.port, args.project_path, args.refresh_minutes, args.max_staleness_days)
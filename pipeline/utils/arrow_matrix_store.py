@@ -0,0 +1,215 @@
+"""
+A triage matrix store that reads the matrices from float32 Arrow (feather) files through a memory map.
+
+triage's MatrixBuilder only writes gzipped CSVs, so the CSV stays the matrix of record (triage uses
+it to decide whether a matrix exists). The first time a matrix is loaded, a `<uuid>.feather` sibling
+is written next to it, and every later load memory-maps that file instead of parsing the CSV.
+
+Uncompressed feather files are read without copying the numeric columns: the worker processes that
+load the same matrix share one copy of it in the page cache. triage's preprocessing of a loaded matrix
+casts (so copies) every column to float32, here only the columns that are not float32 yet are cast.
+lz4/zstd compressed files are smaller on disk but have to be decompressed in each process.
+
+Matrices of earlier experiments can be converted ahead of time:
+
+    python -m pipeline.utils.arrow_matrix_store --matrices-dir <PROJECT_PATH>/matrices
+"""
+import argparse
+import glob
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+from triage.component.catwalk.storage import CSVMatrixStore, FSStore, ProjectStorage
+
+from pipeline.utils.project_constants import PROJECT_PATH
+
+
+FEATHER_SUFFIX = 'feather'
+
+
+def write_feather_matrix(df, path, compression='uncompressed'):
+    """ Write a matrix (indexed by entity_id and as_of_date) as a feather file
+
+        CSVMatrixStore already loads the features as float32, so they are written as they are.
+        Every column is written in a single chunk: pyarrow has to concatenate (copy) the chunks of a column to read it into pandas.
+        The file is written to a temporary path and renamed, so that concurrent readers never see a partial file.
+    """
+    table = pa.Table.from_pandas(df.reset_index(), preserve_index=False).combine_chunks()
+
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    feather.write_feather(table, tmp_path, compression=compression, chunksize=max(table.num_rows, 1))
+    os.replace(tmp_path, path)
+
+
+class ArrowMatrixStore(CSVMatrixStore):
+    """ CSVMatrixStore that loads the matrix from a memory-mapped feather sibling of the CSV """
+
+    compression = 'uncompressed'
+    converted_suffix = FEATHER_SUFFIX
+
+    @property
+    def feather_path(self):
+        """ The path of the feather sibling, None if the project is not on the local file system """
+        if not isinstance(self.matrix_base_store, FSStore):
+            return None
+        return str(self.matrix_base_store.path)[:-len(self.suffix)] + self.converted_suffix
+
+    def _feather_is_fresh(self):
+        """ Whether the feather file exists and was written after the CSV (which is rewritten when a matrix is replaced) """
+        path = self.feather_path
+        if path is None or not os.path.exists(path):
+            return False
+        return os.path.getmtime(path) >= os.path.getmtime(self.matrix_base_store.path)
+
+    def _read_feather(self, n_rows=None):
+        table = feather.read_table(self.feather_path, memory_map=True)
+        if table.num_columns and table.column(0).num_chunks > 1:
+            logging.warning(
+                f'{self.feather_path} was written in {table.column(0).num_chunks} chunks and is copied when loaded, '
+                'rewrite it (python -m pipeline.utils.arrow_matrix_store --replace) to share it between processes'
+            )
+        if n_rows is not None:
+            table = table.slice(0, n_rows)
+
+        # one block per column lets pandas use the memory-mapped buffers without copying them
+        df = table.to_pandas(split_blocks=True)
+        df['as_of_date'] = df.as_of_date.astype('datetime64[ns]')
+        df.set_index(self.indices, inplace=True)
+        return df
+
+    def converted_paths(self):
+        return [self.feather_path]
+
+    def _read_converted(self, n_rows=None):
+        return self._read_feather(n_rows)
+
+    def _write_converted(self, df, compression):
+        write_feather_matrix(df, self.feather_path, compression=compression)
+
+    @property
+    def head_of_matrix(self):
+        if self._feather_is_fresh():
+            return self._read_converted(n_rows=1)
+        return super().head_of_matrix
+
+    def _preprocess_and_split_matrix(self, matrix_with_labels):
+        """ triage's preprocessing (index, date check, float32 columns, label split) without copying the float32
+            columns: triage's downcast_matrix casts every column, and the copies of the memory-mapped columns
+            would not be shared by the processes anymore
+        """
+        if matrix_with_labels.index.names != self.indices:
+            matrix_with_labels.set_index(self.indices, inplace=True)
+        index_of_date = matrix_with_labels.index.names.index('as_of_date')
+        if matrix_with_labels.index.levels[index_of_date].dtype != 'datetime64[ns]':
+            raise ValueError(f'The as_of_date of matrix {self.matrix_uuid} is {matrix_with_labels.index.levels[index_of_date].dtype}')
+
+        for column, dtype in matrix_with_labels.dtypes.items():
+            if isinstance(dtype, pd.SparseDtype):
+                if dtype.subtype != np.float32:
+                    matrix_with_labels[column] = matrix_with_labels[column].astype(pd.SparseDtype(np.float32, 0))
+            elif dtype != np.float32:
+                matrix_with_labels[column] = matrix_with_labels[column].astype(np.float32)
+
+        labels = matrix_with_labels.pop(self.label_column_name)
+
+        return matrix_with_labels, labels
+
+    def _load(self):
+        if self._feather_is_fresh():
+            logging.debug(f'Loading matrix {self.matrix_uuid} from {self.feather_path}')
+            return self._read_converted()
+
+        df = super()._load()
+
+        if self.feather_path is not None:
+            # this load uses the converted file as well, not the dense frame read from the CSV
+            logging.info(f'Writing {self.feather_path} and loading matrix {self.matrix_uuid} from it')
+            self._write_converted(df, self.compression)
+            del df
+            return self._read_converted()
+
+        return df
+
+
+def convert_matrices(matrices_dir, compression='uncompressed', replace=False, store_class=ArrowMatrixStore):
+    """ Write the feather sibling of every CSV matrix in a directory
+
+        Args:
+            matrices_dir (str): directory with the <uuid>.csv.gz and <uuid>.yaml files
+            compression (str): 'uncompressed' (can be memory-mapped), 'lz4' or 'zstd'
+            replace (bool): whether to rewrite the feather files that are already up to date
+            store_class (class): ArrowMatrixStore or a subclass of it (e.g., SparseArrowMatrixStore)
+
+        Returns:
+            (dict) total bytes of the converted CSVs and of the feather files
+    """
+    project_storage = ProjectStorage(os.path.dirname(os.path.normpath(matrices_dir)))
+    directory = os.path.basename(os.path.normpath(matrices_dir))
+
+    sizes = {'csv_bytes': 0, 'feather_bytes': 0}
+    for csv_path in sorted(glob.glob(os.path.join(matrices_dir, f'*.{CSVMatrixStore.suffix}'))):
+        matrix_uuid = os.path.basename(csv_path)[:-len(CSVMatrixStore.suffix) - 1]
+        store = store_class(project_storage, [directory], matrix_uuid)
+        if not store.metadata_base_store.exists():
+            logging.warning(f'No metadata for matrix {matrix_uuid}, skipping it')
+            continue
+
+        if replace or not store._feather_is_fresh():
+            logging.info(f'Converting matrix {matrix_uuid}')
+            store._write_converted(CSVMatrixStore._load(store), compression)
+
+        sizes['csv_bytes'] += os.path.getsize(csv_path)
+        sizes['feather_bytes'] += sum(os.path.getsize(path) for path in store.converted_paths())
+
+    logging.info(f"Matrices: {sizes['csv_bytes'] / 1e9:.2f} GB as csv.gz, {sizes['feather_bytes'] / 1e9:.2f} GB as feather ({compression})")
+
+    return sizes
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Convert the CSV matrices of a project to memory-mappable feather files")
+
+    parser.add_argument(
+        "--matrices-dir",
+        type=str,
+        default=os.path.join(PROJECT_PATH, 'matrices'),
+        help='Directory of the matrices (defaults to the project matrices)'
+    )
+
+    parser.add_argument(
+        "--compression",
+        type=str,
+        choices=['uncompressed', 'lz4', 'zstd'],
+        default='uncompressed',
+        help='Compression of the feather files. Only uncompressed files are shared between processes through the memory map'
+    )
+
+    parser.add_argument(
+        '--sparse',
+        dest='sparse_flag',
+        action='store_true',
+        help='Whether to store the mostly-zero columns as CSR (for run.py --sparse-matrices)'
+    )
+
+    parser.add_argument(
+        '--replace',
+        dest='replace_flag',
+        action='store_true',
+        help='Whether to rewrite feather files that are already up to date'
+    )
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    store_class = ArrowMatrixStore
+    if args.sparse_flag:
+        from pipeline.utils.sparse_matrices import SparseArrowMatrixStore
+        store_class = SparseArrowMatrixStore
+
+    convert_matrices(args.matrices_dir, compression=args.compression, replace=args.replace_flag, store_class=store_class)
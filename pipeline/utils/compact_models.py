@@ -0,0 +1,252 @@
+"""
+A compact file format for the compiled tree ensembles (see tree_inference.py).
+
+A pickled 10,000 tree RandomForest at max_depth 50 stores every Tree object with its node structs, class
+counts and Python state, and unpickling it rebuilds every one of them. The compact format is a compressed
+npz file with the packed arrays of the forest (feature, threshold, children and positive probability of
+every node) and, for wrapped models, the pickled wrapper without its estimator (a few KB). Loading it reads
+the small metadata only; the arrays are decompressed the first time the model scores.
+
+The loaded model has the predict_proba (and predict, classes_) of the original, so triage's Predictor uses
+it as it is. The compiled models of predict_forward are stored in this format, in compiled_models/<model_hash>.
+
+Existing models of the project are converted (compiled, checked against their test matrix and stored if they
+are as accurate and faster), with the size and load time of both formats, by:
+
+    python -m pipeline.utils.compact_models --all
+    python -m pipeline.utils.compact_models -m <model_id> [<model_id> ...]
+"""
+import argparse
+import io
+import json
+import logging
+import os
+import pickle
+import time
+
+import numpy as np
+import pandas as pd
+from triage.component.catwalk.storage import FSStore, ModelStorageEngine, ProjectStorage
+from triage.component.catwalk.utils import retrieve_model_hash_from_id
+
+from pipeline.utils.project_constants import PROJECT_PATH
+from pipeline.utils.tree_inference import PackedForest, COMPILED_MODEL_DIRECTORY, DEFAULT_TOLERANCE, compile_and_store, compiled_model_storage_engine
+from pipeline.utils.utils import get_db_engine
+from pipeline.utils.wrapped_estimators import WrappedClassifier
+
+
+FORMAT_VERSION = 1
+
+
+class LazyPackedForest(PackedForest):
+    """ A PackedForest whose arrays are read from its npz file the first time they are used """
+
+    _array_names = ('feature', 'threshold', 'left', 'right', 'value', 'tree_roots', 'missing_go_to_left')
+
+    def __init__(self, source, classes, n_features_in):
+        self._source = source
+        self._arrays = None
+        self.classes_ = classes
+        self.n_features_in_ = n_features_in
+
+    def __getattr__(self, name):
+        # only called for the attributes that are not set, i.e. the arrays before they are loaded
+        if name not in self._array_names:
+            raise AttributeError(name)
+
+        if self._arrays is None:
+            start = time.perf_counter()
+            if hasattr(self._source, 'seek'):
+                self._source.seek(0)
+            with np.load(self._source) as npz:
+                self._arrays = {key: npz[key] for key in npz.files if key in self._array_names}
+            logging.debug(f'Loaded the packed arrays in {time.perf_counter() - start:.2f} seconds')
+
+        return self._arrays.get(name)
+
+
+def save_compact_model(model, fd):
+    """ Write a compiled model (a PackedForest, or a wrapped model around one) to a file object in the compact format """
+    forest = model.estimator_ if isinstance(model, WrappedClassifier) else model
+    if not isinstance(forest, PackedForest):
+        raise ValueError(f'Only compiled tree ensembles can be saved in the compact format, not {type(forest).__name__}')
+
+    metadata = {
+        'format_version': FORMAT_VERSION,
+        'n_features_in': int(forest.n_features_in_),
+        'n_trees': int(forest.n_trees),
+        'n_nodes': int(forest.n_nodes),
+    }
+
+    arrays = dict(forest.arrays)
+    arrays['metadata'] = np.frombuffer(json.dumps(metadata).encode(), dtype=np.uint8)
+    if isinstance(model, WrappedClassifier):
+        wrapper = pickle.dumps(_without_estimator(model))
+        arrays['wrapper'] = np.frombuffer(wrapper, dtype=np.uint8)
+
+    np.savez_compressed(fd, **arrays)
+
+
+def _without_estimator(model):
+    wrapper = model.__class__.__new__(model.__class__)
+    wrapper.__dict__.update({key: value for key, value in model.__dict__.items() if key != 'estimator_'})
+    return wrapper
+
+
+def load_compact_model(source):
+    """ Load a model saved by save_compact_model
+
+        Args:
+            source: a path (the arrays are read lazily from it) or a file object (read in memory)
+
+        Returns:
+            a PackedForest, or the wrapped model around it
+    """
+    if not isinstance(source, (str, os.PathLike)):
+        source = io.BytesIO(source.read())
+
+    with np.load(source) as npz:
+        metadata = json.loads(npz['metadata'].tobytes())
+        classes = npz['classes']
+        wrapper = pickle.loads(npz['wrapper'].tobytes()) if 'wrapper' in npz.files else None
+
+    if metadata['format_version'] != FORMAT_VERSION:
+        raise ValueError(f"Unknown compact model format version {metadata['format_version']}")
+
+    forest = LazyPackedForest(source, classes, metadata['n_features_in'])
+    if wrapper is None:
+        return forest
+
+    wrapper.estimator_ = forest
+    return wrapper
+
+
+class CompactModelStorageEngine(ModelStorageEngine):
+    """ triage ModelStorageEngine for the compiled models, in the compact format """
+
+    def write(self, obj, model_hash):
+        with self._get_store(model_hash).open('wb') as fd:
+            save_compact_model(obj, fd)
+
+    def load(self, model_hash):
+        store = self._get_store(model_hash)
+        if isinstance(store, FSStore):
+            return load_compact_model(str(store.path))
+
+        with store.open('rb') as fd:
+            return load_compact_model(fd)
+
+
+def _file_size(project_storage, directory, model_hash):
+    store = project_storage.get_store([directory], model_hash)
+    if isinstance(store, FSStore):
+        return os.path.getsize(store.path)
+
+    with store.open('rb') as fd:
+        return len(fd.read())
+
+
+def compare_formats(project_storage, model_hash):
+    """ The size and load time of the pickled model and of its compact form
+
+        The compact load time includes reading the arrays (scoring one row), since they are loaded lazily.
+    """
+    original_storage = project_storage.model_storage_engine()
+    start = time.perf_counter()
+    model = original_storage.load(model_hash)
+    original_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    compact = compiled_model_storage_engine(project_storage).load(model_hash)
+    compact.predict_proba(np.zeros((1, compact.n_features_in_ if isinstance(compact, PackedForest) else compact.n_input_columns_)))
+    compact_seconds = time.perf_counter() - start
+
+    return {
+        'model_hash': model_hash,
+        'model_type': type(model).__name__,
+        'pickle_mb': _file_size(project_storage, 'trained_models', model_hash) / 1024 ** 2,
+        'compact_mb': _file_size(project_storage, COMPILED_MODEL_DIRECTORY, model_hash) / 1024 ** 2,
+        'pickle_load_seconds': original_seconds,
+        'compact_load_seconds': compact_seconds,
+    }
+
+
+def _model_ids_in_project(db_engine, project_path):
+    """ The ids of the models of triage_metadata that have a pickle in the project's trained_models
+
+        The project path can be on s3, so every model is checked through the project's model storage
+        instead of listing the directory.
+    """
+    model_storage = ProjectStorage(project_path).model_storage_engine()
+    models = pd.read_sql('select model_id, model_hash from triage_metadata.models where model_hash is not null order by model_id', db_engine)
+
+    return [int(model.model_id) for model in models.itertuples(index=False) if model_storage.exists(model.model_hash)]
+
+
+def convert_models(db_engine, model_ids, project_path=PROJECT_PATH, tolerance=DEFAULT_TOLERANCE):
+    """ Compile the tree ensembles among the models, store them in the compact format and compare the formats
+
+        Returns:
+            pd.DataFrame with the size and load time of both formats for every converted model
+    """
+    project_storage = ProjectStorage(project_path)
+    comparisons = list()
+    for model_id in model_ids:
+        check = compile_and_store(db_engine, model_id, project_path, tolerance)
+        if check is None or not check['stored']:
+            continue
+
+        comparison = compare_formats(project_storage, retrieve_model_hash_from_id(db_engine, model_id))
+        comparison.update({'model_id': model_id, 'max_score_difference': check['max_difference']})
+        comparisons.append(comparison)
+
+        logging.info(
+            f"Model {model_id}: {comparison['pickle_mb']:.1f} MB pickle loaded in {comparison['pickle_load_seconds']:.1f}s, "
+            f"{comparison['compact_mb']:.1f} MB compact loaded in {comparison['compact_load_seconds']:.1f}s"
+        )
+
+    return pd.DataFrame(comparisons)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Convert the tree ensembles of the project to the compact model format")
+
+    parser.add_argument(
+        "-m",
+        "--model-ids",
+        type=int,
+        nargs='+',
+        help='triage model ids to convert'
+    )
+
+    parser.add_argument(
+        "--all",
+        action='store_true',
+        help='Convert every model in the trained_models of the project path'
+    )
+
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=DEFAULT_TOLERANCE,
+        help='Maximum absolute difference with the original scores on the test matrix'
+    )
+
+    parser.add_argument(
+        "--project-path",
+        type=str,
+        default=PROJECT_PATH,
+        help='Where the models and matrices are stored'
+    )
+
+    args = parser.parse_args()
+
+    if not args.all and not args.model_ids:
+        parser.error('Either --all or -m is required')
+
+    db_engine = get_db_engine()
+    model_ids = _model_ids_in_project(db_engine, args.project_path) if args.all else args.model_ids
+
+    with pd.option_context('display.width', 200):
+        print(convert_models(db_engine, model_ids, args.project_path, args.tolerance))
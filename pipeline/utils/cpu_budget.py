@@ -0,0 +1,194 @@
+"""
+Planning the CPU budget of an experiment so that parallel triage processes and multi-threaded
+estimators don't fight for the same cores.
+
+triage runs the heavyweight classifiers (random forests, boosted trees) in a separate batch with
+`n_bigtrain_processes` workers and everything else with `n_processes` workers. Each estimator's
+thread count should be the number of cores divided by the number of processes it shares the box with.
+"""
+import copy
+import logging
+import os
+
+from sklearn.model_selection import ParameterGrid
+
+
+# Estimators whose thread count is controlled by a hyperparameter.
+# The value is the thread count the estimator uses when the parameter is not set
+THREADED_ESTIMATORS = {
+    'sklearn.ensemble.RandomForestClassifier': 1,
+    'sklearn.ensemble.ExtraTreesClassifier': 1,
+    'imblearn.ensemble.BalancedRandomForestClassifier': 1,
+    'lightgbm.LGBMClassifier': -1,
+    'xgboost.XGBClassifier': -1,
+    'pipeline.utils.warm_start.WarmStartLGBMClassifier': -1,
+    'pipeline.utils.warm_start.WarmStartXGBClassifier': -1,
+    'pipeline.utils.wrapped_estimators.WrappedRandomForestClassifier': 1,
+    'pipeline.utils.wrapped_estimators.WrappedExtraTreesClassifier': 1,
+    'pipeline.utils.wrapped_estimators.WrappedLGBMClassifier': -1,
+    'pipeline.utils.wrapped_estimators.WrappedXGBClassifier': -1,
+}
+
+# Aliases of n_jobs. They override n_jobs in the estimator, so the CPU plan replaces them with n_jobs
+THREAD_PARAMETER_ALIASES = {
+    'xgboost.XGBClassifier': ['nthread'],
+    'lightgbm.LGBMClassifier': ['num_threads', 'nthread'],
+    'pipeline.utils.warm_start.WarmStartXGBClassifier': ['nthread'],
+    'pipeline.utils.warm_start.WarmStartLGBMClassifier': ['num_threads', 'nthread'],
+    'pipeline.utils.wrapped_estimators.WrappedXGBClassifier': ['nthread'],
+    'pipeline.utils.wrapped_estimators.WrappedLGBMClassifier': ['num_threads', 'nthread'],
+}
+
+# Mirrors the classifiers triage trains in its "bigtrain" batch
+TRIAGE_BIGTRAIN_ESTIMATORS = (
+    'imblearn.ensemble.BalancedRandomForestClassifier',
+    'sklearn.ensemble.RandomForestClassifier',
+    'sklearn.ensemble.ExtraTreesClassifier',
+    'sklearn.ensemble.AdaBoostClassifier',
+    'sklearn.ensemble.GradientBoostingClassifier',
+    'xgboost.XGBClassifier',
+    'lightgbm.LGBMClassifier',
+)
+
+# The project's subclasses and wrappers of those classifiers. triage only knows its own list, so the
+# experiment is built with these as additional_bigtrain_classnames (see bigtrain_classnames)
+PROJECT_BIGTRAIN_ESTIMATORS = (
+    'pipeline.utils.warm_start.WarmStartLGBMClassifier',
+    'pipeline.utils.warm_start.WarmStartXGBClassifier',
+    'pipeline.utils.wrapped_estimators.WrappedRandomForestClassifier',
+    'pipeline.utils.wrapped_estimators.WrappedExtraTreesClassifier',
+    'pipeline.utils.wrapped_estimators.WrappedLGBMClassifier',
+    'pipeline.utils.wrapped_estimators.WrappedXGBClassifier',
+)
+
+BIGTRAIN_ESTIMATORS = TRIAGE_BIGTRAIN_ESTIMATORS + PROJECT_BIGTRAIN_ESTIMATORS
+
+
+def available_cores():
+    """Number of cores this process is allowed to run on"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def _threads_from_parameters(class_path, parameters, n_cores):
+    """The number of threads an estimator would start with the given hyperparameters"""
+    if class_path not in THREADED_ESTIMATORS:
+        return 1
+
+    n_threads = parameters.get('n_jobs')
+    for alias in THREAD_PARAMETER_ALIASES.get(class_path, []):
+        if parameters.get(alias) is not None:
+            n_threads = parameters[alias]
+
+    if n_threads is None:
+        n_threads = THREADED_ESTIMATORS[class_path]
+
+    # negative values follow the joblib convention (-1 is all cores, -2 all but one, ...)
+    if n_threads < 0:
+        n_threads = max(1, n_cores + 1 + n_threads)
+
+    return n_threads
+
+
+def bigtrain_classnames(grid_config):
+    """ The class paths of the grid that triage should train in its bigtrain batch but doesn't know of,
+        to pass to the experiment as additional_bigtrain_classnames
+    """
+    return [class_path for class_path in grid_config if class_path in PROJECT_BIGTRAIN_ESTIMATORS]
+
+
+def plan_cpu_budget(grid_config, n_processes, n_bigtrain_processes=1, n_cores=None):
+    """ Assign thread counts to the estimators in the grid given the number of triage processes
+
+        Args:
+            grid_config (dict): the experiment's grid_config
+            n_processes (int): number of processes triage uses for most tasks (run.py --njobs)
+            n_bigtrain_processes (int): number of processes triage uses for the heavyweight classifiers
+            n_cores (int, optional): number of cores to plan for. Defaults to the cores available to this process
+
+        Returns:
+            (dict) the plan, with the keys n_cores, n_processes, n_bigtrain_processes, and threads (classpath -> n_jobs)
+    """
+    n_cores = n_cores or available_cores()
+
+    if n_processes > n_cores:
+        logging.warning(f'{n_processes} processes requested on a machine with {n_cores} cores, capping to {n_cores}')
+        n_processes = n_cores
+
+    n_bigtrain_processes = max(1, min(n_bigtrain_processes, n_processes))
+
+    threads = dict()
+    for class_path in grid_config:
+        if class_path not in THREADED_ESTIMATORS:
+            continue
+
+        sharing_processes = n_bigtrain_processes if class_path in BIGTRAIN_ESTIMATORS else n_processes
+        threads[class_path] = max(1, n_cores // sharing_processes)
+
+    return {
+        'n_cores': n_cores,
+        'n_processes': n_processes,
+        'n_bigtrain_processes': n_bigtrain_processes,
+        'threads': threads
+    }
+
+
+def apply_cpu_plan(grid_config, cpu_plan):
+    """ Return a copy of the grid with the planned thread counts set as n_jobs
+
+        n_jobs is not part of triage's model group or model hash, so this doesn't create new model groups.
+        Aliases such as xgboost's nthread would override n_jobs, so they are dropped from the entries that set
+        one. They are part of the model group, so those entries get the model groups of the grid without them.
+    """
+    grid_config = copy.deepcopy(grid_config)
+
+    for class_path, n_threads in cpu_plan['threads'].items():
+        parameters = grid_config[class_path]
+        aliases = [alias for alias in THREAD_PARAMETER_ALIASES.get(class_path, []) if alias in parameters]
+        if aliases:
+            logging.warning(
+                f'Replacing {", ".join(f"{a}={parameters[a]}" for a in aliases)} of {class_path} with n_jobs={n_threads} '
+                f'(the model groups of its entries change)'
+            )
+            for alias in aliases:
+                del parameters[alias]
+        parameters['n_jobs'] = [n_threads]
+
+    return grid_config
+
+
+def log_cpu_plan(cpu_plan):
+    logging.info(
+        f"CPU plan: {cpu_plan['n_cores']} cores, {cpu_plan['n_processes']} processes, "
+        f"{cpu_plan['n_bigtrain_processes']} bigtrain processes"
+    )
+    for class_path, n_threads in cpu_plan['threads'].items():
+        logging.info(f'CPU plan: {class_path} n_jobs={n_threads}')
+
+
+def check_cpu_oversubscription(grid_config, n_processes, n_bigtrain_processes=1, n_cores=None):
+    """ Warn about grid entries that would start more threads than there are cores
+
+        Returns:
+            (list) of warning messages, empty if the config fits on the machine
+    """
+    n_cores = n_cores or available_cores()
+    messages = list()
+
+    for class_path, parameter_config in grid_config.items():
+        sharing_processes = n_bigtrain_processes if class_path in BIGTRAIN_ESTIMATORS else n_processes
+        for parameters in ParameterGrid(parameter_config):
+            n_threads = _threads_from_parameters(class_path, parameters, n_cores)
+            if n_threads * sharing_processes > n_cores:
+                messages.append(
+                    f'{class_path}({parameters}) runs {n_threads} threads in each of {sharing_processes} processes, '
+                    f'{n_threads * sharing_processes} threads on {n_cores} cores'
+                )
+                break
+
+    for message in messages:
+        logging.warning(f'CPU oversubscription: {message}')
+
+    return messages
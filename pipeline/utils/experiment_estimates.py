@@ -0,0 +1,347 @@
+"""
+Dry run of an experiment config: count the work it implies and estimate its wall time and disk use
+from the timings of previous runs, without touching the feature, matrix or model tables.
+
+The feature and matrix phases are estimated from triage's run tracking tables. The models are estimated
+per grid entry from the model fits, predictions and evaluations of the performance ledger, per class path
+and scaled by the number of trees and their depth.
+"""
+import json
+import logging
+import os
+
+import pandas as pd
+from sklearn.model_selection import ParameterGrid
+
+from triage.component.timechop.timechop import Timechop
+
+from pipeline.utils.project_constants import EXPERIMENT_METADATA_SCHEMA
+from pipeline.utils.warm_start import WARM_START_CLASSES
+from pipeline.utils.wrapped_estimators import WRAPPED_CLASSES
+
+
+# The size of a model (number of trees x depth) when its hyperparameters don't bound it
+DEFAULT_N_ESTIMATORS = 100
+UNBOUNDED_DEPTH = 20
+
+
+def chop_splits(temporal_config, n_timesplits=None):
+    """ The time splits of the experiment, exactly as triage would build them """
+    splits = Timechop(**temporal_config).chop_time()
+    if n_timesplits is not None:
+        splits = splits[-n_timesplits:]
+    return splits
+
+
+def experiment_as_of_dates(temporal_config, n_timesplits=None):
+    """ The as_of_dates the experiment builds features for ('YYYY-MM-DD', sorted) """
+    as_of_dates = set()
+    for split in chop_splits(temporal_config, n_timesplits):
+        as_of_dates.update(split['train_matrix']['as_of_times'])
+        for test_matrix in split['test_matrices']:
+            as_of_dates.update(test_matrix['as_of_times'])
+    return sorted(as_of_date.strftime('%Y-%m-%d') for as_of_date in as_of_dates)
+
+
+def _feature_columns_per_interval(feature_aggregation):
+    """ Number of feature columns a feature group generates for one interval (excluding imputation flags) """
+    n_columns = 0
+
+    for aggregate in feature_aggregation.get('aggregates', []):
+        quantity = aggregate['quantity']
+        n_quantities = len(quantity) if isinstance(quantity, dict) else 1
+        n_columns += n_quantities * len(aggregate.get('metrics', []))
+
+    for categorical in feature_aggregation.get('categoricals', []):
+        choices = categorical.get('choices')
+        if choices is None:
+            logging.warning(f"Categorical {categorical['column']} of {feature_aggregation['prefix']} uses a choice_query, its columns are not counted")
+            continue
+        n_columns += (len(choices) + 1) * len(categorical.get('metrics', []))
+
+    return n_columns
+
+
+def count_experiment_work(config, n_timesplits=None):
+    """ Count the work an experiment config implies
+
+        Args:
+            config (dict): the experiment config (with feature_aggregations filled in)
+            n_timesplits (int, optional): only count the last n time splits (run.py --splits)
+
+        Returns:
+            (dict) with the counts of splits, as_of_dates, feature groups, feature blocks and columns,
+            matrices (and the as_of_dates they span), train/test tasks, and model fits (total and per grid entry)
+    """
+    splits = chop_splits(config['temporal_config'], n_timesplits)
+
+    train_matrices = set()
+    test_matrices = set()
+    as_of_dates = set()
+    n_test_tasks = 0
+    for split in splits:
+        train_times = tuple(split['train_matrix']['as_of_times'])
+        train_matrices.add(train_times)
+        as_of_dates.update(train_times)
+        for test_matrix in split['test_matrices']:
+            test_times = tuple(test_matrix['as_of_times'])
+            test_matrices.add(test_times)
+            as_of_dates.update(test_times)
+            n_test_tasks += 1
+
+    feature_aggregations = config.get('feature_aggregations', [])
+    feature_columns = dict()
+    for feature_aggregation in feature_aggregations:
+        n_intervals = len(feature_aggregation.get('intervals', ['all']))
+        feature_columns[feature_aggregation['prefix']] = n_intervals * _feature_columns_per_interval(feature_aggregation)
+
+    n_label_timespans = len(config['temporal_config'].get('training_label_timespans', [None]))
+
+    parameter_sets = dict()
+    for class_path, parameter_config in config.get('grid_config', {}).items():
+        parameter_sets[class_path] = len(ParameterGrid(parameter_config))
+
+    return {
+        'splits': len(splits),
+        'as_of_dates': len(as_of_dates),
+        'feature_groups': len(feature_aggregations),
+        'feature_blocks': len(feature_aggregations) * len(as_of_dates),
+        'feature_columns': sum(feature_columns.values()),
+        'feature_columns_per_group': feature_columns,
+        'matrices': (len(train_matrices) + len(test_matrices)) * n_label_timespans,
+        'matrix_as_of_dates': sum(len(times) for times in train_matrices | test_matrices) * n_label_timespans,
+        'train_test_tasks': sum(parameter_sets.values()) * n_test_tasks,
+        'model_fits': sum(parameter_sets.values()) * len(splits),
+        'model_fits_per_grid_entry': {class_path: n * len(splits) for class_path, n in parameter_sets.items()},
+    }
+
+
+def get_historical_phase_rates(db_engine, n_runs=10):
+    """ Per-unit timings of the last completed experiment runs, from triage's run tracking tables
+
+        The feature phase is timed per (feature group x as_of_date), the matrix phase per matrix and
+        the model phase per fitted model (with its testing). The timings are multiplied by the number of processes of the run
+        to get the single-process time of a unit of work.
+
+        Returns:
+            pd.DataFrame with one row per run
+    """
+
+    q = f"""
+        select
+            r.id as run_id,
+            r.start_time,
+            coalesce((r.experiment_kwargs ->> 'n_processes')::int, 1) as n_processes,
+            coalesce((r.experiment_kwargs ->> 'n_db_processes')::int, 1) as n_db_processes,
+            extract(epoch from r.matrix_building_started - r.start_time) / nullif(e.feature_blocks * e.as_of_times, 0) as secs_per_feature_block,
+            extract(epoch from r.model_building_started - r.matrix_building_started) / nullif(r.matrices_made, 0) as secs_per_matrix,
+            extract(epoch from r.last_updated_time - r.model_building_started) / nullif(r.models_made, 0) as secs_per_model
+        from triage_metadata.triage_runs r
+            join triage_metadata.experiments e on r.run_hash = e.experiment_hash
+        where r.run_type = 'experiment'
+        and r.current_status = 'completed'
+        and r.model_building_started is not null
+        order by r.start_time desc
+        limit {n_runs}
+    """
+
+    rates = pd.read_sql(q, db_engine)
+    rates['secs_per_feature_block'] = rates.secs_per_feature_block * rates.n_db_processes
+    rates['secs_per_matrix'] = rates.secs_per_matrix * rates.n_processes
+    rates['secs_per_model'] = rates.secs_per_model * rates.n_processes
+
+    return rates
+
+
+def estimator_class_path(class_path):
+    """ The class path of the estimator a wrapped or warm-started grid entry trains (the class path itself otherwise) """
+    for wrappers in (WRAPPED_CLASSES, WARM_START_CLASSES):
+        for estimator, wrapper in wrappers.items():
+            if wrapper == class_path:
+                return estimator
+    return class_path
+
+
+def model_size(parameters):
+    """ Number of trees x their depth, what the fit (and prediction) time of a model grows with
+
+        Models that are not ensembles count as DEFAULT_N_ESTIMATORS trees: only the ratio between two
+        models of the same class path is used.
+    """
+    n_estimators = parameters.get('n_estimators') or DEFAULT_N_ESTIMATORS
+    max_depth = parameters.get('max_depth')
+    if max_depth is None or max_depth <= 0:
+        max_depth = UNBOUNDED_DEPTH
+    return n_estimators * max_depth
+
+
+def get_historical_model_rates(db_engine, n_models=1000):
+    """ Seconds per unit of model size (see model_size) of the last models in the performance ledger, per estimator
+
+        A model's seconds are its fit (and storing) plus its predictions and evaluations, like the model phase of a run.
+        The models of wrapped and warm-started grid entries count for the estimator they wrap.
+
+        Returns:
+            (dict) estimator class path -> median seconds per unit of model size
+    """
+    if not pd.read_sql(f"select to_regclass('{EXPERIMENT_METADATA_SCHEMA}.phase_timings') is not null", db_engine).iloc[0, 0]:
+        return dict()
+
+    q = f"""
+        with fits as (
+            select model_id, detail as class_path, wall_seconds
+            from {EXPERIMENT_METADATA_SCHEMA}.phase_timings
+            where phase = 'model_fit' and model_id is not null
+            order by recorded_at desc
+            limit {n_models}
+        ), tests as (
+            select model_id, sum(wall_seconds) as wall_seconds
+            from {EXPERIMENT_METADATA_SCHEMA}.phase_timings
+            where phase in ('prediction', 'evaluation') and model_id in (select model_id from fits)
+            group by model_id
+        )
+        select fits.class_path, m.hyperparameters::text as hyperparameters, fits.wall_seconds + coalesce(tests.wall_seconds, 0) as seconds
+        from fits
+            join triage_metadata.models m using(model_id)
+            left join tests using(model_id)
+    """
+    models = pd.read_sql(q, db_engine)
+    if models.empty:
+        return dict()
+
+    models['estimator'] = models.class_path.apply(estimator_class_path)
+    models['seconds_per_size'] = models.seconds / models.hyperparameters.apply(lambda h: model_size(json.loads(h) if h else {}))
+
+    return models.groupby('estimator').seconds_per_size.median().to_dict()
+
+
+def get_historical_disk_use(db_engine, project_path, n_matrices=50):
+    """ Average on-disk size of the matrices (per row and feature) and of the models (per model type)
+
+        Only local project paths are inspected.
+
+        Returns:
+            (dict) bytes_per_matrix_cell, rows_per_as_of_date, and bytes_per_model (model_type -> bytes)
+    """
+    disk_use = {'bytes_per_matrix_cell': None, 'rows_per_as_of_date': None, 'bytes_per_model': dict()}
+
+    if not project_path or '://' in project_path:
+        logging.warning(f'Not estimating disk use for a non-local project path {project_path}')
+        return disk_use
+
+    q = f"""
+        select
+            matrix_uuid,
+            num_observations,
+            jsonb_array_length(matrix_metadata -> 'as_of_times') as n_as_of_dates,
+            jsonb_array_length(matrix_metadata -> 'feature_names') as n_features
+        from triage_metadata.matrices
+        where num_observations > 0
+        order by creation_time desc
+        limit {n_matrices}
+    """
+    matrices = pd.read_sql(q, db_engine)
+    matrices['path'] = matrices.matrix_uuid.apply(lambda uuid: os.path.join(project_path, 'matrices', f'{uuid}.csv.gz'))
+    matrices = matrices[matrices.path.apply(os.path.exists)]
+
+    if not matrices.empty:
+        matrices['size'] = matrices.path.apply(os.path.getsize)
+        disk_use['bytes_per_matrix_cell'] = matrices['size'].sum() / (matrices.num_observations * matrices.n_features).sum()
+        disk_use['rows_per_as_of_date'] = matrices.num_observations.sum() / matrices.n_as_of_dates.sum()
+
+    q = """
+        select distinct on (model_type) model_type, model_hash
+        from triage_metadata.models
+        order by model_type, run_time desc
+    """
+    models = pd.read_sql(q, db_engine)
+    for model_type, model_hash in zip(models.model_type, models.model_hash):
+        path = os.path.join(project_path, 'trained_models', model_hash)
+        if os.path.exists(path):
+            disk_use['bytes_per_model'][model_type] = os.path.getsize(path)
+
+    return disk_use
+
+
+def estimate_experiment_cost(config, db_engine, project_path, n_jobs=1, n_db_jobs=2, n_timesplits=None):
+    """ Count the work of an experiment config and estimate its wall time and disk use from previous runs
+
+        Args:
+            config (dict): the experiment config (with feature_aggregations filled in)
+            db_engine: SQLAlchemy engine
+            project_path (str): where the matrices and models of previous runs are stored
+            n_jobs (int): number of processes the experiment would use for matrices and models
+            n_db_jobs (int): number of processes the experiment would use for features
+            n_timesplits (int, optional): only count the last n time splits
+
+        Returns:
+            (dict) the work counts, plus the estimated hours per phase (and of the models of every grid entry)
+            and the estimated disk use in GB (None when there is no history)
+    """
+    estimate = count_experiment_work(config, n_timesplits)
+
+    rates = get_historical_phase_rates(db_engine)
+    if rates.empty:
+        logging.warning('No completed experiment runs to estimate the wall time from')
+        estimate['hours'] = None
+        estimate['model_hours_per_grid_entry'] = None
+    else:
+        estimate['model_hours_per_grid_entry'] = _model_hours_per_grid_entry(
+            config.get('grid_config', {}), estimate['splits'], get_historical_model_rates(db_engine), rates.secs_per_model.median(), n_jobs
+        )
+        estimate['hours'] = {
+            'features': rates.secs_per_feature_block.median() * estimate['feature_blocks'] / n_db_jobs / 3600,
+            'matrices': rates.secs_per_matrix.median() * estimate['matrices'] / n_jobs / 3600,
+            'models': sum(estimate['model_hours_per_grid_entry'].values()),
+        }
+        estimate['hours']['total'] = sum(estimate['hours'].values())
+
+    disk_use = get_historical_disk_use(db_engine, project_path)
+    estimate['disk_gb'] = None
+    if disk_use['bytes_per_matrix_cell'] is not None:
+        matrix_rows = disk_use['rows_per_as_of_date'] * estimate['matrix_as_of_dates']
+        model_bytes = sum(
+            disk_use['bytes_per_model'].get(class_path, disk_use['bytes_per_model'].get(estimator_class_path(class_path), 0)) * n_fits
+            for class_path, n_fits in estimate['model_fits_per_grid_entry'].items()
+        )
+        estimate['disk_gb'] = (matrix_rows * estimate['feature_columns'] * disk_use['bytes_per_matrix_cell'] + model_bytes) / 1e9
+
+    return estimate
+
+
+def _model_hours_per_grid_entry(grid_config, n_splits, model_rates, secs_per_model, n_jobs):
+    """ Hours of the model fits (with their testing) of every grid entry
+
+        Each parameter set is estimated from the ledger rate of its estimator scaled by its size, or from the
+        median seconds per model of the previous runs when the ledger has no model of that estimator.
+    """
+    hours = dict()
+    for class_path, parameter_config in grid_config.items():
+        rate = model_rates.get(estimator_class_path(class_path))
+        if rate is None:
+            logging.warning(f'No model of {class_path} in the performance ledger, its fits are estimated from the median of all models')
+            seconds = secs_per_model * len(ParameterGrid(parameter_config))
+        else:
+            seconds = sum(rate * model_size(parameters) for parameters in ParameterGrid(parameter_config))
+        hours[class_path] = seconds * n_splits / n_jobs / 3600
+
+    return hours
+
+
+def log_experiment_estimate(estimate):
+    logging.info('Experiment estimate:')
+    for key in ('splits', 'as_of_dates', 'feature_groups', 'feature_blocks', 'feature_columns', 'matrices', 'model_fits', 'train_test_tasks'):
+        logging.info(f'  {key}: {estimate[key]}')
+
+    for class_path, n_fits in estimate['model_fits_per_grid_entry'].items():
+        logging.info(f'  model fits of {class_path}: {n_fits}')
+
+    for class_path, hours in (estimate.get('model_hours_per_grid_entry') or {}).items():
+        logging.info(f'  estimated hours (models of {class_path}): {hours:.1f}')
+
+    if estimate.get('hours') is not None:
+        for phase, hours in estimate['hours'].items():
+            logging.info(f'  estimated hours ({phase}): {hours:.1f}')
+
+    if estimate.get('disk_gb') is not None:
+        logging.info(f"  estimated disk use: {estimate['disk_gb']:.1f} GB")
@@ -0,0 +1,218 @@
+"""
+Executing the experiment summary report notebook from python instead of shelling out to jupyter.
+
+The notebook is run with nbclient on a kernel that is kept alive between reports, and converted
+to the requested formats with the nbconvert exporters. The report can also be generated in a
+detached process, so that run.py returns as soon as the experiment is done.
+"""
+import argparse
+import atexit
+import logging
+import os
+import subprocess
+import sys
+from datetime import datetime
+
+import nbformat
+from jupyter_client.manager import KernelManager
+from nbclient import NotebookClient
+from nbconvert.exporters import get_exporter
+
+
+REPORT_TEMPLATE_PATH = 'notebooks/triage_reports/triage_summary_report_template.ipynb'
+REPORT_OUTPUT_DIR = 'notebooks/triage_reports'
+
+# Kernels kept alive between reports of the same process, by (kernel name, working directory)
+_KERNEL_MANAGERS = dict()
+
+
+def _shutdown_kernels():
+    for km in _KERNEL_MANAGERS.values():
+        if km.has_kernel:
+            km.shutdown_kernel(now=True)
+    _KERNEL_MANAGERS.clear()
+
+
+atexit.register(_shutdown_kernels)
+
+
+def get_cached_kernel(kernel_name, working_dir):
+    """ A started kernel for the notebook's kernel name and directory, reused across reports """
+    key = (kernel_name, os.path.abspath(working_dir))
+
+    km = _KERNEL_MANAGERS.get(key)
+    if km is None or not km.is_alive():
+        logging.info(f'Starting a {kernel_name} kernel in {working_dir} for the experiment reports')
+        km = KernelManager(kernel_name=kernel_name)
+        km.start_kernel(cwd=working_dir)
+        _KERNEL_MANAGERS[key] = km
+
+    return km
+
+
+def execute_notebook(nb, working_dir, timeout=1800, reuse_kernel=True):
+    """ Execute a notebook in place
+
+        Args:
+            nb (NotebookNode): the notebook
+            working_dir (str): directory the notebook's code runs in
+            timeout (int): seconds a single cell can run before the execution is stopped
+            reuse_kernel (bool): whether to run on the cached kernel (which keeps imports warm across reports)
+                instead of starting and stopping a kernel for this notebook
+
+        Returns:
+            (NotebookNode) the executed notebook
+    """
+    kernel_name = nb.metadata.get('kernelspec', {}).get('name', 'python3')
+
+    km = None
+    if reuse_kernel:
+        km = get_cached_kernel(kernel_name, working_dir)
+        # A cached kernel still holds the variables of the previous report
+        nb.cells.insert(0, nbformat.v4.new_code_cell("get_ipython().run_line_magic('reset', '-f')"))
+
+    client = NotebookClient(
+        nb,
+        km=km,
+        kernel_name=kernel_name,
+        timeout=timeout,
+        resources={'metadata': {'path': working_dir}},
+    )
+
+    try:
+        client.execute()
+    finally:
+        if reuse_kernel:
+            nb.cells.pop(0)
+
+    return nb
+
+
+def write_notebook(nb, output_base, output_formats=('notebook', 'html')):
+    """ Write the notebook in each of the formats (any nbconvert exporter name, e.g., 'notebook', 'html', 'pdf')
+
+        Returns:
+            (list) of the paths written
+    """
+    paths = list()
+    for output_format in output_formats:
+        exporter = get_exporter(output_format)()
+        body, _ = exporter.from_notebook_node(nb)
+
+        path = f'{output_base}{exporter.file_extension}'
+        mode = 'wb' if isinstance(body, bytes) else 'w'
+        with open(path, mode) as f:
+            f.write(body)
+
+        logging.info(f'Wrote the experiment report to {path}')
+        paths.append(path)
+
+    return paths
+
+
+def generate_experiment_report(template_path=REPORT_TEMPLATE_PATH, output_dir=REPORT_OUTPUT_DIR, output_formats=('notebook', 'html'), timeout=1800, reuse_kernel=True):
+    """ Execute the report template and save it in the requested formats
+
+        Args:
+            template_path (str): the report notebook template
+            output_dir (str): where the reports are written (triage_summary_report_<timestamp>.<ext>)
+            output_formats (tuple): nbconvert exporter names
+            timeout (int): seconds a single cell can run
+            reuse_kernel (bool): whether to run on a kernel cached by this process
+
+        Returns:
+            (list) of the paths written
+    """
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M')
+    output_base = os.path.join(output_dir, f'triage_summary_report_{timestamp}')
+
+    nb = nbformat.read(template_path, as_version=4)
+
+    logging.info(f'Executing the experiment report {template_path}')
+    try:
+        execute_notebook(nb, working_dir=output_dir, timeout=timeout, reuse_kernel=reuse_kernel)
+    except Exception as e:
+        # Still write what was executed, it shows where the report broke
+        logging.error(f'The experiment report failed: {e}')
+        write_notebook(nb, f'{output_base}_failed', ['notebook'])
+        raise
+
+    return write_notebook(nb, output_base, output_formats)
+
+
+def generate_experiment_report_in_background(template_path=REPORT_TEMPLATE_PATH, output_dir=REPORT_OUTPUT_DIR, output_formats=('notebook', 'html'), timeout=1800, log_path=None):
+    """ Generate the report in a detached process that the caller doesn't wait for
+
+        Args:
+            log_path (str, optional): file the report process logs to. Defaults to <output_dir>/triage_summary_report.log
+
+        Returns:
+            (subprocess.Popen) the report process
+    """
+    log_path = log_path or os.path.join(output_dir, 'triage_summary_report.log')
+
+    command = [
+        sys.executable, '-m', 'pipeline.utils.experiment_report',
+        '--template', template_path,
+        '--output-dir', output_dir,
+        '--formats', *output_formats,
+        '--timeout', str(timeout),
+    ]
+
+    with open(log_path, 'a') as log_file:
+        process = subprocess.Popen(
+            command,
+            stdout=log_file,
+            stderr=subprocess.STDOUT,
+            start_new_session=True  # keeps running after run.py exits
+        )
+
+    logging.info(f'Generating the experiment report in the background (pid {process.pid}), logging to {log_path}')
+
+    return process
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Execute the triage summary report notebook")
+
+    parser.add_argument(
+        "--template",
+        type=str,
+        default=REPORT_TEMPLATE_PATH,
+        help='Path of the report notebook template'
+    )
+
+    parser.add_argument(
+        "--output-dir",
+        type=str,
+        default=REPORT_OUTPUT_DIR,
+        help='Directory the reports are written to'
+    )
+
+    parser.add_argument(
+        "--formats",
+        type=str,
+        nargs='+',
+        default=['notebook', 'html'],
+        help='Output formats (nbconvert exporter names, e.g. notebook html pdf)'
+    )
+
+    parser.add_argument(
+        "--timeout",
+        type=int,
+        default=1800,
+        help='Seconds a single cell can run'
+    )
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    generate_experiment_report(
+        template_path=args.template,
+        output_dir=args.output_dir,
+        output_formats=args.formats,
+        timeout=args.timeout,
+        reuse_kernel=False
+    )
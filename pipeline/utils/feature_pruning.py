@@ -0,0 +1,151 @@
+"""
+Dropping the uninformative columns of a training matrix before the model is fit.
+
+Within a training window many columns are constant or nearly so (rare diagnosis codes, rare cities,
+imputation flags that never fire) or exact copies of another column. They are selected per training
+matrix, so every split gets its own list, and the projection is kept by the wrapped estimator
+(wrapped_estimators.py) to be applied again at scoring time.
+
+Enabled with a block in the experiment config:
+
+    feature_pruning:
+        near_zero_fraction: 0.999  # drop columns where one value covers at least this fraction of the rows (1 drops only constant columns)
+        drop_duplicates: True      # drop columns that are identical to an earlier column
+
+The columns every model was trained without are recorded in acdhs_experiments.pruned_features by the
+experiment's trainer (see record_pruned_features_of).
+"""
+import logging
+
+import numpy as np
+import pandas as pd
+
+from pipeline.utils.performance_ledger import LedgerModelTrainer
+from pipeline.utils.project_constants import EXPERIMENT_METADATA_SCHEMA
+
+
+def _dominant_value_fraction(column):
+    """ The fraction of the rows taken by the most common value of a column """
+    counts = column.value_counts(dropna=False)
+    return counts.iloc[0] / len(column) if len(column) else 1.0
+
+
+def select_columns(X, near_zero_fraction=None, drop_duplicates=False):
+    """ Select the columns of a training matrix to keep
+
+        Args:
+            X (pd.DataFrame): the training matrix (dense or sparse columns)
+            near_zero_fraction (float, optional): drop the columns where one value covers at least this fraction of the rows
+            drop_duplicates (bool): drop the columns that are identical to an earlier column
+
+        Returns:
+            (np.array) the positions of the kept columns, and (dict) the dropped columns with the reason they were dropped
+    """
+    dropped = dict()
+
+    if near_zero_fraction is not None:
+        for column in X.columns:
+            fraction = _dominant_value_fraction(X[column])
+            if fraction >= 1:
+                dropped[column] = 'constant'
+            elif fraction >= near_zero_fraction:
+                dropped[column] = f'near zero variance ({fraction:.4f})'
+
+    if drop_duplicates:
+        # columns with the same hash are compared value by value
+        hashes = dict()
+        for column in X.columns:
+            if column in dropped:
+                continue
+            values = X[column].to_numpy(dtype=np.float32)
+            key = pd.util.hash_array(values).sum()
+            for earlier in hashes.get(key, []):
+                if np.array_equal(values, X[earlier].to_numpy(dtype=np.float32), equal_nan=True):
+                    dropped[column] = f'duplicate of {earlier}'
+                    break
+            else:
+                hashes.setdefault(key, []).append(column)
+
+    kept = np.array([i for i, column in enumerate(X.columns) if column not in dropped], dtype=int)
+
+    if len(kept) == 0:
+        raise ValueError('Feature pruning dropped every column of the training matrix')
+
+    logging.info(f'Feature pruning: keeping {len(kept)} of {X.shape[1]} columns')
+
+    return kept, dropped
+
+
+def pruning_options(config):
+    """ The wrapper options for the experiment config's feature_pruning block (empty if there is none) """
+    pruning_config = config.get('feature_pruning')
+    if not pruning_config:
+        return dict()
+
+    return {
+        'prune_near_zero_fraction': pruning_config.get('near_zero_fraction', 1.0),
+        'prune_duplicates': pruning_config.get('drop_duplicates', True),
+    }
+
+
+def _create_pruned_features_table(db_engine, schema=EXPERIMENT_METADATA_SCHEMA):
+    q = f'''
+        create schema if not exists {schema};
+
+        create table if not exists {schema}.pruned_features (
+            experiment_hash varchar,
+            model_id int,
+            model_hash varchar,
+            feature varchar,
+            reason varchar,
+            recorded_at timestamp default now()
+        );
+    '''
+
+    with db_engine.begin() as conn:
+        conn.execute(q)
+
+
+def record_pruned_features(db_engine, experiment_hash, model_id, model_hash, dropped_columns):
+    """ Record the columns a model was trained without. The model itself keeps the projection """
+    pruned = pd.DataFrame({'feature': list(dropped_columns.keys()), 'reason': list(dropped_columns.values())})
+    pruned['experiment_hash'] = experiment_hash
+    pruned['model_id'] = model_id
+    pruned['model_hash'] = model_hash
+
+    _create_pruned_features_table(db_engine)
+    with db_engine.begin() as conn:
+        pruned.to_sql(
+            'pruned_features',
+            conn,
+            schema=EXPERIMENT_METADATA_SCHEMA,
+            if_exists='append',
+            index=False
+        )
+
+
+class PruningModelTrainer(LedgerModelTrainer):
+    """ The ledger's ModelTrainer, recording the columns every model was trained without if it pruned its features """
+
+    def _train(self, matrix_store, class_path, parameters, random_seed):
+        self._fitted = super()._train(matrix_store, class_path, parameters, random_seed)
+        return self._fitted
+
+    def _train_and_store_model(self, matrix_store, class_path, parameters, model_hash, *args, **kwargs):
+        model_id = super()._train_and_store_model(matrix_store, class_path, parameters, model_hash, *args, **kwargs)
+
+        fitted, self._fitted = getattr(self, '_fitted', None), None
+        if getattr(fitted, 'dropped_columns_', None):
+            record_pruned_features(self.db_engine, self.experiment_hash, model_id, model_hash, fitted.dropped_columns_)
+
+        return model_id
+
+
+def record_pruned_features_of(experiment):
+    """ Record the pruned features of the experiment's models, if its config has a feature_pruning block.
+        Call it after instrument_experiment (performance_ledger.py), whose trainer this one extends
+    """
+    if pruning_options(experiment.config):
+        experiment.trainer.__class__ = PruningModelTrainer
+
+    return experiment
@@ -0,0 +1,261 @@
+"""
+Successive-halving over time splits for the model grid.
+
+Every model group is first trained on the most recent splits, ranked on the experiment's
+priority metric, and only the top fraction is carried to the older splits. The ranking of every
+round (kept and eliminated groups) is written to the database so the experiment stays auditable.
+"""
+import json
+import logging
+import math
+
+import pandas as pd
+
+from triage.component.catwalk.utils import associate_models_with_experiment
+
+from pipeline.utils.project_constants import EXPERIMENT_METADATA_SCHEMA
+
+
+# Cheap model groups that we keep on every split as reference points
+BASELINE_CLASS_PREFIXES = (
+    'triage.component.catwalk.baselines',
+    'sklearn.dummy',
+)
+
+
+def _create_grid_pruning_table(db_engine, schema=EXPERIMENT_METADATA_SCHEMA):
+    q = f'''
+        create schema if not exists {schema};
+
+        create table if not exists {schema}.grid_pruning (
+            experiment_hash varchar,
+            run_id int,
+            pruning_round int,
+            model_group_id int,
+            model_type varchar,
+            hyperparameters jsonb,
+            metric varchar,
+            parameter varchar,
+            avg_value float,
+            splits_evaluated int,
+            rank int,
+            kept bool,
+            oldest_train_end_time timestamp,
+            recorded_at timestamp default now()
+        );
+    '''
+
+    with db_engine.begin() as conn:
+        conn.execute(q)
+
+
+def train_and_test_splits(experiment, splits, keep_task=None):
+    """ Train, test and evaluate the experiment's grid on a subset of the time splits
+
+        Args:
+            experiment: triage experiment whose matrices are already built
+            splits (List[dict]): entries of experiment.full_matrix_definitions
+            keep_task (callable, optional): predicate on a triage train task. Tasks for which it
+                returns False are not trained
+
+        Returns:
+            (int) number of train/test tasks processed
+    """
+    batches = experiment.model_train_tester.generate_task_batches(
+        splits=splits,
+        grid_config=experiment.config.get('grid_config'),
+        model_comment=experiment.config.get('model_comment', None),
+    )
+
+    if keep_task is not None:
+        for batch in batches:
+            batch.tasks[:] = [task for task in batch.tasks if keep_task(task)]
+
+    n_tasks = sum(len(batch.tasks) for batch in batches)
+    if n_tasks == 0:
+        logging.info('No train/test tasks left for these splits')
+        return 0
+
+    model_hashes = set(task['train_kwargs']['model_hash'] for batch in batches for task in batch.tasks)
+    associate_models_with_experiment(experiment.experiment_hash, model_hashes, experiment.db_engine)
+
+    logging.info(f'Training and evaluating {n_tasks} train/test tasks on {len(splits)} split(s)')
+    experiment.process_train_test_batches(batches)
+
+    return n_tasks
+
+
+def rank_model_groups(db_engine, experiment_hash, train_end_times, metric, parameter):
+    """ Average the priority metric of every model group of the experiment over the given splits
+
+        Args:
+            db_engine: SQLAlchemy engine
+            experiment_hash (str): triage experiment hash
+            train_end_times (List[datetime]): train end times of the splits to rank on
+            metric (str): e.g., 'precision@'
+            parameter (str): e.g., '100_abs'
+
+        Returns:
+            pd.DataFrame with one row per model group, best first
+    """
+
+    train_end_times = ', '.join([f"'{t}'::timestamp" for t in train_end_times])
+
+    q = f"""
+        select
+            m.model_group_id,
+            mg.model_type,
+            mg.hyperparameters,
+            avg(e.stochastic_value) as avg_value,
+            count(distinct m.train_end_time) as splits_evaluated
+        from triage_metadata.experiment_models em
+            join triage_metadata.models m using(model_hash)
+            join triage_metadata.model_groups mg using(model_group_id)
+            join test_results.evaluations e using(model_id)
+        where em.experiment_hash = '{experiment_hash}'
+        and m.train_end_time in ({train_end_times})
+        and e.metric = '{metric}'
+        and e.parameter = '{parameter}'
+        and coalesce(e.subset_hash, '') = ''
+        group by 1, 2, 3
+        order by avg_value desc nulls last
+    """
+
+    return pd.read_sql(q, db_engine)
+
+
+def _record_pruning_round(db_engine, experiment, pruning_round, ranked, kept_groups, metric, parameter, oldest_train_end_time):
+    ranked = ranked.copy()
+    ranked['experiment_hash'] = experiment.experiment_hash
+    ranked['run_id'] = experiment.run_id
+    ranked['pruning_round'] = pruning_round
+    ranked['metric'] = metric
+    ranked['parameter'] = parameter
+    ranked['rank'] = range(1, len(ranked) + 1)
+    ranked['kept'] = ranked.model_group_id.isin(kept_groups)
+    ranked['oldest_train_end_time'] = oldest_train_end_time
+    ranked['hyperparameters'] = ranked.hyperparameters.apply(json.dumps)
+
+    with db_engine.begin() as conn:
+        ranked.to_sql(
+            'grid_pruning',
+            conn,
+            schema=EXPERIMENT_METADATA_SCHEMA,
+            if_exists='append',
+            index=False
+        )
+
+
+def run_experiment_with_grid_pruning(experiment, n_recent_splits=2, keep_fraction=0.5, min_model_groups=1, keep_baselines=True):
+    """ Run a triage experiment, pruning the model grid by successive halving over time splits.
+
+        The model groups are trained on the `n_recent_splits` most recent splits and ranked on the
+        experiment's priority metric (scoring.priority_metric @ scoring.priority_parameter).
+        The top `keep_fraction` of the groups is then trained on the next `n_recent_splits` older
+        splits, re-ranked over all the splits seen so far, and so on until every split is covered.
+
+        Args:
+            experiment: triage experiment (SingleThreadedExperiment or MultiCoreExperiment)
+            n_recent_splits (int): number of splits evaluated in each pruning round
+            keep_fraction (float): fraction of the model groups carried to the next round
+            min_model_groups (int): never prune below this number of model groups
+            keep_baselines (bool): whether baselines and dummy classifiers are trained on all the splits regardless of rank.
+                They are then left out of the ranking, so they don't take the places of the other model groups
+
+        Returns:
+            (set) ids of the model groups that were trained on every split
+    """
+
+    if n_recent_splits < 1:
+        raise ValueError(f'n_recent_splits should be at least 1, got {n_recent_splits}')
+
+    if not 0 < keep_fraction <= 1:
+        raise ValueError(f'keep_fraction should be in (0, 1], got {keep_fraction}')
+
+    db_engine = experiment.db_engine
+    scoring_config = experiment.config.get('scoring', {})
+    metric = scoring_config.get('priority_metric', 'precision@')
+    parameter = scoring_config.get('priority_parameter', '100_abs')
+
+    _create_grid_pruning_table(db_engine)
+
+    experiment.generate_matrices()
+    experiment.generate_subsets()
+    experiment.generate_protected_groups()
+
+    # oldest to newest, we walk backwards in chunks of n_recent_splits
+    splits = sorted(experiment.full_matrix_definitions, key=lambda s: s['train_matrix']['matrix_info_end_time'])
+    rounds = [splits[max(0, i - n_recent_splits):i] for i in range(len(splits), 0, -n_recent_splits)]
+
+    trainer = experiment.trainer
+    surviving_groups = None
+    evaluated_end_times = list()
+
+    def _keep_task(task):
+        train_kwargs = task['train_kwargs']
+        if keep_baselines and train_kwargs['class_path'].startswith(BASELINE_CLASS_PREFIXES):
+            return True
+
+        model_group_id = trainer.model_grouper.get_model_group_id(
+            train_kwargs['class_path'],
+            trainer.unique_parameters(train_kwargs['parameters']),
+            train_kwargs['matrix_store'].metadata,
+            db_engine
+        )
+        return model_group_id in surviving_groups
+
+    for pruning_round, round_splits in enumerate(rounds):
+        logging.info(
+            f'Grid pruning round {pruning_round}: '
+            f'{len(round_splits)} split(s) ending {[str(s["train_matrix"]["matrix_info_end_time"]) for s in round_splits]}, '
+            f'{"all" if surviving_groups is None else len(surviving_groups)} model groups'
+        )
+
+        train_and_test_splits(
+            experiment,
+            round_splits,
+            keep_task=None if surviving_groups is None else _keep_task
+        )
+
+        evaluated_end_times.extend([s['train_matrix']['matrix_info_end_time'] for s in round_splits])
+
+        # No need to rank after the oldest splits are done
+        if pruning_round == len(rounds) - 1:
+            break
+
+        ranked = rank_model_groups(db_engine, experiment.experiment_hash, evaluated_end_times, metric, parameter)
+        if surviving_groups is not None:
+            ranked = ranked[ranked.model_group_id.isin(surviving_groups)]
+        if keep_baselines:
+            ranked = ranked[~ranked.model_type.str.startswith(BASELINE_CLASS_PREFIXES)]
+
+        if ranked.empty:
+            logging.warning('No evaluations found for ranking the model groups, stopping the grid pruning without eliminating any model group')
+            surviving_groups = None
+            continue
+
+        n_keep = max(min_model_groups, math.ceil(keep_fraction * len(ranked)))
+        surviving_groups = set(ranked.model_group_id.iloc[:n_keep])
+
+        _record_pruning_round(
+            db_engine,
+            experiment,
+            pruning_round,
+            ranked,
+            surviving_groups,
+            metric,
+            parameter,
+            min(evaluated_end_times)
+        )
+
+        eliminated = ranked[~ranked.model_group_id.isin(surviving_groups)]
+        logging.info(
+            f'Kept {len(surviving_groups)} model groups on {metric}{parameter}, '
+            f'eliminated {len(eliminated)}: {eliminated.model_group_id.tolist()}'
+        )
+
+    # as at the end of experiment.run()
+    experiment._summary_report()
+    experiment._log_end_of_run_report()
+
+    return surviving_groups
@@ -0,0 +1,251 @@
+"""
+A local cache of the trained models, keyed by model hash, for scoring and analysis that load the same models repeatedly.
+
+triage stores the models as compressed joblib pickles in the project path (which can be an S3 bucket), so every load
+downloads and decompresses the whole file. The first time a model is loaded through the cache it is re-dumped
+uncompressed in `<cache_path>/<model_hash>/model.joblib`, with the sha256, size and modification time of the file
+next to it. Later loads hash the file again only if its size or modification time changed (a corrupted or partial file
+is fetched again), and load it with `mmap_mode='r'`: the numpy arrays
+of the estimator are memory-mapped instead of read, for the estimators that keep them as they are (e.g. the wrappers,
+linear models, LightGBM/XGBoost buffers). scikit-learn trees copy their node arrays when unpickled.
+
+The cache is bounded: when it grows over its size, the least recently used models are removed.
+
+Models of a project can be fetched ahead of time:
+
+    python -m pipeline.utils.model_cache -m 101 102 103
+"""
+import argparse
+import errno
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+import joblib
+from triage.component.catwalk.storage import ModelStorageEngine, ProjectStorage
+from triage.component.catwalk.utils import retrieve_model_hash_from_id
+
+from pipeline.utils.project_constants import PROJECT_PATH, MODEL_CACHE_PATH, MODEL_CACHE_SIZE_GB
+from pipeline.utils.utils import get_db_engine
+
+
+MODEL_FILENAME = 'model.joblib'
+CHECKSUM_FILENAME = 'model.sha256'
+
+
+def _sha256(path, chunk_size=1 << 24):
+    checksum = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def _file_state(path):
+    """ The size and modification time of a file, which change when it is rewritten or truncated """
+    stat = os.stat(path)
+    return f'{stat.st_size} {stat.st_mtime_ns}'
+
+
+def _write_checksum(model_path, checksum_path, checksum):
+    """ Write the checksum of the model with its current size and modification time, replacing the previous one atomically """
+    tmp_path = f'{checksum_path}.{os.getpid()}.{time.monotonic_ns()}.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(f'{checksum} {_file_state(model_path)}')
+    os.replace(tmp_path, checksum_path)
+
+
+def _directory_size(path):
+    return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+
+
+class LocalModelCache:
+    """ Uncompressed copies of models on the local disk, with a checksum each and a least recently used size bound
+
+        Args:
+            cache_path (str): The local directory of the cache
+            max_size_gb (float): The size over which the least recently used models are removed
+            verify (bool): Whether to check the checksum of a cached model before loading it
+    """
+
+    def __init__(self, cache_path=MODEL_CACHE_PATH, max_size_gb=MODEL_CACHE_SIZE_GB, verify=True):
+        if not cache_path:
+            raise ValueError('The model cache needs a local directory (MODEL_CACHE_PATH in project_constants.py)')
+
+        self.cache_path = cache_path
+        self.max_size = max_size_gb * 1024 ** 3
+        self.verify = verify
+        os.makedirs(self.cache_path, exist_ok=True)
+
+    def _model_dir(self, model_hash):
+        return os.path.join(self.cache_path, model_hash)
+
+    def contains(self, model_hash, verify=None):
+        """ Whether the model is cached (and its checksum matches, if verify is set)
+
+            The file is only hashed again when its size or modification time are not the ones it was verified with.
+        """
+        verify = self.verify if verify is None else verify
+        model_path = os.path.join(self._model_dir(model_hash), MODEL_FILENAME)
+        checksum_path = os.path.join(self._model_dir(model_hash), CHECKSUM_FILENAME)
+
+        if not (os.path.exists(model_path) and os.path.exists(checksum_path)):
+            return False
+
+        if verify:
+            with open(checksum_path) as f:
+                checksum, _, verified_state = f.read().strip().partition(' ')
+
+            if verified_state != _file_state(model_path):
+                if checksum != _sha256(model_path):
+                    logging.warning(f'The cached model {model_hash} does not match its checksum, removing it')
+                    self.remove(model_hash)
+                    return False
+                _write_checksum(model_path, checksum_path, checksum)
+
+        return True
+
+    def load(self, model_hash, mmap_mode='r'):
+        """ Load a cached model, its arrays memory-mapped (mmap_mode=None reads them in memory) """
+        model_dir = self._model_dir(model_hash)
+
+        # the modification time of the directory is the last use, for the LRU eviction
+        os.utime(model_dir)
+
+        return joblib.load(os.path.join(model_dir, MODEL_FILENAME), mmap_mode=mmap_mode)
+
+    def add(self, model_hash, model):
+        """ Dump a model uncompressed in the cache, and evict the least recently used models if it's over its size
+
+            The model is written to a temporary directory that is renamed, so concurrent readers never see a partial model.
+            If another process cached the model in the meantime, its copy is kept and this one is dropped.
+        """
+        model_dir = self._model_dir(model_hash)
+        tmp_dir = tempfile.mkdtemp(prefix=f'{model_hash}.', suffix='.tmp', dir=self.cache_path)
+
+        model_path = os.path.join(tmp_dir, MODEL_FILENAME)
+        joblib.dump(model, model_path)
+        _write_checksum(model_path, os.path.join(tmp_dir, CHECKSUM_FILENAME), _sha256(model_path))
+
+        # a directory left without a valid model (e.g. by a process killed while removing it) is moved out of the way
+        if os.path.exists(model_dir) and not self.contains(model_hash):
+            try:
+                stale_dir = tempfile.mkdtemp(prefix=f'{model_hash}.', suffix='.stale.tmp', dir=self.cache_path)
+                os.replace(model_dir, stale_dir)
+                shutil.rmtree(stale_dir, ignore_errors=True)
+            except FileNotFoundError:
+                pass
+
+        try:
+            os.replace(tmp_dir, model_dir)
+        except OSError as e:
+            if e.errno not in (errno.ENOTEMPTY, errno.EEXIST):
+                raise
+            logging.info(f'Model {model_hash} was cached by another process, keeping its copy')
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+
+        logging.info(f'Cached model {model_hash} ({_directory_size(model_dir) / 1024 ** 2:.1f} MB)')
+        self.evict(keep=model_hash)
+
+    def remove(self, model_hash):
+        shutil.rmtree(self._model_dir(model_hash), ignore_errors=True)
+
+    def evict(self, keep=None):
+        """ Remove the least recently used models until the cache fits in its size (the `keep` model is never removed) """
+        entries = list()
+        for model_hash in os.listdir(self.cache_path):
+            path = self._model_dir(model_hash)
+            if not os.path.isdir(path) or model_hash.endswith('.tmp'):
+                continue
+            entries.append((os.path.getmtime(path), model_hash, _directory_size(path)))
+
+        total_size = sum(size for _, _, size in entries)
+        for _, model_hash, size in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            if model_hash == keep:
+                continue
+
+            logging.info(f'Evicting model {model_hash} from the cache ({size / 1024 ** 2:.1f} MB)')
+            self.remove(model_hash)
+            total_size -= size
+
+
+class CachedModelStorageEngine(ModelStorageEngine):
+    """ triage ModelStorageEngine that loads the models through a LocalModelCache
+
+        Can be given to a triage Predictor instead of `project_storage.model_storage_engine()`.
+    """
+
+    def __init__(self, project_storage, model_cache=None, model_directory=None):
+        super().__init__(project_storage, model_directory)
+        self.model_cache = model_cache or LocalModelCache()
+
+    def load(self, model_hash):
+        if self.model_cache.contains(model_hash):
+            logging.debug(f'Loading model {model_hash} from the local cache')
+            return self.model_cache.load(model_hash)
+
+        logging.info(f'Model {model_hash} is not in the local cache, loading it from the project storage')
+        model = super().load(model_hash)
+        self.model_cache.add(model_hash, model)
+
+        return model
+
+    def exists(self, model_hash):
+        # the checksum is verified when the model is loaded
+        return self.model_cache.contains(model_hash, verify=False) or super().exists(model_hash)
+
+
+def model_storage_engine(project_storage):
+    """ The model storage engine of a project, through the local cache if MODEL_CACHE_PATH is set """
+    if MODEL_CACHE_PATH:
+        return CachedModelStorageEngine(project_storage)
+
+    return project_storage.model_storage_engine()
+
+
+def load_model(db_engine, model_id, project_path=PROJECT_PATH, model_cache=None):
+    """ Load a triage model by id through the local cache, e.g. in postmodeling notebooks """
+    model_hash = retrieve_model_hash_from_id(db_engine, model_id)
+
+    return CachedModelStorageEngine(ProjectStorage(project_path), model_cache).load(model_hash)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Fetch trained models into the local model cache")
+
+    parser.add_argument(
+        "-m",
+        "--model-ids",
+        type=int,
+        nargs='+',
+        help='triage model ids to cache',
+        required=True
+    )
+
+    parser.add_argument(
+        "--project-path",
+        type=str,
+        default=PROJECT_PATH,
+        help='Where the models are stored (local path or s3://)'
+    )
+
+    args = parser.parse_args()
+
+    db_engine = get_db_engine()
+    storage_engine = CachedModelStorageEngine(ProjectStorage(args.project_path))
+    for model_id in args.model_ids:
+        model_hash = retrieve_model_hash_from_id(db_engine, model_id)
+        if storage_engine.model_cache.contains(model_hash):
+            logging.info(f'Model {model_id} ({model_hash}) is already cached')
+            continue
+
+        start = time.perf_counter()
+        storage_engine.load(model_hash)
+        logging.info(f'Cached model {model_id} ({model_hash}) in {time.perf_counter() - start:.1f} seconds')
@@ -0,0 +1,337 @@
+"""
+A persistent ledger of where an experiment spends its time and memory.
+
+Every phase of a run (precompute, cohort, labels, feature tables, matrix build) and every model
+fit, prediction and evaluation gets a row with its wall time, CPU time, peak RSS and row count in
+acdhs_experiments.phase_timings, keyed by the experiment hash and run id. Comparing the rows of
+runs of the same experiment hash shows when (and where) a config got slower.
+
+Notes on the numbers:
+    - CPU time is the CPU time of this process and its children. The feature and cohort phases
+      mostly run inside postgres, so their CPU time is small compared to their wall time.
+    - Peak RSS is the high water mark of the process, not of the phase. triage trains every model
+      in a fresh worker process (when n_jobs > 1), so it is per model fit there.
+"""
+import argparse
+import logging
+import os
+import resource
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+import pandas as pd
+
+from triage.component.catwalk.evaluation import ModelEvaluator
+from triage.component.catwalk.model_trainers import ModelTrainer
+from triage.component.catwalk.predictors import Predictor
+
+from pipeline.utils.project_constants import EXPERIMENT_METADATA_SCHEMA
+from pipeline.utils.utils import get_db_engine
+
+
+# Experiment steps that are timed as a whole, and the phase name they are recorded under
+EXPERIMENT_PHASES = {
+    'generate_cohort': 'cohort',
+    'generate_labels': 'labels',
+    'generate_preimputation_features': 'feature_tables',
+    'impute_missing_features': 'feature_imputation',
+    'build_matrices': 'matrix_build',
+    'generate_subsets': 'subsets',
+    'generate_protected_groups': 'protected_groups',
+    'train_and_test_models': 'train_test',
+}
+
+
+def create_phase_timings_table(db_engine, schema=EXPERIMENT_METADATA_SCHEMA):
+    q = f'''
+        create schema if not exists {schema};
+
+        create table if not exists {schema}.phase_timings (
+            experiment_hash varchar,
+            run_id int,
+            phase varchar,
+            detail varchar,
+            model_hash varchar,
+            model_id int,
+            rows bigint,
+            wall_seconds float,
+            cpu_seconds float,
+            peak_rss_mb float,
+            pid int,
+            started_at timestamp,
+            recorded_at timestamp default now()
+        );
+
+        create index if not exists phase_timings_experiment_hash_idx on {schema}.phase_timings(experiment_hash, run_id);
+    '''
+
+    with db_engine.begin() as conn:
+        conn.execute(q)
+
+
+def _cpu_seconds():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on linux
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) / 1024
+
+
+@contextmanager
+def measure():
+    """ Measure the wall time, CPU time and peak RSS of the enclosed block
+
+        Yields a dict that is filled with started_at, wall_seconds, cpu_seconds, peak_rss_mb and pid
+        when the block exits. The caller can add other columns (e.g., rows) to it.
+    """
+    timing = {'started_at': datetime.now(), 'pid': os.getpid()}
+    wall_start = time.perf_counter()
+    cpu_start = _cpu_seconds()
+
+    try:
+        yield timing
+    finally:
+        timing['wall_seconds'] = time.perf_counter() - wall_start
+        timing['cpu_seconds'] = _cpu_seconds() - cpu_start
+        timing['peak_rss_mb'] = _peak_rss_mb()
+
+
+def record_timings(db_engine, timings):
+    """ Append timing rows to the ledger. Failing to record never fails the experiment """
+    try:
+        with db_engine.begin() as conn:
+            pd.DataFrame(timings).to_sql(
+                'phase_timings',
+                conn,
+                schema=EXPERIMENT_METADATA_SCHEMA,
+                if_exists='append',
+                index=False
+            )
+    except Exception as e:
+        logging.warning(f'Could not record {len(timings)} timing(s) in the performance ledger: {e}')
+
+
+class LedgerModelTrainer(ModelTrainer):
+    """ ModelTrainer that records every model fit (and the storing of the model) in the ledger """
+
+    def _train_and_store_model(self, matrix_store, class_path, parameters, model_hash, *args, **kwargs):
+        with measure() as timing:
+            model_id = super()._train_and_store_model(matrix_store, class_path, parameters, model_hash, *args, **kwargs)
+
+        timing.update(
+            experiment_hash=self.experiment_hash,
+            run_id=self.run_id,
+            phase='model_fit',
+            detail=class_path,
+            model_hash=model_hash,
+            model_id=model_id,
+            rows=len(matrix_store.labels)
+        )
+        record_timings(self.db_engine, [timing])
+
+        return model_id
+
+
+class LedgerPredictor(Predictor):
+    """ Predictor that records every prediction in the ledger """
+
+    def predict(self, model_id, matrix_store, *args, **kwargs):
+        with measure() as timing:
+            predictions = super().predict(model_id, matrix_store, *args, **kwargs)
+
+        timing.update(
+            experiment_hash=self.ledger_experiment_hash,
+            run_id=self.ledger_run_id,
+            phase='prediction',
+            detail=matrix_store.matrix_type.string_name,
+            model_id=model_id,
+            rows=len(predictions)
+        )
+        record_timings(self.db_engine, [timing])
+
+        return predictions
+
+
+class LedgerModelEvaluator(ModelEvaluator):
+    """ ModelEvaluator that records every evaluation in the ledger """
+
+    def evaluate(self, predictions_proba, matrix_store, model_id, *args, **kwargs):
+        with measure() as timing:
+            result = super().evaluate(predictions_proba, matrix_store, model_id, *args, **kwargs)
+
+        subset = kwargs.get('subset')
+        timing.update(
+            experiment_hash=self.ledger_experiment_hash,
+            run_id=self.ledger_run_id,
+            phase='evaluation',
+            detail=matrix_store.matrix_type.string_name + (f" ({subset['name']})" if subset else ''),
+            model_id=model_id,
+            rows=len(predictions_proba)
+        )
+        record_timings(self.db_engine, [timing])
+
+        return result
+
+
+def _count_rows(db_engine, table_names):
+    q = ' + '.join([f'(select count(*) from {table_name})' for table_name in table_names])
+    return pd.read_sql(f'select {q} as n', db_engine).n.iloc[0]
+
+
+def _phase_rows(experiment, phase):
+    """ The number of rows a phase produced, where that is cheap to know """
+    if phase == 'cohort':
+        return _count_rows(experiment.db_engine, [experiment.cohort_table_name])
+
+    if phase == 'labels':
+        return _count_rows(experiment.db_engine, [experiment.labels_table_name])
+
+    if phase in ('feature_tables', 'feature_imputation'):
+        return _count_rows(
+            experiment.db_engine,
+            [agg.get_table_name(imputed=(phase == 'feature_imputation')) for agg in experiment.collate_aggregations]
+        )
+
+    if phase == 'matrix_build':
+        q = f"""
+            select coalesce(sum(num_observations), 0) as n
+            from triage_metadata.experiment_matrices
+                join triage_metadata.matrices using(matrix_uuid)
+            where experiment_hash = '{experiment.experiment_hash}'
+        """
+        return pd.read_sql(q, experiment.db_engine).n.iloc[0]
+
+    return None
+
+
+def _instrument_step(experiment, method_name, phase):
+    step = getattr(experiment, method_name)
+
+    def timed_step(*args, **kwargs):
+        with measure() as timing:
+            value = step(*args, **kwargs)
+        timing.update(experiment_hash=experiment.experiment_hash, run_id=experiment.run_id, phase=phase)
+        # counted after the phase, so that counting isn't part of its time, and before recording the row
+        try:
+            timing['rows'] = _phase_rows(experiment, phase)
+        except Exception as e:
+            logging.warning(f'Could not count the rows of {phase}: {e}')
+        record_timings(experiment.db_engine, [timing])
+
+        rows = f", {timing['rows']} rows" if timing.get('rows') is not None else ''
+        logging.info(
+            f"{phase} took {timing['wall_seconds']:.1f}s "
+            f"(cpu {timing['cpu_seconds']:.1f}s, peak rss {timing['peak_rss_mb']:.0f}MB{rows})"
+        )
+        return value
+
+    return timed_step
+
+
+def instrument_experiment(experiment):
+    """ Record the phases of a triage experiment, and its model fits, predictions and evaluations, in the ledger
+
+        The experiment steps are wrapped on the instance, so this works with experiment.run() and with
+        anything else that calls the steps (e.g., the grid pruning). The trainer, predictor and evaluator
+        are switched to subclasses that time each call. They stay picklable, so the timings are also
+        recorded from the worker processes of a MultiCoreExperiment.
+
+        Args:
+            experiment: triage experiment (SingleThreadedExperiment or MultiCoreExperiment)
+    """
+    create_phase_timings_table(experiment.db_engine)
+
+    for method_name, phase in EXPERIMENT_PHASES.items():
+        setattr(experiment, method_name, _instrument_step(experiment, method_name, phase))
+
+    experiment.trainer.__class__ = LedgerModelTrainer
+
+    for component, ledger_class in ((experiment.predictor, LedgerPredictor), (experiment.evaluator, LedgerModelEvaluator)):
+        component.__class__ = ledger_class
+        component.ledger_experiment_hash = experiment.experiment_hash
+        component.ledger_run_id = experiment.run_id
+
+    return experiment
+
+
+def compare_runs(db_engine, experiment_hash=None, n_runs=5):
+    """ Compare the time spent per phase by the last runs of an experiment
+
+        Args:
+            db_engine: SQLAlchemy engine
+            experiment_hash (str, optional): defaults to the experiment of the most recent ledger row
+            n_runs (int): number of most recent runs to compare
+
+        Returns:
+            pd.DataFrame with one row per phase and one column per run (wall seconds, summed over the
+            phase's rows), plus the ratio of the latest run to the median of the previous ones
+    """
+    if experiment_hash is None:
+        q = f"select experiment_hash from {EXPERIMENT_METADATA_SCHEMA}.phase_timings order by recorded_at desc limit 1"
+        experiment_hash = pd.read_sql(q, db_engine).experiment_hash.iloc[0]
+
+    q = f"""
+        with runs as (
+            select distinct run_id
+            from {EXPERIMENT_METADATA_SCHEMA}.phase_timings
+            where experiment_hash = '{experiment_hash}'
+            order by run_id desc
+            limit {n_runs}
+        )
+        select
+            run_id,
+            phase,
+            sum(wall_seconds) as wall_seconds,
+            sum(cpu_seconds) as cpu_seconds,
+            max(peak_rss_mb) as peak_rss_mb,
+            sum(rows) as rows,
+            count(*) as n
+        from {EXPERIMENT_METADATA_SCHEMA}.phase_timings
+            join runs using(run_id)
+        where experiment_hash = '{experiment_hash}'
+        group by 1, 2
+    """
+    timings = pd.read_sql(q, db_engine)
+
+    report = timings.pivot(index='phase', columns='run_id', values='wall_seconds').sort_index(axis=1)
+    n_compared = report.shape[1]
+    if n_compared > 1:
+        latest = report.columns[-1]
+        report['latest_vs_median'] = report[latest] / report[report.columns[:-1]].median(axis=1)
+
+    logging.info(f'Wall seconds per phase of the last {n_compared} runs of experiment {experiment_hash}')
+
+    return report
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Compare the time spent per phase by the last runs of an experiment")
+
+    parser.add_argument(
+        "-e",
+        "--experiment-hash",
+        type=str,
+        help='Experiment hash (defaults to the most recently recorded experiment)',
+        required=False
+    )
+
+    parser.add_argument(
+        "-n",
+        "--runs",
+        type=int,
+        default=5,
+        help='Number of most recent runs to compare',
+        required=False
+    )
+
+    args = parser.parse_args()
+
+    with pd.option_context('display.width', 200, 'display.float_format', '{:.1f}'.format):
+        print(compare_runs(get_db_engine(), experiment_hash=args.experiment_hash, n_runs=args.runs))
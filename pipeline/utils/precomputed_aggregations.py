@@ -0,0 +1,44 @@
+"""
+triage's feature generation, reading only the collate date's rows of the precomputed feature tables
+(pretriage.days_since_events, see pretriage/days_since_features.py, and the interval tables of pretriage/interval_features.py).
+
+The rows of those tables have knowledge_date = as_of_date - 1 day, and the feature groups reading them use the `all`
+interval (so their feature names are the ones of the groups they replace). triage bounds an `all` interval by the
+collate date only, so the query of every as_of_date scanned the rows of all the earlier as_of_dates and the
+`case when as_of_date = '{collate_date}'` threw all but one of them away: the work grew with the square of the number
+of as_of_dates. The aggregations of those groups also get the lower bound knowledge_date >= collate date - 1 day here,
+which selects the collate date's rows through the knowledge_date index triage puts on the materialized from_obj.
+"""
+import re
+
+from sqlalchemy.sql.expression import text
+from triage.component.architect.features import FeatureGenerator
+from triage.component.collate import SpacetimeAggregation
+
+from pipeline.pretriage.interval_features import PRECOMPUTED_TABLE_PREFIX
+
+
+PRECOMPUTED_TABLES = re.compile(rf'pretriage\.days_since_events\b|{re.escape(PRECOMPUTED_TABLE_PREFIX)}\w+')
+
+
+def reads_precomputed_table(aggregation_config):
+    """ Whether a feature group reads a precomputed table, with one row per entity and as_of_date """
+    return PRECOMPUTED_TABLES.search(aggregation_config['from_obj']) is not None
+
+
+class CollateDateAggregation(SpacetimeAggregation):
+    """ A SpacetimeAggregation reading the rows of the collate date only (knowledge_date = as_of_date - 1 day) """
+
+    def where(self, date, intervals):
+        return text(f"{super().where(date, intervals).text} AND {self.date_column} >= '{date}'::date - interval '1 day'")
+
+
+class PrecomputedFeatureGenerator(FeatureGenerator):
+    """ triage's FeatureGenerator, with a CollateDateAggregation for the feature groups reading a precomputed table """
+
+    def _aggregation(self, aggregation_config, feature_dates, state_table):
+        aggregation = super()._aggregation(aggregation_config, feature_dates, state_table)
+        if reads_precomputed_table(aggregation_config):
+            aggregation.__class__ = CollateDateAggregation
+
+        return aggregation
@@ -0,0 +1,264 @@
+"""
+Building the production (predict forward) matrix of a model, as triage.predictlist.predict_forward_with_existed_model does,
+but as a separate step so one matrix can be scored by every model trained on the same features.
+
+Models of the same experiment (or of experiments with the same cohort and feature definitions) that were trained
+on the same feature columns get identical production matrices. feature_set_key identifies them.
+"""
+import copy
+import logging
+from collections import OrderedDict
+
+import pandas as pd
+
+from triage.component.architect.builders import MatrixBuilder
+from triage.component.architect.entity_date_table_generators import EntityDateTableGenerator
+from triage.component.architect.feature_group_creator import FeatureGroup
+from triage.component.architect.planner import Planner
+from triage.component.catwalk.predictors import Predictor
+from triage.component.catwalk.utils import filename_friendly_hash, retrieve_model_hash_from_id
+from triage.component.timechop import Timechop
+from triage.predictlist.utils import (
+    experiment_config_from_model_id,
+    train_matrix_info_from_model_id,
+    temporal_params_from_matrix_metadata,
+    get_feature_names,
+    get_feature_needs_imputation_in_train,
+    get_feature_needs_imputation_in_production,
+    cohort_config_from_label_config,
+)
+from triage.util.conf import dt_from_str
+
+from pipeline.utils.precomputed_aggregations import PrecomputedFeatureGenerator
+
+
+def last_split_model_id(db_engine, model_group_id):
+    """ The model of the model group's last split, the latest one trained by an experiment (not by a retrain) """
+    q = f'''
+        select m.model_id
+        from triage_metadata.models m
+            join triage_metadata.triage_runs r on m.built_in_triage_run = r.id
+        where m.model_group_id = {model_group_id}
+        and r.run_type = 'experiment'
+        order by m.train_end_time desc
+        limit 1
+    '''
+    model_ids = pd.read_sql(q, db_engine).model_id.tolist()
+
+    if not model_ids:
+        raise ValueError(f'Model group {model_group_id} has no model trained by an experiment')
+
+    return int(model_ids[0])
+
+
+def experiment_model_id(db_engine, model_id):
+    """ The model the experiment config and temporal parameters of a model are read from: the model itself, or the
+        last split of its model group if it was trained by a retrain (it has no experiment run and no test matrix)
+    """
+    q = f'''
+        select m.model_group_id, r.run_type
+        from triage_metadata.models m
+            left join triage_metadata.triage_runs r on m.built_in_triage_run = r.id
+        where m.model_id = {model_id}
+    '''
+    model = pd.read_sql(q, db_engine)
+
+    if model.empty:
+        raise ValueError(f'No model {model_id} in triage_metadata.models')
+
+    if model.run_type.iloc[0] != 'retrain':
+        return model_id
+
+    return last_split_model_id(db_engine, model.model_group_id.iloc[0])
+
+
+class ProductionModel:
+    """ What's needed to build the production matrix of a model and score it, read once from triage_metadata
+
+        The train matrix is the model's. The experiment config and temporal parameters of a retrained model are the
+        ones of its model group's last split, as triage's Retrainer uses them.
+    """
+
+    def __init__(self, db_engine, model_id):
+        self.model_id = model_id
+        self.train_matrix_uuid, self.train_matrix_metadata = train_matrix_info_from_model_id(db_engine, model_id)
+
+        config_model_id = experiment_model_id(db_engine, model_id)
+        self.experiment_config = experiment_config_from_model_id(db_engine, config_model_id)
+        self.temporal_params = temporal_params_from_matrix_metadata(db_engine, config_model_id)
+
+        if self.experiment_config.get('cohort_config') is None:
+            self.experiment_config['cohort_config'] = cohort_config_from_label_config(self.experiment_config['label_config'])
+
+    @property
+    def feature_set_key(self):
+        """ Models with the same key have the same production matrix on an as_of_date """
+        return filename_friendly_hash({
+            'cohort_config': self.experiment_config['cohort_config'],
+            'feature_aggregations': self.experiment_config['feature_aggregations'],
+            'feature_start_time': self.experiment_config['temporal_config']['feature_start_time'],
+            'feature_names': sorted(self.train_matrix_metadata['feature_names']),
+            'label_name': self.experiment_config['label_config']['name'],
+            'test_durations': self.temporal_params['test_durations'],
+            'test_label_timespans': self.temporal_params['test_label_timespans'],
+        })
+
+
+def cohort_table_model(production_model, cohort_table, name_suffix):
+    """ A copy of the production model whose cohort is the entities of a precomputed cohort table,
+        e.g. the clients a partial delta precompute was run for
+    """
+    model = copy.copy(production_model)
+    model.experiment_config = copy.deepcopy(production_model.experiment_config)
+    model.experiment_config['cohort_config'] = {
+        'name': f"{production_model.experiment_config['cohort_config']['name']}_{name_suffix}",
+        'query': f'select entity_id from {cohort_table}',
+    }
+
+    return model
+
+
+class CachingPredictor(Predictor):
+    """ A triage Predictor that keeps the last model it loaded, so scoring several matrices with a model loads it once
+
+        With a compiled_model_storage_engine (see tree_inference.py), the compiled form of a model is used when there is one.
+    """
+
+    _loaded_model_id = None
+    _loaded_model = None
+
+    def __init__(self, *args, compiled_model_storage_engine=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.compiled_model_storage_engine = compiled_model_storage_engine
+
+    def _load_compiled_model(self, model_id):
+        if self.compiled_model_storage_engine is None:
+            return None
+
+        model_hash = retrieve_model_hash_from_id(self.db_engine, model_id)
+        if not self.compiled_model_storage_engine.exists(model_hash):
+            return None
+
+        logging.info(f'Scoring with the compiled form of model {model_id}')
+        return self.compiled_model_storage_engine.load(model_hash)
+
+    def load_model(self, model_id):
+        if model_id != self._loaded_model_id:
+            self._loaded_model = None
+            compiled_model = self._load_compiled_model(model_id)
+            self._loaded_model = compiled_model if compiled_model is not None else super().load_model(model_id)
+            self._loaded_model_id = model_id
+
+        return self._loaded_model
+
+
+def build_production_matrix(db_engine, matrix_storage_engine, production_model, as_of_date, matrix_id=None, features_schema_name='triage_production'):
+    """ Generate the cohort, features and imputations of a model's experiment config on an as_of_date and build its matrix
+
+        Args:
+            db_engine: SQLAlchemy engine
+            matrix_storage_engine (triage.component.catwalk.storage.MatrixStorageEngine)
+            production_model (ProductionModel): The model (its config and train matrix) the matrix is built for
+            as_of_date (str): 'YYYY-MM-DD'
+            matrix_id (str, optional): Defaults to the one triage uses for a single model
+            features_schema_name (str): The schema of the cohort, feature and imputation tables. The services scoring
+                alongside predict_forward use their own, so they don't overwrite its tables
+
+        Returns:
+            (str) the uuid of the matrix
+    """
+    experiment_config = copy.deepcopy(production_model.experiment_config)
+    matrix_metadata = production_model.train_matrix_metadata
+    feature_start_time = experiment_config['temporal_config']['feature_start_time']
+
+    with db_engine.begin() as conn:
+        conn.execute(f'create schema if not exists {features_schema_name}')
+
+    cohort_table_name = f"{features_schema_name}.cohort_{experiment_config['cohort_config']['name']}"
+    cohort_table_generator = EntityDateTableGenerator(
+        db_engine=db_engine,
+        query=experiment_config['cohort_config']['query'],
+        entity_date_table_name=cohort_table_name
+    )
+    cohort_table_generator.generate_entity_date_table(as_of_dates=[dt_from_str(as_of_date)])
+
+    feature_generator = PrecomputedFeatureGenerator(
+        db_engine=db_engine,
+        features_schema_name=features_schema_name,
+        feature_start_time=feature_start_time,
+    )
+    collate_aggregations = feature_generator.aggregations(
+        feature_aggregation_config=experiment_config['feature_aggregations'],
+        feature_dates=[as_of_date],
+        state_table=cohort_table_name
+    )
+    feature_generator.process_table_tasks(
+        feature_generator.generate_all_table_tasks(collate_aggregations, task_type='aggregation')
+    )
+
+    # the feature dictionary of the train matrix, with the imputations of train and production
+    feature_dictionary = FeatureGroup()
+    imputation_table_tasks = OrderedDict()
+    for aggregation in collate_aggregations:
+        feature_group, feature_names = get_feature_names(aggregation, matrix_metadata)
+        feature_dictionary[feature_group] = feature_names
+
+        impute_cols = set(get_feature_needs_imputation_in_production(aggregation, db_engine)) | set(get_feature_needs_imputation_in_train(aggregation, feature_names))
+        nonimpute_cols = set(f for f in feature_names if '_imp' not in f) - impute_cols
+
+        imputation_table_tasks.update(
+            feature_generator._generate_imp_table_tasks_for(aggregation, impute_cols=list(impute_cols), nonimpute_cols=list(nonimpute_cols))
+        )
+    feature_generator.process_table_tasks(imputation_table_tasks)
+
+    matrix_builder = MatrixBuilder(
+        db_config={
+            'features_schema_name': features_schema_name,
+            'labels_schema_name': 'public',
+            'cohort_table_name': cohort_table_name,
+        },
+        matrix_storage_engine=matrix_storage_engine,
+        engine=db_engine,
+        experiment_hash=None,
+        replace=True,
+    )
+
+    temporal_config = experiment_config['temporal_config']
+    temporal_config.update(production_model.temporal_params)
+    split_definition = Timechop(**temporal_config).define_test_matrices(
+        train_test_split_time=dt_from_str(as_of_date),
+        test_duration=temporal_config['test_durations'][0],
+        test_label_timespan=temporal_config['test_label_timespans'][0]
+    )[-1]
+
+    # formating the datetimes as strings to be saved as JSON
+    for key in ['first_as_of_time', 'last_as_of_time', 'matrix_info_end_time']:
+        split_definition[key] = str(split_definition[key])
+    split_definition['as_of_times'] = [str(split_definition['as_of_times'][0])]
+
+    label_name = experiment_config['label_config']['name']
+    metadata = Planner.make_metadata(
+        split_definition,
+        feature_dictionary,
+        label_name,
+        'binary',
+        experiment_config['cohort_config']['name'],
+        'production',
+        feature_start_time,
+        experiment_config.get('user_metadata', {}),
+    )
+    metadata['matrix_id'] = matrix_id or f'{as_of_date}_model_id_{production_model.model_id}_risklist'
+    matrix_uuid = filename_friendly_hash(metadata)
+
+    logging.info(f"Building the production matrix {metadata['matrix_id']} ({matrix_uuid})")
+    matrix_builder.build_matrix(
+        as_of_times=[as_of_date],
+        label_name=label_name,
+        label_type='binary',
+        feature_dictionary=feature_dictionary,
+        matrix_metadata=metadata,
+        matrix_uuid=matrix_uuid,
+        matrix_type='production',
+    )
+
+    return matrix_uuid
@@ -0,0 +1,350 @@
+"""
+The schema of acdhs_production.predictions, the scores the outreach lists are generated from, and the upsert of new scores into it.
+
+The table is partitioned by month of prediction_date, has a unique key on (model_id, entity_id, as_of_date, prediction_date),
+and its indexes are named and created once. Rerunning the scoring of a model on a date replaces its rows instead of
+appending a second copy of them, and scored_at records when every row was last scored.
+
+A table created by an older version of predict_forward (not partitioned, with an unnamed copy of every index per run) is
+migrated the first time the schema is checked: its rows are copied, without duplicates, into the partitioned table and
+the old table is dropped with its indexes. The old table has no timestamp: of the copies of a row, the one scored from the
+most recently built matrix is kept.
+
+The watermarks of the upstream tables the predictions of a model were computed from, and when their precomputed
+tables were built, are recorded next to them in acdhs_production.prediction_watermarks.
+"""
+import json
+import logging
+from datetime import date
+
+import pandas as pd
+
+
+PREDICTIONS_TABLE = 'acdhs_production.predictions'
+PREDICTION_WATERMARKS_TABLE = 'acdhs_production.prediction_watermarks'
+PREDICTIONS_KEY = ('model_id', 'entity_id', 'as_of_date', 'prediction_date')
+
+PREDICTIONS_COLUMNS = [
+    ('model_id', 'int not null'),
+    ('client_hash', 'varchar'),
+    ('entity_id', 'bigint not null'),
+    ('as_of_date', 'date not null'),
+    ('prediction_date', 'date not null'),
+    ('score', 'float'),
+    ('rank_abs_no_ties', 'int'),
+    ('rank_pct_no_ties', 'float'),
+    ('rank_abs_with_ties', 'int'),
+    ('rank_pct_with_ties', 'float'),
+    ('matrix_uuid', 'text'),
+    ('label_value', 'int'),
+    ('test_label_timespan', 'interval'),
+    ('scored_at', 'timestamp default now()'),
+]
+
+# name -> column, created on the partitioned table (and so on every partition)
+PREDICTIONS_INDEXES = {
+    'predictions_entity_id_idx': 'entity_id',
+    'predictions_as_of_date_idx': 'as_of_date',
+    'predictions_prediction_date_idx': 'prediction_date',
+}
+
+
+def _table_state(db_engine):
+    """ 'missing', 'partitioned', or 'legacy' (an unpartitioned table of an older version) """
+    q = f'''
+        select
+            to_regclass('{PREDICTIONS_TABLE}') is not null as table_exists,
+            exists (select 1 from pg_partitioned_table where partrelid = to_regclass('{PREDICTIONS_TABLE}')) as partitioned
+    '''
+    state = pd.read_sql(q, db_engine).iloc[0]
+
+    if not state.table_exists:
+        return 'missing'
+
+    return 'partitioned' if state.partitioned else 'legacy'
+
+
+def _missing_columns(db_engine):
+    """ The columns of PREDICTIONS_COLUMNS the table was created without (by an older version) """
+    schema, table = PREDICTIONS_TABLE.split('.')
+    q = f'''
+        select column_name
+        from information_schema.columns
+        where table_schema = '{schema}' and table_name = '{table}'
+    '''
+    existing = set(pd.read_sql(q, db_engine).column_name)
+
+    return [(column, column_type) for column, column_type in PREDICTIONS_COLUMNS if column not in existing]
+
+
+def _partition_name(prediction_date):
+    return f"{PREDICTIONS_TABLE}_p{prediction_date.strftime('%Y_%m')}"
+
+
+def _create_partition_query(prediction_date):
+    """ The partition of the month of the prediction date (a datetime.date) """
+    start = prediction_date.replace(day=1)
+    end = (start.replace(year=start.year + 1, month=1) if start.month == 12 else start.replace(month=start.month + 1))
+
+    return f'''
+        create table if not exists {_partition_name(start)}
+        partition of {PREDICTIONS_TABLE}
+        for values from ('{start}') to ('{end}');
+    '''
+
+
+def _create_table_query():
+    columns = ',\n'.join(f'{column} {column_type}' for column, column_type in PREDICTIONS_COLUMNS)
+    indexes = '\n'.join(
+        f'create index if not exists {name} on {PREDICTIONS_TABLE} ({column});'
+        for name, column in PREDICTIONS_INDEXES.items()
+    )
+
+    return f'''
+        create table if not exists {PREDICTIONS_TABLE} (
+            {columns},
+            constraint predictions_key unique ({', '.join(PREDICTIONS_KEY)})
+        ) partition by range (prediction_date);
+
+        {indexes}
+    '''
+
+
+def _migrate_legacy_table_query(db_engine):
+    """ Move the rows of the unpartitioned table into the partitioned one, keeping the row of every key scored from the
+        latest matrix (by triage_metadata.matrices.creation_time, the old table has no timestamp of its own)
+    """
+    legacy_table = f'{PREDICTIONS_TABLE}_unpartitioned'
+    months = pd.read_sql(
+        f"select distinct date_trunc('month', prediction_date)::date as month from {PREDICTIONS_TABLE} where prediction_date is not null",
+        db_engine
+    ).month.tolist()
+
+    partitions = '\n'.join(_create_partition_query(month) for month in months)
+    columns = [column for column, _ in PREDICTIONS_COLUMNS]
+    legacy_columns = [column for column in columns if column != 'scored_at']
+
+    # the indexes keep their names (e.g. predictions_entity_id_idx) when the table is renamed, and would
+    # make the `create index if not exists` of the partitioned table skip its own
+    return f'''
+        alter table {PREDICTIONS_TABLE} rename to predictions_unpartitioned;
+
+        do $$
+        declare
+            legacy_index record;
+            i int := 0;
+        begin
+            for legacy_index in select indexrelid::regclass::text as name from pg_index where indrelid = '{legacy_table}'::regclass loop
+                i := i + 1;
+                execute 'alter index ' || legacy_index.name || ' rename to predictions_unpartitioned_' || i || '_idx';
+            end loop;
+        end $$;
+
+        {_create_table_query()}
+
+        {partitions}
+
+        insert into {PREDICTIONS_TABLE} ({', '.join(columns)})
+            select distinct on ({', '.join(f'p.{column}' for column in PREDICTIONS_KEY)})
+                {', '.join(f'p.{column}' for column in legacy_columns)},
+                coalesce(m.creation_time, p.prediction_date) as scored_at
+            from {legacy_table} p
+            left join triage_metadata.matrices m on p.matrix_uuid = m.matrix_uuid
+            where {' and '.join(f'p.{column} is not null' for column in PREDICTIONS_KEY)}
+            order by {', '.join(f'p.{column}' for column in PREDICTIONS_KEY)}, m.creation_time desc nulls last;
+
+        drop table {legacy_table};
+    '''
+
+
+def create_predictions_table(db_engine):
+    """ Create the acdhs_production schema and the partitioned predictions table with its key and indexes,
+        or migrate the table of an older version. Adds the columns a partitioned table was created without.
+    """
+    state = _table_state(db_engine)
+    if state == 'partitioned':
+        missing_columns = _missing_columns(db_engine)
+        if missing_columns:
+            logging.info(f'Adding the columns {[column for column, _ in missing_columns]} to {PREDICTIONS_TABLE}')
+            with db_engine.begin() as conn:
+                conn.execute(
+                    f"set role 'rg_staff'; alter table {PREDICTIONS_TABLE} " +
+                    ', '.join(f'add column if not exists {column} {column_type}' for column, column_type in missing_columns)
+                )
+        return
+
+    if state == 'legacy':
+        logging.info(f'Migrating {PREDICTIONS_TABLE} to a table partitioned by prediction_date, with a unique key')
+        q = _migrate_legacy_table_query(db_engine)
+    else:
+        logging.info(f'Creating {PREDICTIONS_TABLE}')
+        q = _create_table_query()
+
+    with db_engine.begin() as conn:
+        conn.execute(f'''
+            set role 'rg_staff';
+
+            create schema if not exists acdhs_production;
+
+            {q}
+        ''')
+
+
+def upsert_predictions(db_engine, model_ids, as_of_date, prediction_date=None, entity_filter=None):
+    """ Copy the scores of models on an as_of_date from triage_production.predictions to acdhs_production.predictions
+
+        The rows of a (model_id, entity_id, as_of_date, prediction_date) that is already there are updated.
+
+        Args:
+            db_engine: SQLAlchemy engine
+            model_ids (list): triage model ids
+            as_of_date (str): 'YYYY-MM-DD'
+            prediction_date (str, optional): Defaults to today
+            entity_filter (str, optional): A condition on p.entity_id, to copy the scores of some entities only
+    """
+    create_predictions_table(db_engine)
+
+    prediction_date = date.fromisoformat(prediction_date) if prediction_date else date.today()
+    columns = [column for column, _ in PREDICTIONS_COLUMNS]
+    updated_columns = ',\n'.join(f'{c} = excluded.{c}' for c in columns if c not in PREDICTIONS_KEY)
+    entity_condition = f'and {entity_filter}' if entity_filter else ''
+
+    q = f"""
+        set role 'rg_staff';
+
+        {_create_partition_query(prediction_date)}
+
+        insert into {PREDICTIONS_TABLE} ({', '.join(columns)})
+            select
+                model_id,
+                client_hash,
+                entity_id,
+                as_of_date::date,
+                '{prediction_date}'::date as prediction_date,
+                score,
+                rank_abs_no_ties,
+                rank_pct_no_ties,
+                rank_abs_with_ties,
+                rank_pct_with_ties,
+                matrix_uuid,
+                label_value,
+                test_label_timespan,
+                now() as scored_at
+            from triage_production.predictions p join pretriage.client_id_mapping cim on p.entity_id = cim.client_id
+            where model_id in ({', '.join(str(m) for m in model_ids)}) and as_of_date = '{as_of_date}'::date {entity_condition}
+            order by model_id, score desc
+        on conflict ({', '.join(PREDICTIONS_KEY)}) do update set
+            {updated_columns}
+        ;
+    """
+
+    logging.info(f'Upserting the predictions of models {model_ids} on {as_of_date} into {PREDICTIONS_TABLE}')
+    with db_engine.begin() as conn:
+        conn.execute(q)
+
+
+
+def upsert_scores(db_engine, scores, prediction_date=None):
+    """ Upsert scores computed outside of triage (e.g. by the incremental scoring) into acdhs_production.predictions
+
+        Only the score, matrix_uuid and scored_at of a row that is already there are updated: the scores of a few
+        entities are not ranked in a cohort, so the ranks, label and label timespan of new rows are left empty and
+        those of the existing rows are kept.
+
+        Args:
+            db_engine: SQLAlchemy engine
+            scores (pd.DataFrame): model_id, entity_id, client_hash, as_of_date, score and matrix_uuid of every entity
+            prediction_date (str, optional): Defaults to today
+    """
+    if scores.empty:
+        return
+
+    create_predictions_table(db_engine)
+
+    prediction_date = date.fromisoformat(prediction_date) if prediction_date else date.today()
+    columns = ['model_id', 'entity_id', 'client_hash', 'as_of_date', 'score', 'matrix_uuid']
+    rows = [
+        (int(row.model_id), int(row.entity_id), row.client_hash, str(row.as_of_date), str(prediction_date), float(row.score), row.matrix_uuid)
+        for row in scores[columns].itertuples(index=False)
+    ]
+
+    with db_engine.begin() as conn:
+        conn.execute(f"set role 'rg_staff'; {_create_partition_query(prediction_date)}")
+        conn.execute(
+            f'''
+            insert into {PREDICTIONS_TABLE} (model_id, entity_id, client_hash, as_of_date, prediction_date, score, matrix_uuid)
+            values (%s, %s, %s, %s, %s, %s, %s)
+            on conflict ({', '.join(PREDICTIONS_KEY)}) do update set
+                score = excluded.score,
+                matrix_uuid = excluded.matrix_uuid,
+                scored_at = now()
+            ''',
+            rows
+        )
+
+    logging.info(f'Upserted the scores of {len(rows)} entities into {PREDICTIONS_TABLE}')
+
+def _create_prediction_watermarks_table(db_engine):
+    q = f'''
+        set role 'rg_staff';
+
+        create schema if not exists acdhs_production;
+
+        create table if not exists {PREDICTION_WATERMARKS_TABLE} (
+            model_id int,
+            as_of_date date,
+            prediction_date date,
+            upstream_watermarks jsonb,
+            precomputed_at jsonb,
+            recorded_at timestamp default now(),
+            primary key (model_id, as_of_date, prediction_date)
+        );
+    '''
+
+    with db_engine.begin() as conn:
+        conn.execute(q)
+
+
+def record_prediction_watermarks(db_engine, model_ids, as_of_date, upstream_watermarks, precomputed_at, prediction_date=None):
+    """ Record the upstream watermarks and precompute times the predictions of the models on the as_of_date were made with
+
+        Args:
+            upstream_watermarks (dict): upstream table -> latest date (see pretriage/delta_precompute.py)
+            precomputed_at (dict): precomputed table -> when it was built
+    """
+    _create_prediction_watermarks_table(db_engine)
+
+    prediction_date = prediction_date or str(date.today())
+    with db_engine.begin() as conn:
+        for model_id in model_ids:
+            conn.execute(
+                f'''
+                insert into {PREDICTION_WATERMARKS_TABLE} (model_id, as_of_date, prediction_date, upstream_watermarks, precomputed_at)
+                values (%s, %s, %s, %s, %s)
+                on conflict (model_id, as_of_date, prediction_date) do update set
+                    upstream_watermarks = excluded.upstream_watermarks,
+                    precomputed_at = excluded.precomputed_at,
+                    recorded_at = now()
+                ''',
+                (int(model_id), as_of_date, prediction_date, json.dumps(upstream_watermarks), json.dumps(precomputed_at))
+            )
+
+
+def last_prediction_watermarks(db_engine, model_id, as_of_date):
+    """ The upstream watermarks of the last predictions of the model on the as_of_date, None if there are none """
+    if not pd.read_sql(f"select to_regclass('{PREDICTION_WATERMARKS_TABLE}') is not null", db_engine).iloc[0, 0]:
+        return None
+
+    q = f'''
+        select upstream_watermarks::text
+        from {PREDICTION_WATERMARKS_TABLE}
+        where model_id = {model_id} and as_of_date = '{as_of_date}'::date
+        order by recorded_at desc
+        limit 1
+    '''
+    last = pd.read_sql(q, db_engine)
+
+    if last.empty:
+        return None
+
+    return json.loads(last.iloc[0, 0])
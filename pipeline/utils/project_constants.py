@@ -9,3 +9,12 @@ LOGS_PATH = ''
 
 # Where Triage pipline config files are stored
 EXPERIMENT_CONFIG_PATH = f'{CODE_BASEPATH}/src/pipeline/configs'
+
+# Schema for project-side experiment bookkeeping tables (kept next to triage_metadata)
+EXPERIMENT_METADATA_SCHEMA = 'acdhs_experiments'
+
+# Local directory of the model cache (see utils/model_cache.py), not used if empty
+MODEL_CACHE_PATH = ''
+
+# Size over which the least recently used models are removed from the cache
+MODEL_CACHE_SIZE_GB = 50
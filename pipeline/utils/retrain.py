@@ -0,0 +1,460 @@
+"""
+Retraining a model group up to a prediction date, reusing the train matrices already built for it.
+
+triage's Retrainer trains on a single as_of_date (the last one of the retrain split) and builds its features from
+scratch. Here the retrained model is trained on every as_of_date of the training history up to the prediction date
+(the as_of_times of the retrain split, within max_training_history), as the models of the experiment were. The rows of
+the as_of_dates that are already in a train matrix of the model group (the experiment's splits, or an earlier retrain)
+are read from that matrix. Only the newest window (the as_of_dates that are in none of them) gets its precomputed
+tables, labels, cohort, features and imputations built. The rows are stitched into the retrain matrix, which later
+retrains reuse in turn.
+
+A matrix is only reused if it has the same label, label timespan, cohort and feature columns as the model group.
+"""
+import getpass
+import logging
+import os
+import platform
+from datetime import datetime
+
+import pandas as pd
+from triage.component.architect.builders import MatrixBuilder
+from triage.component.architect.entity_date_table_generators import EntityDateTableGenerator
+from triage.component.architect.feature_group_creator import FeatureGroup
+from triage.component.architect.features import FeatureDictionaryCreator, FeatureGroupCreator, FeatureGroupMixer
+from triage.component.architect.label_generators import LabelGenerator
+from triage.component.architect.planner import Planner
+from triage.component.architect.utils import change_datetimes_on_metadata
+from triage.component.catwalk import ModelTrainer
+from triage.component.catwalk.storage import ModelStorageEngine, ProjectStorage
+from triage.component.catwalk.utils import filename_friendly_hash, retrieve_model_hash_from_id, retrieve_experiment_seed_from_run_id
+from triage.component.results_schema import Matrix, Retrain, TriageRun, TriageRunStatus, upgrade_db
+from triage.component.timechop import Timechop
+from triage.predictlist import Retrainer
+from triage.predictlist.utils import (
+    experiment_config_from_model_id,
+    get_model_group_info,
+    train_matrix_info_from_model_id,
+    temporal_params_from_matrix_metadata,
+    cohort_config_from_label_config,
+    get_feature_names,
+    associate_models_with_retrain,
+    save_retrain_and_get_hash,
+)
+from triage.tracking import (
+    infer_git_hash,
+    infer_ec2_instance_type,
+    infer_installed_libraries,
+    infer_python_version,
+    infer_triage_version,
+    infer_log_location,
+    record_cohort_table_name,
+    record_labels_table_name,
+    record_matrix_building_started,
+    record_model_building_started,
+)
+from triage.util.conf import dt_from_str
+from triage.util.db import scoped_session, get_for_update
+from triage.util.introspection import classpath
+
+from pipeline.pretriage.current_eviction_features import generate_current_eviction_features
+from pipeline.pretriage.days_since_features import generate_days_since_features
+from pipeline.pretriage.delta_precompute import DATED_TABLES, record_precomputed_dates, refresh_eviction_aggregates, upstream_watermarks
+from pipeline.pretriage.interval_features import interval_feature_tables, rebuild_interval_feature_tables
+from pipeline.pretriage.static_features import generate_static_features
+from pipeline.utils.precomputed_aggregations import PrecomputedFeatureGenerator
+from pipeline.utils.production_matrices import last_split_model_id
+
+
+def precompute_training_window(db_engine, as_of_dates, feature_aggregations):
+    """ Precompute the pretriage tables of the new as_of_dates of a retrain (the full precompute of predict_forward, for several dates)
+
+        Only the rows of these dates are replaced in the shared tables (the prediction dates of the services and
+        batch are kept), and the dates are recorded in the precompute log
+    """
+    generate_static_features(db_engine)
+    generate_days_since_features(db_engine, as_of_dates)
+    rebuild_interval_feature_tables(db_engine, feature_aggregations, as_of_dates)
+
+    # the as_of_dates are training_as_of_date_frequency apart, not necessarily a month
+    for as_of_date in as_of_dates:
+        generate_current_eviction_features(db_engine, start_date=as_of_date, end_date=as_of_date, append=True)
+
+    refresh_eviction_aggregates(db_engine, upstream_watermarks(db_engine, max(as_of_dates)))
+
+    record_precomputed_dates(db_engine, DATED_TABLES + interval_feature_tables(feature_aggregations), as_of_dates)
+
+
+class MatrixReuseRetrainer(Retrainer):
+    """ triage's Retrainer, training on the whole history up to the prediction date and reusing the rows of the
+        train matrices already built for the model group (see the module docstring)
+
+        Args:
+            db_engine (sqlalchemy.engine)
+            project_path (str)
+            model_group_id (int)
+    """
+
+    def __init__(self, db_engine, project_path, model_group_id):
+        """ triage's Retrainer.__init__, with the last split of the model group being its latest model trained by an
+            experiment. triage takes the latest model of the group, which is the previous retrain's model once the group
+            was retrained, and that model has no test matrix to read the temporal parameters from.
+        """
+        self.retrain_hash = None
+        self.db_engine = db_engine
+        upgrade_db(db_engine=self.db_engine)
+        self.project_storage = ProjectStorage(project_path)
+        self.model_group_id = model_group_id
+        self.model_group_info = dict(
+            get_model_group_info(self.db_engine, self.model_group_id),
+            model_id_last_split=last_split_model_id(self.db_engine, self.model_group_id)
+        )
+        self.matrix_storage_engine = self.project_storage.matrix_storage_engine()
+
+        model_id_last_split = self.model_group_info['model_id_last_split']
+        self.triage_run_id = int(pd.read_sql(
+            f'select built_in_triage_run from triage_metadata.models where model_id = {model_id_last_split}',
+            self.db_engine
+        ).iloc[0, 0])
+        self.experiment_config = experiment_config_from_model_id(self.db_engine, model_id_last_split)
+        self.experiment_config['temporal_config'].update(temporal_params_from_matrix_metadata(self.db_engine, model_id_last_split))
+        # the "test" of a retrained model is predicting forward to a single date
+        self.experiment_config['temporal_config']['test_durations'] = ['0day']
+
+        self.training_label_timespan = self.experiment_config['temporal_config']['training_label_timespans'][0]
+        self.test_label_timespan = self.experiment_config['temporal_config']['test_label_timespans'][0]
+        self.test_duration = self.experiment_config['temporal_config']['test_durations'][0]
+        self.feature_start_time = self.experiment_config['temporal_config']['feature_start_time']
+
+        if self.experiment_config.get('cohort_config') is None:
+            self.experiment_config['cohort_config'] = cohort_config_from_label_config(self.experiment_config['label_config'])
+
+        self.label_name = self.experiment_config['label_config']['name']
+        self.cohort_name = self.experiment_config.get('cohort_config', {}).get('name', 'default')
+        self.user_metadata = self.experiment_config.get('user_metadata', {})
+
+        self.feature_dictionary_creator = FeatureDictionaryCreator(features_schema_name='triage_production', db_engine=self.db_engine)
+        self.label_generator = LabelGenerator(
+            label_name=self.experiment_config['label_config'].get('name', None),
+            query=self.experiment_config['label_config']['query'],
+            replace=True,
+            db_engine=self.db_engine,
+        )
+        self.labels_table_name = "labels_{}_{}_production".format(
+            self.experiment_config['label_config'].get('name', 'default'),
+            filename_friendly_hash(self.experiment_config['label_config']['query'])
+        )
+        self.feature_generator = PrecomputedFeatureGenerator(
+            db_engine=self.db_engine,
+            features_schema_name='triage_production',
+            feature_start_time=self.feature_start_time,
+        )
+        self.model_trainer = ModelTrainer(
+            experiment_hash=None,
+            model_storage_engine=ModelStorageEngine(self.project_storage),
+            db_engine=self.db_engine,
+            replace=True,
+            run_id=self.triage_run_id,
+        )
+
+    def _start_run(self):
+        """ The TriageRun of the retrain, as triage's Retrainer records it """
+        run = TriageRun(
+            start_time=datetime.now(),
+            git_hash=infer_git_hash(),
+            triage_version=infer_triage_version(),
+            python_version=infer_python_version(),
+            run_type="retrain",
+            run_hash=self.retrain_hash,
+            last_updated_time=datetime.now(),
+            current_status=TriageRunStatus.started,
+            installed_libraries=infer_installed_libraries(),
+            platform=platform.platform(),
+            os_user=getpass.getuser(),
+            working_directory=os.getcwd(),
+            ec2_instance_type=infer_ec2_instance_type(),
+            log_location=infer_log_location(),
+            experiment_class_path=classpath(self.__class__),
+            random_seed=retrieve_experiment_seed_from_run_id(self.db_engine, self.triage_run_id),
+        )
+        with scoped_session(self.db_engine) as session:
+            session.add(run)
+            session.commit()
+            run_id = run.run_id
+
+        if not run_id:
+            raise ValueError("Failed to retrieve run_id from saved row")
+
+        return run_id
+
+    def _feature_dictionary(self, collate_aggregations, matrix_metadata):
+        """ The feature columns of the model group (of its last split's train matrix), by feature table """
+        feature_dictionary = FeatureGroup()
+        for aggregation in collate_aggregations:
+            feature_group, feature_names = get_feature_names(aggregation, matrix_metadata)
+            feature_dictionary[feature_group] = feature_names
+
+        feature_group_creator = FeatureGroupCreator(self.experiment_config['feature_group_definition'])
+        return FeatureGroupMixer(["all"]).generate(feature_group_creator.subsets(feature_dictionary))[0]
+
+    def _is_reusable(self, matrix_store, feature_names):
+        metadata = matrix_store.metadata
+        return (
+            metadata.get('label_name') == self.label_name
+            and metadata.get('label_timespan') == self.training_label_timespan
+            and metadata.get('cohort_name') == self.cohort_name
+            and set(matrix_store.columns()) == set(feature_names)
+        )
+
+    def reusable_rows(self, as_of_dates, feature_names):
+        """ The rows of the as_of_dates that are in a train matrix of the model group (the most recent matrices first)
+
+            Returns:
+                (list) (design matrix, labels) of the reused rows of every matrix they are read from
+                (set) the as_of_dates that are in none of them
+        """
+        q = f'''
+            select train_matrix_uuid
+            from triage_metadata.models
+            where model_group_id = {self.model_group_id}
+            group by train_matrix_uuid
+            order by max(train_end_time) desc
+        '''
+        train_matrix_uuids = pd.read_sql(q, self.db_engine).train_matrix_uuid.tolist()
+
+        missing = set(as_of_dates)
+        reused = list()
+        for matrix_uuid in train_matrix_uuids:
+            if not missing:
+                break
+
+            matrix_store = self.matrix_storage_engine.get_store(matrix_uuid)
+            if not matrix_store.exists or not self._is_reusable(matrix_store, feature_names):
+                continue
+
+            dates = missing & set(pd.to_datetime(matrix_store.metadata['as_of_times']).date)
+            if not dates:
+                continue
+
+            design_matrix, labels = matrix_store.matrix_label_tuple
+            rows = design_matrix.index.get_level_values('as_of_date').isin(pd.to_datetime(sorted(dates)))
+            reused.append((design_matrix.loc[rows, feature_names], labels.loc[rows]))
+            missing -= dates
+
+            logging.info(f'Reusing {rows.sum()} rows of {len(dates)} as_of_dates from the train matrix {matrix_uuid}')
+
+        return reused, missing
+
+    def build_window(self, as_of_dates, run_id, matrix_definition, feature_dictionary):
+        """ Build the labels, cohort, features and imputations of the new as_of_dates, and their train matrix
+
+            Returns:
+                (design matrix, labels) of the new rows
+        """
+        logging.info(f'Building the features of the {len(as_of_dates)} new as_of_dates: {as_of_dates}')
+        precompute_training_window(self.db_engine, as_of_dates, self.experiment_config['feature_aggregations'])
+
+        self.label_generator.generate_all_labels(
+            labels_table=self.labels_table_name,
+            as_of_dates=as_of_dates,
+            label_timespans=[self.training_label_timespan]
+        )
+        record_labels_table_name(run_id, self.db_engine, self.labels_table_name)
+
+        cohort_table_name = f"triage_production.cohort_{self.cohort_name}_retrain"
+        EntityDateTableGenerator(
+            db_engine=self.db_engine,
+            query=self.experiment_config['cohort_config'].get('query'),
+            labels_table_name=self.labels_table_name,
+            entity_date_table_name=cohort_table_name
+        ).generate_entity_date_table(as_of_dates=[dt_from_str(d) for d in as_of_dates])
+        record_cohort_table_name(run_id, self.db_engine, cohort_table_name)
+
+        collate_aggregations = self.feature_generator.aggregations(
+            feature_aggregation_config=self.experiment_config['feature_aggregations'],
+            feature_dates=as_of_dates,
+            state_table=cohort_table_name
+        )
+        self.feature_generator.process_table_tasks(
+            self.feature_generator.generate_all_table_tasks(collate_aggregations, task_type='aggregation')
+        )
+        _, imputation_table_tasks = self.get_feature_dict_and_imputation_task(collate_aggregations, self.model_group_info['model_id_last_split'])
+        self.feature_generator.process_table_tasks(imputation_table_tasks)
+
+        window_definition = dict(matrix_definition, as_of_times=as_of_dates, first_as_of_time=min(as_of_dates))
+        metadata = Planner.make_metadata(
+            matrix_definition=window_definition,
+            feature_dictionary=feature_dictionary,
+            label_name=self.label_name,
+            label_type='binary',
+            cohort_name=self.cohort_name,
+            matrix_type='train',
+            feature_start_time=dt_from_str(self.feature_start_time),
+            user_metadata=self.user_metadata,
+        )
+        metadata['matrix_id'] = '_'.join([self.label_name, 'binary', max(as_of_dates), 'retrain_window'])
+        matrix_uuid = filename_friendly_hash(metadata)
+
+        MatrixBuilder(
+            db_config={
+                "features_schema_name": "triage_production",
+                "labels_schema_name": "public",
+                "cohort_table_name": cohort_table_name,
+                "labels_table_name": self.labels_table_name,
+            },
+            matrix_storage_engine=self.matrix_storage_engine,
+            engine=self.db_engine,
+            experiment_hash=None,
+            replace=True,
+        ).build_matrix(
+            as_of_times=as_of_dates,
+            label_name=self.label_name,
+            label_type='binary',
+            feature_dictionary=feature_dictionary,
+            matrix_metadata=metadata,
+            matrix_uuid=matrix_uuid,
+            matrix_type='train',
+        )
+
+        return self.matrix_storage_engine.get_store(matrix_uuid).matrix_label_tuple
+
+    def save_matrix(self, design_matrix, labels, metadata, feature_dictionary):
+        """ Store the stitched train matrix and record it in triage_metadata.matrices, as MatrixBuilder does """
+        matrix_uuid = filename_friendly_hash(metadata)
+        matrix_store = self.matrix_storage_engine.get_store(matrix_uuid)
+        matrix_store.metadata = metadata
+        matrix_store.matrix_label_tuple = design_matrix, labels
+        matrix_store.save_matrix_metadata()
+        matrix_store.save()
+
+        matrix = Matrix(
+            matrix_id=metadata['matrix_id'],
+            matrix_uuid=matrix_uuid,
+            matrix_type='train',
+            labeling_window=metadata['label_timespan'],
+            num_observations=len(design_matrix),
+            lookback_duration=metadata['max_training_history'],
+            feature_start_time=metadata['feature_start_time'],
+            feature_dictionary=feature_dictionary,
+            matrix_metadata=change_datetimes_on_metadata(metadata),
+            built_by_experiment=None,
+        )
+        with scoped_session(self.db_engine) as session:
+            session.merge(matrix)
+            session.commit()
+
+        return matrix_uuid
+
+    def retrain(self, prediction_date):
+        """ Retrain the model group on its training history up to the prediction date
+
+            Args:
+                prediction_date (str): 'YYYY-MM-DD'
+
+            Returns:
+                (dict) the retrain_model_comment and retrain_model_id, as triage's Retrainer
+        """
+        retrain_config = {
+            "model_group_id": self.model_group_id,
+            "prediction_date": prediction_date,
+            "test_label_timespan": self.test_label_timespan,
+            "test_duration": self.test_duration,
+        }
+        self.retrain_hash = save_retrain_and_get_hash(retrain_config, self.db_engine)
+        with get_for_update(self.db_engine, Retrain, self.retrain_hash) as retrain:
+            retrain.prediction_date = prediction_date
+
+        chops = Timechop(**self.get_temporal_config_for_retrain(dt_from_str(prediction_date))).chop_time()
+        if len(chops) != 1:
+            raise ValueError(f'Expected a single retrain split up to {prediction_date}, got {len(chops)}')
+
+        train_split = chops[0]['train_matrix']
+        as_of_dates = [datetime.strftime(d, "%Y-%m-%d") for d in sorted(train_split['as_of_times'])]
+        matrix_definition = {
+            'first_as_of_time': str(train_split['first_as_of_time']),
+            'last_as_of_time': str(train_split['last_as_of_time']),
+            'matrix_info_end_time': str(train_split['matrix_info_end_time']),
+            'as_of_times': as_of_dates,
+            'training_label_timespan': train_split['training_label_timespan'],
+            'max_training_history': train_split['max_training_history'],
+            'training_as_of_date_frequency': train_split['training_as_of_date_frequency'],
+        }
+        logging.info(f'Retraining model group {self.model_group_id} on {len(as_of_dates)} as_of_dates, {as_of_dates[0]} to {as_of_dates[-1]}')
+
+        run_id = self._start_run()
+        self.model_trainer.run_id = run_id
+        self.model_trainer.experiment_hash = self.retrain_hash
+
+        last_split_matrix_uuid, last_split_metadata = train_matrix_info_from_model_id(self.db_engine, self.model_group_info['model_id_last_split'])
+        collate_aggregations = self.feature_generator.aggregations(
+            feature_aggregation_config=self.experiment_config['feature_aggregations'],
+            feature_dates=as_of_dates,
+            state_table=f"triage_production.cohort_{self.cohort_name}_retrain"
+        )
+        feature_dictionary = self._feature_dictionary(collate_aggregations, last_split_metadata)
+        feature_names = [feature for features in feature_dictionary.values() for feature in features]
+
+        # 1. The rows of the history that are already in a matrix, and the new window
+        record_matrix_building_started(run_id, self.db_engine)
+        parts, new_dates = self.reusable_rows([dt_from_str(d).date() for d in as_of_dates], feature_names)
+        if new_dates:
+            design_matrix, labels = self.build_window(sorted(str(d) for d in new_dates), run_id, matrix_definition, feature_dictionary)
+            parts.append((design_matrix[feature_names], labels))
+
+        design_matrix = pd.concat([part[0] for part in parts]).sort_index()
+        labels = pd.concat([part[1] for part in parts]).loc[design_matrix.index]
+        logging.info(f'Retrain matrix of {len(design_matrix)} rows, {len(new_dates)} of {len(as_of_dates)} as_of_dates built')
+
+        # 2. The stitched matrix, with the metadata triage's Retrainer gives its (single date) matrix
+        metadata = Planner.make_metadata(
+            matrix_definition=matrix_definition,
+            feature_dictionary=feature_dictionary,
+            label_name=self.label_name,
+            label_type='binary',
+            cohort_name=self.cohort_name,
+            matrix_type='train',
+            feature_start_time=dt_from_str(self.feature_start_time),
+            user_metadata=self.user_metadata,
+        )
+        metadata['matrix_id'] = '_'.join([self.label_name, 'binary', as_of_dates[-1], 'retrain'])
+        matrix_uuid = self.save_matrix(design_matrix, labels, metadata, feature_dictionary)
+
+        # 3. Train the model group's model on it
+        random_seed = self.model_trainer.get_or_generate_random_seed(
+            model_group_id=self.model_group_id,
+            matrix_metadata=last_split_metadata,
+            train_matrix_uuid=last_split_matrix_uuid
+        )
+        retrain_model_hash = self.model_trainer._model_hash(
+            self.matrix_storage_engine.get_store(matrix_uuid).metadata,
+            class_path=self.model_group_info['model_type'],
+            parameters=self.model_group_info['hyperparameters'],
+            random_seed=random_seed,
+        )
+        associate_models_with_retrain(self.retrain_hash, (retrain_model_hash, ), self.db_engine)
+
+        retrain_model_comment = 'retrain_' + str(datetime.now())
+        record_model_building_started(run_id, self.db_engine)
+        retrain_model_id = self.model_trainer.process_train_task(
+            matrix_store=self.matrix_storage_engine.get_store(matrix_uuid),
+            class_path=self.model_group_info['model_type'],
+            parameters=self.model_group_info['hyperparameters'],
+            model_hash=retrain_model_hash,
+            misc_db_parameters={
+                'train_end_time': dt_from_str(as_of_dates[-1]),
+                'test': False,
+                'train_matrix_uuid': matrix_uuid,
+                'training_label_timespan': self.training_label_timespan,
+                'model_comment': retrain_model_comment,
+            },
+            random_seed=random_seed,
+            retrain=True,
+            model_group_id=self.model_group_id
+        )
+
+        self.retrain_model_hash = retrieve_model_hash_from_id(self.db_engine, retrain_model_id)
+        self.retrain_matrix_uuid = matrix_uuid
+        self.retrain_model_id = retrain_model_id
+        logging.info(f'Retrained model group {self.model_group_id} up to {prediction_date}: model {retrain_model_id}')
+
+        return {'retrain_model_comment': retrain_model_comment, 'retrain_model_id': retrain_model_id}
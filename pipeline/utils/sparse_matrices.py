@@ -0,0 +1,214 @@
+"""
+Keeping the mostly-zero columns of the matrices sparse.
+
+The categorical feature groups (diagnosis codes, zip codes, cities, courts, landlords, ...) produce
+hundreds of columns that are almost all zeros. SparseArrowMatrixStore stores those columns as a CSR
+matrix next to a feather file with the dense columns, and loads them as pandas sparse columns.
+The wrapped estimators (see wrapped_estimators.py, sparse_input) hand them to the estimator as CSR.
+"""
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from pipeline.utils.arrow_matrix_store import ArrowMatrixStore, write_feather_matrix
+from pipeline.utils.project_constants import EXPERIMENT_METADATA_SCHEMA
+
+
+SPARSE_SUFFIX = 'sparse.npz'
+
+
+def to_csr(X):
+    """ A CSR float32 matrix from a DataFrame with dense and sparse columns (or from an array), in the same column order """
+    if not isinstance(X, pd.DataFrame):
+        return sparse.csr_matrix(X, dtype=np.float32)
+
+    is_sparse = np.array([isinstance(dtype, pd.SparseDtype) for dtype in X.dtypes])
+    parts, order = list(), list()
+
+    if is_sparse.any():
+        parts.append(X.loc[:, is_sparse].sparse.to_coo().astype(np.float32))
+        order.extend(np.flatnonzero(is_sparse))
+    if not is_sparse.all():
+        parts.append(sparse.csr_matrix(X.loc[:, ~is_sparse].to_numpy(dtype=np.float32)))
+        order.extend(np.flatnonzero(~is_sparse))
+
+    # back to the column order of X
+    csr = sparse.hstack(parts, format='csr')
+    return csr[:, np.argsort(order)]
+
+
+def feature_group_of(column):
+    """ The feature group (prefix) of a triage feature column, e.g. bh_entity_id_1year_... -> bh """
+    if '_entity_id_' in column:
+        return column.split('_entity_id_')[0]
+    return column.split('_')[0]
+
+
+class SparseArrowMatrixStore(ArrowMatrixStore):
+    """ ArrowMatrixStore that keeps the columns with at least `sparse_zero_fraction` zeros as CSR
+
+        The dense columns are in <uuid>.dense.feather (memory-mapped like ArrowMatrixStore) and the
+        sparse ones in <uuid>.sparse.npz, with the full column order.
+    """
+
+    converted_suffix = 'dense.feather'
+    sparse_zero_fraction = 0.9
+
+    @property
+    def sparse_path(self):
+        if self.feather_path is None:
+            return None
+        return self.feather_path[:-len(self.converted_suffix)] + SPARSE_SUFFIX
+
+    def converted_paths(self):
+        return [self.feather_path, self.sparse_path]
+
+    def _feather_is_fresh(self):
+        return super()._feather_is_fresh() and os.path.exists(self.sparse_path)
+
+    def _write_converted(self, df, compression):
+        label_name = self.metadata['label_name']
+        features = [column for column in df.columns if column != label_name]
+
+        zero_fraction = (df[features] == 0).mean()
+        sparse_columns = zero_fraction[zero_fraction >= self.sparse_zero_fraction].index.tolist()
+
+        csr = sparse.csc_matrix(df[sparse_columns].to_numpy(dtype=np.float32)).tocsr()
+        tmp_path = f'{self.sparse_path}.{os.getpid()}.tmp.npz'
+        np.savez(
+            tmp_path,
+            data=csr.data,
+            indices=csr.indices,
+            indptr=csr.indptr,
+            shape=csr.shape,
+            sparse_columns=np.array(sparse_columns, dtype=str),
+            columns=np.array(df.columns.tolist(), dtype=str),
+        )
+        os.replace(tmp_path, self.sparse_path)
+
+        # written last, the freshness of the feather file covers both files
+        write_feather_matrix(df.drop(columns=sparse_columns), self.feather_path, compression=compression)
+
+        logging.info(f'Matrix {self.matrix_uuid}: {len(sparse_columns)} of {len(features)} columns stored sparse ({csr.nnz} non-zeros)')
+
+    def _read_converted(self, n_rows=None):
+        dense = self._read_feather(n_rows)
+
+        with np.load(self.sparse_path) as npz:
+            csr = sparse.csr_matrix((npz['data'], npz['indices'], npz['indptr']), shape=tuple(npz['shape']))
+            sparse_columns = npz['sparse_columns'].tolist()
+            columns = npz['columns'].tolist()
+
+        if n_rows is not None:
+            csr = csr[:n_rows]
+
+        sparse_df = pd.DataFrame.sparse.from_spmatrix(csr, index=dense.index, columns=sparse_columns)
+
+        return pd.concat([dense, sparse_df], axis=1)[columns]
+
+
+def _create_sparse_savings_table(db_engine, schema=EXPERIMENT_METADATA_SCHEMA):
+    q = f'''
+        create schema if not exists {schema};
+
+        create table if not exists {schema}.sparse_matrix_savings (
+            matrix_uuid varchar,
+            feature_group varchar,
+            rows int,
+            n_columns int,
+            n_sparse_columns int,
+            nnz bigint,
+            dense_bytes bigint,
+            sparse_bytes bigint,
+            recorded_at timestamp default now()
+        );
+    '''
+
+    with db_engine.begin() as conn:
+        conn.execute(q)
+
+
+def sparse_savings(store):
+    """ Bytes of the sparse columns of a converted matrix per feature group, stored dense (float32) and as CSR
+
+        The numbers hold in memory and on disk (the files are uncompressed by default)
+
+        Returns:
+            pd.DataFrame with one row per feature group
+    """
+    with np.load(store.sparse_path) as npz:
+        csr = sparse.csr_matrix((npz['data'], npz['indices'], npz['indptr']), shape=tuple(npz['shape']))
+        sparse_columns = npz['sparse_columns'].tolist()
+        columns = npz['columns'].tolist()
+
+    label_name = store.metadata['label_name']
+    nnz_per_column = np.diff(csr.tocsc().indptr)
+    n_rows = csr.shape[0]
+
+    groups = pd.DataFrame({'column': [c for c in columns if c != label_name]})
+    groups['feature_group'] = groups.column.apply(feature_group_of)
+    groups = groups.merge(
+        pd.DataFrame({'column': sparse_columns, 'nnz': nnz_per_column, 'is_sparse': True}),
+        on='column',
+        how='left'
+    ).fillna({'nnz': 0, 'is_sparse': False}).astype({'is_sparse': bool})
+
+    savings = groups.groupby('feature_group').agg(
+        n_columns=('column', 'count'),
+        n_sparse_columns=('is_sparse', 'sum'),
+        nnz=('nnz', 'sum'),
+    ).reset_index()
+    savings['rows'] = n_rows
+    savings['dense_bytes'] = n_rows * savings.n_sparse_columns * 4
+    # float32 values and int32 column indices (the row pointers are shared by the groups)
+    savings['sparse_bytes'] = savings.nnz * 8
+    savings['matrix_uuid'] = store.matrix_uuid
+
+    return savings
+
+
+def report_sparse_savings(db_engine, matrix_storage_engine, matrix_uuids):
+    """ Record the memory/disk savings of the sparse columns per matrix and feature group
+
+        Args:
+            db_engine: SQLAlchemy engine
+            matrix_storage_engine: the experiment's matrix storage engine (with SparseArrowMatrixStore)
+            matrix_uuids (list): the matrices to report on. Matrices that were not loaded yet (so not converted) are skipped
+
+        Returns:
+            pd.DataFrame the savings per feature group, summed over the matrices
+    """
+    savings = list()
+    for matrix_uuid in matrix_uuids:
+        store = matrix_storage_engine.get_store(matrix_uuid)
+        if not isinstance(store, SparseArrowMatrixStore) or not store._feather_is_fresh():
+            continue
+        savings.append(sparse_savings(store))
+
+    if not savings:
+        logging.warning('No sparse matrices to report on')
+        return pd.DataFrame()
+
+    savings = pd.concat(savings)
+
+    _create_sparse_savings_table(db_engine)
+    with db_engine.begin() as conn:
+        savings.to_sql(
+            'sparse_matrix_savings',
+            conn,
+            schema=EXPERIMENT_METADATA_SCHEMA,
+            if_exists='append',
+            index=False
+        )
+
+    totals = savings.groupby('feature_group')[['n_sparse_columns', 'dense_bytes', 'sparse_bytes']].sum()
+    for feature_group, row in totals[totals.n_sparse_columns > 0].sort_values('dense_bytes', ascending=False).iterrows():
+        logging.info(
+            f'Sparse columns of {feature_group}: {row.dense_bytes / 1e6:.1f} MB dense, '
+            f'{row.sparse_bytes / 1e6:.1f} MB as CSR over {savings.matrix_uuid.nunique()} matrices'
+        )
+
+    return totals
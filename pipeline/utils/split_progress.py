@@ -0,0 +1,190 @@
+"""
+Running the time splits of an experiment newest first, with a progress table that can be queried while it runs.
+
+triage builds every matrix and then trains the splits in order, so the performance on the recent
+periods is only known at the very end. Here the database steps (labels, cohort, features) run first,
+and then every split, newest first, gets its matrices built and its models trained, tested and
+evaluated before the next one starts. Evaluations are written by triage as each model completes,
+and every split is recorded in acdhs_experiments.split_progress when it starts and when it is done.
+
+While the experiment runs (or after it was stopped):
+
+    python -m pipeline.utils.split_progress -e <experiment_hash>
+"""
+import argparse
+import logging
+
+import pandas as pd
+
+from triage.component.catwalk.utils import associate_matrices_with_experiment
+from triage.tracking import record_matrix_building_started
+
+from pipeline.utils.grid_pruning import train_and_test_splits
+from pipeline.utils.project_constants import EXPERIMENT_METADATA_SCHEMA
+from pipeline.utils.utils import get_db_engine
+
+
+def _create_split_progress_table(db_engine, schema=EXPERIMENT_METADATA_SCHEMA):
+    q = f'''
+        create schema if not exists {schema};
+
+        create table if not exists {schema}.split_progress (
+            experiment_hash varchar,
+            run_id int,
+            split_number int,
+            train_end_time timestamp,
+            status varchar,
+            n_train_test_tasks int,
+            started_at timestamp default now(),
+            finished_at timestamp,
+            primary key (experiment_hash, run_id, split_number)
+        );
+    '''
+
+    with db_engine.begin() as conn:
+        conn.execute(q)
+
+
+def _record_split_started(db_engine, experiment, split_number, train_end_time):
+    with db_engine.begin() as conn:
+        conn.execute(
+            f'''
+            insert into {EXPERIMENT_METADATA_SCHEMA}.split_progress (experiment_hash, run_id, split_number, train_end_time, status)
+            values (%s, %s, %s, %s, 'running')
+            on conflict (experiment_hash, run_id, split_number) do update
+            set status = 'running', started_at = now(), finished_at = null
+            ''',
+            (experiment.experiment_hash, experiment.run_id, split_number, train_end_time)
+        )
+
+
+def _record_split_done(db_engine, experiment, split_number, n_tasks):
+    with db_engine.begin() as conn:
+        conn.execute(
+            f'''
+            update {EXPERIMENT_METADATA_SCHEMA}.split_progress
+            set status = 'done', n_train_test_tasks = %s, finished_at = now()
+            where experiment_hash = %s and run_id = %s and split_number = %s
+            ''',
+            (n_tasks, experiment.experiment_hash, experiment.run_id, split_number)
+        )
+
+
+def run_experiment_newest_first(experiment):
+    """ Run a triage experiment one time split at a time, newest first
+
+        Each split's matrices are built right before its models are trained, so the first results
+        (of the most recent period) are available after one split instead of after the whole grid.
+        Split 0 is the newest split in acdhs_experiments.split_progress.
+
+        Args:
+            experiment: triage experiment (SingleThreadedExperiment or MultiCoreExperiment)
+    """
+    db_engine = experiment.db_engine
+    _create_split_progress_table(db_engine)
+
+    experiment.generate_labels()
+    experiment.generate_cohort()
+    experiment.generate_preimputation_features()
+    experiment.impute_missing_features()
+
+    matrix_build_tasks = experiment.matrix_build_tasks
+    associate_matrices_with_experiment(experiment.experiment_hash, matrix_build_tasks.keys(), db_engine)
+    record_matrix_building_started(experiment.run_id, db_engine)
+
+    experiment.generate_subsets()
+    experiment.generate_protected_groups()
+
+    splits = sorted(experiment.full_matrix_definitions, key=lambda s: s['train_matrix']['matrix_info_end_time'], reverse=True)
+    built = set()
+    for split_number, split in enumerate(splits):
+        train_end_time = split['train_matrix']['matrix_info_end_time']
+        logging.info(f'Newest first: split {split_number + 1} of {len(splits)}, training up to {train_end_time}')
+        _record_split_started(db_engine, experiment, split_number, train_end_time)
+
+        uuids = [uuid for uuid in [split['train_uuid']] + list(split['test_uuids']) if uuid in matrix_build_tasks and uuid not in built]
+        experiment.process_matrix_build_tasks({uuid: matrix_build_tasks[uuid] for uuid in uuids})
+        built.update(uuids)
+
+        n_tasks = train_and_test_splits(experiment, [split])
+        _record_split_done(db_engine, experiment, split_number, n_tasks)
+
+    # as at the end of experiment.run()
+    experiment._summary_report()
+    experiment._log_end_of_run_report()
+
+
+def split_progress(db_engine, experiment_hash, metric='precision@', parameter='100_abs', run_id=None):
+    """ The progress of the latest (or given) newest-first run of an experiment, one row per split
+
+        Returns:
+            pd.DataFrame with the status of every split, the number of models evaluated on it and the
+            best and median value of the metric, with the model group of the best one
+    """
+    run_filter = f'and p.run_id = {run_id}' if run_id is not None else f'''
+        and p.run_id = (select max(run_id) from {EXPERIMENT_METADATA_SCHEMA}.split_progress where experiment_hash = '{experiment_hash}')
+    '''
+
+    q = f"""
+        with experiment_models as (
+            select m.model_id, m.model_group_id, m.train_end_time
+            from triage_metadata.experiment_models em
+                join triage_metadata.models m using(model_hash)
+            where em.experiment_hash = '{experiment_hash}'
+        )
+        select
+            p.split_number,
+            p.train_end_time,
+            p.status,
+            p.started_at,
+            p.finished_at,
+            count(distinct e.model_id) as models_evaluated,
+            max(e.stochastic_value) as best_value,
+            percentile_cont(0.5) within group (order by e.stochastic_value) as median_value,
+            (array_agg(m.model_group_id order by e.stochastic_value desc nulls last))[1] as best_model_group_id
+        from {EXPERIMENT_METADATA_SCHEMA}.split_progress p
+            left join experiment_models m on m.train_end_time = p.train_end_time
+            left join test_results.evaluations e
+                on e.model_id = m.model_id
+                and e.metric = '{metric}'
+                and e.parameter = '{parameter}'
+                and coalesce(e.subset_hash, '') = ''
+        where p.experiment_hash = '{experiment_hash}'
+        {run_filter}
+        group by 1, 2, 3, 4, 5
+        order by p.split_number
+    """
+
+    return pd.read_sql(q, db_engine)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Progress of an experiment run newest split first (run.py --newest-first)")
+
+    parser.add_argument(
+        "-e",
+        "--experiment-hash",
+        type=str,
+        help='Experiment hash',
+        required=True
+    )
+
+    parser.add_argument(
+        "--metric",
+        type=str,
+        default='precision@',
+        help='Metric to summarize per split'
+    )
+
+    parser.add_argument(
+        "--parameter",
+        type=str,
+        default='100_abs',
+        help='Parameter of the metric'
+    )
+
+    args = parser.parse_args()
+
+    with pd.option_context('display.width', 200):
+        print(split_progress(get_db_engine(), args.experiment_hash, metric=args.metric, parameter=args.parameter))
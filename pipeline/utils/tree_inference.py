@@ -0,0 +1,305 @@
+"""
+Scoring scikit-learn tree ensembles (random forests, extra trees, decision trees) from packed numpy arrays.
+
+A fitted forest is thousands of Tree objects, and predict_proba walks them one at a time, allocating an
+(n_rows, n_classes) array per tree. Here all the nodes of all the trees are packed into a handful of flat
+arrays (feature, threshold, children, positive class probability of the leaves), and a chunk of trees is
+walked at once for all the rows, one tree level per step. The packed forest is a few arrays instead of a
+pickle of Python objects, and is stored in a compact format (see compact_models.py).
+
+LightGBM and XGBoost already score with their own native code and are left as they are.
+
+A compiled model is only kept if its scores match the original model's on the model's test matrix
+(within a tolerance) and it scores that matrix faster than the original. Walking a deep forest level by level
+in numpy can be several times slower than scikit-learn's compiled predict_proba, and predict_forward (and the
+scoring service) use the compiled form of a model whenever there is one:
+
+    python -m pipeline.utils.tree_inference -m <model_id> [<model_id> ...]
+"""
+import argparse
+import copy
+import logging
+import time
+
+import numpy as np
+import scipy.sparse
+from triage.component.catwalk.storage import ProjectStorage
+from triage.component.catwalk.utils import retrieve_model_hash_from_id
+from triage.predictlist.utils import train_matrix_info_from_model_id, test_matrix_info_from_model_id
+
+from pipeline.utils.model_cache import model_storage_engine
+from pipeline.utils.project_constants import PROJECT_PATH
+from pipeline.utils.utils import get_db_engine
+from pipeline.utils.wrapped_estimators import WrappedClassifier
+
+
+COMPILED_MODEL_DIRECTORY = 'compiled_models'
+
+# the default tolerance of the check against the original scores
+DEFAULT_TOLERANCE = 1e-6
+
+
+class PackedForest:
+    """ The trees of a fitted scikit-learn forest (or a single tree) as flat arrays, with the estimator's predict_proba
+
+        Node i of the packed forest splits on feature[i] <= threshold[i] (feature -1 for the leaves), and its children
+        are left[i] and right[i]. tree_roots has the first node of every tree, and value the probability of the
+        positive class at the leaves.
+    """
+
+    # trees walked together, the node array is (n_rows, chunk_size)
+    chunk_size = 256
+
+    def __init__(self, feature, threshold, left, right, value, tree_roots, classes, n_features_in, missing_go_to_left=None):
+        self.feature = feature
+        self.threshold = threshold
+        self.left = left
+        self.right = right
+        self.value = value
+        self.tree_roots = tree_roots
+        self.classes_ = classes
+        self.n_features_in_ = n_features_in
+        self.missing_go_to_left = missing_go_to_left
+
+    @property
+    def n_trees(self):
+        return len(self.tree_roots)
+
+    @property
+    def n_nodes(self):
+        return len(self.feature)
+
+    @property
+    def arrays(self):
+        """ The packed arrays by name (the attributes of the constructor) """
+        arrays = {
+            'feature': self.feature,
+            'threshold': self.threshold,
+            'left': self.left,
+            'right': self.right,
+            'value': self.value,
+            'tree_roots': self.tree_roots,
+            'classes': self.classes_,
+        }
+        if self.missing_go_to_left is not None:
+            arrays['missing_go_to_left'] = self.missing_go_to_left
+        return arrays
+
+    @classmethod
+    def from_estimator(cls, estimator):
+        """ Pack a fitted RandomForestClassifier, ExtraTreesClassifier or DecisionTreeClassifier (binary) """
+        trees = [t.tree_ for t in estimator.estimators_] if hasattr(estimator, 'estimators_') else [estimator.tree_]
+        if len(estimator.classes_) != 2:
+            raise ValueError(f'Only binary classifiers can be packed, {type(estimator).__name__} has {len(estimator.classes_)} classes')
+
+        offsets = np.cumsum([0] + [tree.node_count for tree in trees])
+        features, thresholds, lefts, rights, values, missing = [], [], [], [], [], []
+        for offset, tree in zip(offsets, trees):
+            is_leaf = tree.children_left == -1
+            features.append(np.where(is_leaf, -1, tree.feature).astype(np.int32))
+            thresholds.append(tree.threshold.astype(np.float64))
+            # the leaves point to themselves, so a walk that reached a leaf stays there
+            nodes = np.arange(tree.node_count)
+            lefts.append((np.where(is_leaf, nodes, tree.children_left) + offset).astype(np.int32))
+            rights.append((np.where(is_leaf, nodes, tree.children_right) + offset).astype(np.int32))
+            # the class counts (or fractions, depending on the scikit-learn version) of the leaves
+            counts = tree.value[:, 0, :]
+            values.append((counts[:, 1] / counts.sum(axis=1)).astype(np.float64))
+            if hasattr(tree, 'missing_go_to_left'):
+                missing.append(tree.missing_go_to_left.astype(bool))
+
+        return cls(
+            feature=np.concatenate(features),
+            threshold=np.concatenate(thresholds),
+            left=np.concatenate(lefts),
+            right=np.concatenate(rights),
+            value=np.concatenate(values),
+            tree_roots=offsets[:-1].astype(np.int32),
+            classes=np.asarray(estimator.classes_),
+            n_features_in=estimator.n_features_in_,
+            missing_go_to_left=np.concatenate(missing) if len(missing) == len(trees) else None,
+        )
+
+    def _positive_proba(self, X):
+        n_rows = X.shape[0]
+        rows = np.arange(n_rows)[:, None]
+        total = np.zeros(n_rows, dtype=np.float64)
+
+        for start in range(0, self.n_trees, self.chunk_size):
+            nodes = np.broadcast_to(self.tree_roots[start:start + self.chunk_size], (n_rows, len(self.tree_roots[start:start + self.chunk_size]))).copy()
+            while True:
+                feature = self.feature[nodes]
+                internal = feature >= 0
+                if not internal.any():
+                    break
+
+                x = X[rows, np.where(internal, feature, 0)]
+                go_left = x <= self.threshold[nodes]
+                if self.missing_go_to_left is not None:
+                    go_left |= np.isnan(x) & self.missing_go_to_left[nodes]
+
+                nodes = np.where(go_left, self.left[nodes], self.right[nodes])
+
+            total += self.value[nodes].sum(axis=1)
+
+        return total / self.n_trees
+
+    def predict_proba(self, X):
+        if scipy.sparse.issparse(X):
+            X = X.toarray()
+        # scikit-learn trees compare float32 features with their thresholds
+        X = np.asarray(X, dtype=np.float32)
+
+        if X.shape[1] != self.n_features_in_:
+            raise ValueError(f'The packed forest has {self.n_features_in_} features, the matrix has {X.shape[1]} columns')
+
+        positive = self._positive_proba(X)
+        return np.column_stack([1 - positive, positive])
+
+    def predict(self, X):
+        return self.classes_[(self.predict_proba(X)[:, 1] > 0.5).astype(int)]
+
+
+def is_compilable(model):
+    """ Whether the model (or the estimator of a wrapped model) is a scikit-learn tree ensemble that can be packed """
+    estimator = model.estimator_ if isinstance(model, WrappedClassifier) else model
+    return type(estimator).__name__ in ('RandomForestClassifier', 'ExtraTreesClassifier', 'DecisionTreeClassifier')
+
+
+def compile_model(model):
+    """ The model with its trees packed. A wrapped model keeps its wrapper (column projection, score correction)
+        around the packed estimator, so its predict_proba does the same steps.
+    """
+    if not is_compilable(model):
+        raise ValueError(f'{type(model).__name__} is not a scikit-learn tree ensemble')
+
+    if isinstance(model, WrappedClassifier):
+        compiled = copy.copy(model)
+        compiled.estimator_ = PackedForest.from_estimator(model.estimator_)
+        return compiled
+
+    return PackedForest.from_estimator(model)
+
+
+def _best_seconds(predict_proba, X, repeats):
+    """ The scores, and the fastest of the repeated prediction times """
+    seconds = list()
+    for _ in range(repeats):
+        start = time.perf_counter()
+        scores = predict_proba(X)[:, 1]
+        seconds.append(time.perf_counter() - start)
+
+    return scores, min(seconds)
+
+
+def check_compiled_model(model, compiled, X, tolerance=DEFAULT_TOLERANCE, repeats=3):
+    """ Compare the scores and prediction times of a compiled model with the original's
+
+        Returns:
+            (dict) the maximum absolute difference of the scores, the prediction times of both (the fastest of
+            the repeats) and whether the compiled model is within the tolerance and faster
+    """
+    original_scores, original_seconds = _best_seconds(model.predict_proba, X, repeats)
+    compiled_scores, compiled_seconds = _best_seconds(compiled.predict_proba, X, repeats)
+
+    max_difference = float(np.max(np.abs(original_scores - compiled_scores))) if len(original_scores) else 0.0
+
+    return {
+        'max_difference': max_difference,
+        'within_tolerance': max_difference <= tolerance,
+        'original_seconds': original_seconds,
+        'compiled_seconds': compiled_seconds,
+        'faster': compiled_seconds < original_seconds,
+    }
+
+
+def compiled_model_storage_engine(project_storage):
+    """ Where the compiled models are stored, by model hash, next to trained_models, in the compact format """
+    # compact_models imports PackedForest from this module
+    from pipeline.utils.compact_models import CompactModelStorageEngine
+
+    return CompactModelStorageEngine(project_storage, model_directory=COMPILED_MODEL_DIRECTORY)
+
+
+def compile_and_store(db_engine, model_id, project_path=PROJECT_PATH, tolerance=DEFAULT_TOLERANCE):
+    """ Compile a model, check it on its test matrix and store it if its scores are within the tolerance and it
+        is faster than the original. Otherwise a compiled form stored earlier is deleted, so the original is used.
+
+        Returns:
+            (dict) the result of check_compiled_model with whether the compiled model was stored, None if the model is not a tree ensemble
+    """
+    project_storage = ProjectStorage(project_path)
+    matrix_storage_engine = project_storage.matrix_storage_engine()
+    model_hash = retrieve_model_hash_from_id(db_engine, model_id)
+
+    model = model_storage_engine(project_storage).load(model_hash)
+    if not is_compilable(model):
+        logging.info(f'Model {model_id} ({type(model).__name__}) is not a scikit-learn tree ensemble, not compiled')
+        return None
+
+    compiled = compile_model(model)
+
+    train_matrix_uuid, _ = train_matrix_info_from_model_id(db_engine, model_id)
+    test_matrix_uuid, _ = test_matrix_info_from_model_id(db_engine, model_id)
+    train_matrix_columns = matrix_storage_engine.get_store(train_matrix_uuid).columns()
+    X = matrix_storage_engine.get_store(test_matrix_uuid).matrix_with_sorted_columns(train_matrix_columns)
+
+    check = check_compiled_model(model, compiled, X, tolerance)
+    logging.info(
+        f"Model {model_id}: compiled scores differ by at most {check['max_difference']:.2e} on {len(X)} rows, "
+        f"predict_proba in {check['compiled_seconds']:.2f}s instead of {check['original_seconds']:.2f}s"
+    )
+
+    compiled_storage = compiled_model_storage_engine(project_storage)
+    check['stored'] = check['within_tolerance'] and check['faster']
+
+    if not check['stored']:
+        if not check['within_tolerance']:
+            logging.warning(f'The compiled model {model_id} differs by more than {tolerance}, not storing it')
+        else:
+            logging.warning(f'The compiled model {model_id} is slower than the original, not storing it')
+
+        if compiled_storage.exists(model_hash):
+            compiled_storage.delete(model_hash)
+            logging.info(f'Deleted the compiled model {model_id} ({model_hash}) stored earlier')
+
+        return check
+
+    compiled_storage.write(compiled, model_hash)
+    logging.info(f'Stored the compiled model {model_id} ({model_hash}) in {COMPILED_MODEL_DIRECTORY}')
+
+    return check
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Compile the tree ensembles used for scoring into packed arrays")
+
+    parser.add_argument(
+        "-m",
+        "--model-ids",
+        type=int,
+        nargs='+',
+        help='triage model ids to compile',
+        required=True
+    )
+
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=DEFAULT_TOLERANCE,
+        help='Maximum absolute difference with the original scores on the test matrix'
+    )
+
+    parser.add_argument(
+        "--project-path",
+        type=str,
+        default=PROJECT_PATH,
+        help='Where the models and matrices are stored'
+    )
+
+    args = parser.parse_args()
+
+    db_engine = get_db_engine()
+    for model_id in args.model_ids:
+        compile_and_store(db_engine, model_id, args.project_path, args.tolerance)
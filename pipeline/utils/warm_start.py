@@ -0,0 +1,343 @@
+"""
+Warm-starting the boosted models across consecutive time splits.
+
+With a model update frequency much shorter than the training history, consecutive training matrices
+share most of their rows. The warm-start classifiers save their booster after every fit, and the
+next split continues from the previous split's booster with `extra_rounds` boosting rounds on the
+as_of_dates that are new to this split, instead of training from scratch.
+
+The warm-start classes are added to the grid next to the cold models they mirror (same
+hyperparameters), so every split gets both and their fit times and metrics can be compared.
+
+A booster is only continued by a model of the same class, hyperparameters and feature columns, trained on
+a matrix of the same label, label timespan and cohort (which the trainer passes to the model as its
+warm_start_scope). The warm-start classes are not wrapped (see wrapped_estimators.py), so they can't be
+combined with the sparse input, feature pruning or negative downsampling options.
+"""
+import copy
+import glob
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+from sklearn.base import BaseEstimator, ClassifierMixin
+
+from pipeline.utils.grid_pruning import train_and_test_splits
+from pipeline.utils.performance_ledger import LedgerModelTrainer
+from pipeline.utils.project_constants import EXPERIMENT_METADATA_SCHEMA
+
+
+# Cold class path -> the warm-start class that mirrors it
+WARM_START_CLASSES = {
+    'lightgbm.LGBMClassifier': 'pipeline.utils.warm_start.WarmStartLGBMClassifier',
+    'xgboost.XGBClassifier': 'pipeline.utils.warm_start.WarmStartXGBClassifier',
+}
+
+# Hyperparameters that don't change the model, left out of the booster key
+_UNKEYED_PARAMETERS = ('n_jobs', 'nthread', 'num_threads', 'random_state')
+
+
+class _WarmStartBoosterClassifier(BaseEstimator, ClassifierMixin):
+    """ Trains a booster that continues from the booster of the previous time split, if there is one
+
+        Args:
+            warm_start_dir (str): where the boosters are kept between splits. Without it, every fit is cold
+            extra_rounds (int): boosting rounds added to the previous split's booster
+            random_state (int): passed to the booster
+            warm_start_scope (dict): the label, label timespan and cohort of the train matrix, set by
+                WarmStartModelTrainer. Without it, every fit is cold
+            params: hyperparameters of the booster
+    """
+    booster_extension = None
+
+    def __init__(self, warm_start_dir=None, extra_rounds=100, random_state=None, warm_start_scope=None, **params):
+        self.warm_start_dir = warm_start_dir
+        self.extra_rounds = extra_rounds
+        self.random_state = random_state
+        self.warm_start_scope = warm_start_scope
+        self.params = params
+
+    def get_params(self, deep=True):
+        params = super().get_params(deep)
+        params.update(self.params)
+        return params
+
+    def set_params(self, **params):
+        for key, value in params.items():
+            if key in ('warm_start_dir', 'extra_rounds', 'random_state', 'warm_start_scope'):
+                setattr(self, key, value)
+            else:
+                self.params[key] = value
+        return self
+
+    def _fit_booster(self, X, y, n_estimators, init_model_path):
+        raise NotImplementedError
+
+    def _save_booster(self, path):
+        raise NotImplementedError
+
+    def _booster_dir(self, columns):
+        """ Boosters can only be continued by the same model group on the same features, label and cohort """
+        key = {
+            'class': type(self).__name__,
+            'scope': self.warm_start_scope,
+            'extra_rounds': self.extra_rounds,
+            'params': {k: v for k, v in self.params.items() if k not in _UNKEYED_PARAMETERS},
+            'columns': list(columns),
+        }
+        key_hash = hashlib.md5(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+        return os.path.join(self.warm_start_dir, key_hash)
+
+    def _previous_booster(self, booster_dir, train_end):
+        """ The most recent booster trained on data that ends before train_end, as (train end, path) """
+        previous = list()
+        for path in glob.glob(os.path.join(booster_dir, f'*{self.booster_extension}')):
+            booster_end = pd.Timestamp(os.path.basename(path)[:-len(self.booster_extension)])
+            if booster_end < train_end:
+                previous.append((booster_end, path))
+
+        return max(previous) if previous else None
+
+    def fit(self, X, y):
+        as_of_dates = pd.DatetimeIndex(X.index.get_level_values('as_of_date'))
+        train_end = as_of_dates.max()
+        y = np.asarray(y)
+
+        self.warm_started_from_ = None
+        booster_dir = None
+        if self.warm_start_dir is not None and self.warm_start_scope is None:
+            logging.warning('No label and cohort of the train matrix to key the boosters on (see WarmStartModelTrainer), training from scratch')
+        elif self.warm_start_dir is not None:
+            booster_dir = self._booster_dir(X.columns)
+            previous = self._previous_booster(booster_dir, train_end)
+
+            if previous is not None:
+                previous_end, previous_path = previous
+                newest = np.asarray(as_of_dates > previous_end)
+                if len(np.unique(y[newest])) > 1:
+                    logging.info(f'Warm-starting from the booster trained until {previous_end.date()}, {self.extra_rounds} rounds on {newest.sum()} new rows')
+                    self.model_ = self._fit_booster(X[newest], y[newest], self.extra_rounds, previous_path)
+                    self.warm_started_from_ = previous_end
+                else:
+                    logging.warning(f'Not enough new rows after {previous_end.date()} to continue the booster, training from scratch')
+
+        if self.warm_started_from_ is None:
+            self.model_ = self._fit_booster(X, y, self.params.get('n_estimators', 100), None)
+
+        if booster_dir is not None:
+            os.makedirs(booster_dir, exist_ok=True)
+            self._save_booster(os.path.join(booster_dir, f'{train_end.date()}{self.booster_extension}'))
+
+        self.classes_ = self.model_.classes_
+        return self
+
+    def predict_proba(self, X):
+        return self.model_.predict_proba(X)
+
+    def predict(self, X):
+        return self.model_.predict(X)
+
+    @property
+    def feature_importances_(self):
+        return self.model_.feature_importances_
+
+
+class WarmStartLGBMClassifier(_WarmStartBoosterClassifier):
+    booster_extension = '.txt'
+
+    def _fit_booster(self, X, y, n_estimators, init_model_path):
+        from lightgbm import LGBMClassifier
+
+        model = LGBMClassifier(random_state=self.random_state, **dict(self.params, n_estimators=n_estimators))
+        return model.fit(X, y, init_model=init_model_path)
+
+    def _save_booster(self, path):
+        self.model_.booster_.save_model(path)
+
+
+class WarmStartXGBClassifier(_WarmStartBoosterClassifier):
+    booster_extension = '.json'
+
+    def _fit_booster(self, X, y, n_estimators, init_model_path):
+        from xgboost import XGBClassifier
+
+        model = XGBClassifier(random_state=self.random_state, **dict(self.params, n_estimators=n_estimators))
+        return model.fit(X, y, xgb_model=init_model_path)
+
+    def _save_booster(self, path):
+        self.model_.get_booster().save_model(path)
+
+
+def warm_start_scope(matrix_metadata):
+    """ What a booster is trained to predict, from the metadata of its train matrix """
+    return {key: str(matrix_metadata.get(key)) for key in ('label_name', 'label_timespan', 'cohort_name')}
+
+
+class WarmStartModelTrainer(LedgerModelTrainer):
+    """ The ledger's ModelTrainer, passing the label, label timespan and cohort of the train matrix to the warm-start models
+
+        The scope is only an argument of the model's constructor, the model group and hash keep the grid's hyperparameters.
+    """
+
+    def _train(self, matrix_store, class_path, parameters, random_seed):
+        if class_path in WARM_START_CLASSES.values():
+            parameters = dict(parameters, warm_start_scope=warm_start_scope(matrix_store.metadata))
+        return super()._train(matrix_store, class_path, parameters, random_seed)
+
+
+def add_warm_start_models(grid_config, warm_start_dir, extra_rounds=100):
+    """ Add a warm-start copy of every boosted model in the grid, keeping the cold ones for comparison
+
+        Returns:
+            (dict) a copy of the grid config
+    """
+    grid_config = copy.deepcopy(grid_config)
+
+    for class_path, warm_class_path in WARM_START_CLASSES.items():
+        if class_path not in grid_config:
+            continue
+
+        parameters = copy.deepcopy(grid_config[class_path])
+        parameters['warm_start_dir'] = [warm_start_dir]
+        parameters['extra_rounds'] = [extra_rounds]
+        grid_config[warm_class_path] = parameters
+        logging.info(f'Added {warm_class_path} (warm start, {extra_rounds} extra rounds per split) to the grid')
+
+    return grid_config
+
+
+def _create_warm_start_comparison_table(db_engine, schema=EXPERIMENT_METADATA_SCHEMA):
+    q = f'''
+        create schema if not exists {schema};
+
+        create table if not exists {schema}.warm_start_comparison (
+            experiment_hash varchar,
+            run_id int,
+            train_end_time timestamp,
+            warm_model_type varchar,
+            warm_model_group_id int,
+            cold_model_group_id int,
+            warm_fit_seconds float,
+            cold_fit_seconds float,
+            speedup float,
+            metric varchar,
+            parameter varchar,
+            warm_value float,
+            cold_value float,
+            metric_change float,
+            recorded_at timestamp default now()
+        );
+    '''
+
+    with db_engine.begin() as conn:
+        conn.execute(q)
+
+
+def compare_warm_and_cold(experiment):
+    """ Compare the fit time (from the performance ledger) and the priority metric of every warm-start
+        model with the cold model of the same hyperparameters on the same split, and record it
+
+        Returns:
+            pd.DataFrame with one row per warm-start model
+    """
+    db_engine = experiment.db_engine
+    scoring_config = experiment.config.get('scoring', {})
+    metric = scoring_config.get('priority_metric', 'precision@')
+    parameter = scoring_config.get('priority_parameter', '100_abs')
+
+    cold_model_type = ' '.join([f"when '{warm}' then '{cold}'" for cold, warm in WARM_START_CLASSES.items()])
+
+    q = f"""
+        with fits as (
+            select
+                m.model_group_id,
+                m.train_end_time,
+                mg.model_type,
+                mg.hyperparameters,
+                max(t.wall_seconds) as fit_seconds,
+                avg(e.stochastic_value) as value
+            from triage_metadata.experiment_models em
+                join triage_metadata.models m using(model_hash)
+                join triage_metadata.model_groups mg using(model_group_id)
+                left join {EXPERIMENT_METADATA_SCHEMA}.phase_timings t
+                    on t.model_hash = m.model_hash and t.phase = 'model_fit' and t.run_id = {experiment.run_id}
+                left join test_results.evaluations e
+                    on e.model_id = m.model_id and e.metric = '{metric}' and e.parameter = '{parameter}' and coalesce(e.subset_hash, '') = ''
+            where em.experiment_hash = '{experiment.experiment_hash}'
+            group by 1, 2, 3, 4
+        )
+        select
+            w.train_end_time,
+            w.model_type as warm_model_type,
+            w.model_group_id as warm_model_group_id,
+            c.model_group_id as cold_model_group_id,
+            w.fit_seconds as warm_fit_seconds,
+            c.fit_seconds as cold_fit_seconds,
+            c.fit_seconds / nullif(w.fit_seconds, 0) as speedup,
+            w.value as warm_value,
+            c.value as cold_value,
+            w.value - c.value as metric_change
+        from fits w
+            join fits c
+                on c.train_end_time = w.train_end_time
+                and c.model_type = case w.model_type {cold_model_type} end
+                and c.hyperparameters = w.hyperparameters - 'warm_start_dir' - 'extra_rounds'
+        order by w.model_type, w.train_end_time
+    """
+    comparison = pd.read_sql(q, db_engine)
+
+    if comparison.empty:
+        logging.warning('No warm-start models with a matching cold model to compare with')
+        return comparison
+
+    comparison['experiment_hash'] = experiment.experiment_hash
+    comparison['run_id'] = experiment.run_id
+    comparison['metric'] = metric
+    comparison['parameter'] = parameter
+
+    _create_warm_start_comparison_table(db_engine)
+    with db_engine.begin() as conn:
+        comparison.to_sql(
+            'warm_start_comparison',
+            conn,
+            schema=EXPERIMENT_METADATA_SCHEMA,
+            if_exists='append',
+            index=False
+        )
+
+    for model_type, df in comparison.groupby('warm_model_type'):
+        logging.info(
+            f'{model_type}: median speedup {df.speedup.median():.2f}x over {len(df)} split(s), '
+            f'mean change of {metric}{parameter} {df.metric_change.mean():+.3f}'
+        )
+
+    return comparison
+
+
+def run_experiment_with_warm_start(experiment):
+    """ Run a triage experiment one time split at a time, oldest first, so that every split's
+        warm-start models can continue from the boosters of the previous split.
+        The models of a split are still trained in parallel.
+
+        Returns:
+            pd.DataFrame the warm vs cold comparison (see compare_warm_and_cold)
+    """
+    experiment.trainer.__class__ = WarmStartModelTrainer
+
+    experiment.generate_matrices()
+    experiment.generate_subsets()
+    experiment.generate_protected_groups()
+
+    splits = sorted(experiment.full_matrix_definitions, key=lambda s: s['train_matrix']['matrix_info_end_time'])
+    for split in splits:
+        logging.info(f"Warm start: training the split ending {split['train_matrix']['matrix_info_end_time']}")
+        train_and_test_splits(experiment, [split])
+
+    # as at the end of experiment.run()
+    experiment._summary_report()
+    experiment._log_end_of_run_report()
+
+    return compare_warm_and_cold(experiment)
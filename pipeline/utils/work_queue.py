@@ -0,0 +1,579 @@
+"""
+Running the matrix builds and model training of an experiment on several hosts through a queue table.
+
+MultiCoreExperiment only parallelizes within one machine. Here the coordinator (run.py --role coordinator)
+runs the database steps (labels, cohort, feature tables, subsets, protected groups) and enqueues one task
+per matrix and one per train matrix x model group (trained and tested on all the split's test matrices)
+in acdhs_experiments.work_queue. Workers on any host claim tasks with `select ... for update skip locked`,
+run them and record the outcome. triage generates the train tasks of a split from its train matrix, so the
+coordinator queues them once the matrices of the split are built.
+
+Workers need the same code, the database and the project path (shared file system or S3). They read the
+experiment config from triage_metadata, so they don't need the config file:
+
+    python -m pipeline.utils.work_queue                      # tasks of any experiment
+    python -m pipeline.utils.work_queue -e <experiment_hash> # tasks of one experiment, exits when it is done
+
+For a test on one box, run.py --role coordinator --local-workers 4 starts the workers itself.
+"""
+import argparse
+import importlib
+import json
+import logging
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import traceback
+from unittest import mock
+
+import pandas as pd
+
+import triage.experiments.base
+from triage.component.catwalk.utils import associate_matrices_with_experiment, associate_models_with_experiment
+from triage.experiments import SingleThreadedExperiment
+from triage.tracking import record_matrix_building_started, record_model_building_started
+
+from pipeline.utils.feature_pruning import record_pruned_features_of
+from pipeline.utils.performance_ledger import instrument_experiment
+from pipeline.utils.project_constants import EXPERIMENT_METADATA_SCHEMA
+from pipeline.utils.utils import get_db_engine
+
+
+# claim order: matrices first, then the train tasks in the order of triage's batches (baselines, big, others)
+MATRIX_PRIORITY = 0
+
+# times a task is claimed (by a worker that failed it or stopped sending heartbeats) before it is marked failed
+MAX_ATTEMPTS = 2
+
+
+def create_work_queue_tables(db_engine, schema=EXPERIMENT_METADATA_SCHEMA):
+    q = f'''
+        create schema if not exists {schema};
+
+        create table if not exists {schema}.work_queue_runs (
+            experiment_hash varchar primary key,
+            run_id int,
+            coordinator varchar,
+            project_path varchar,
+            matrix_storage_class varchar,
+            replace bool,
+            save_predictions bool,
+            status varchar,
+            started_at timestamp default now(),
+            finished_at timestamp
+        );
+
+        create table if not exists {schema}.work_queue (
+            task_id serial primary key,
+            experiment_hash varchar not null,
+            task_key varchar not null,
+            task_type varchar not null,
+            priority int default 0,
+            payload jsonb,
+            depends_on varchar[] default '{{}}',
+            status varchar default 'pending',
+            attempts int default 0,
+            claimed_by varchar,
+            claimed_at timestamp,
+            heartbeat_at timestamp,
+            finished_at timestamp,
+            error text,
+            unique (experiment_hash, task_key)
+        );
+
+        create index if not exists work_queue_status_idx on {schema}.work_queue(status, experiment_hash);
+    '''
+
+    with db_engine.begin() as conn:
+        conn.execute(q)
+
+
+def _worker_name():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def enqueue_tasks(db_engine, experiment_hash, tasks):
+    """ Add tasks to the queue. Tasks that are already queued for the experiment are set back to
+        pending, except the ones that are done.
+
+        Args:
+            tasks (List[dict]): with task_key, task_type, priority, payload and depends_on (list of task keys)
+    """
+    if not tasks:
+        return
+
+    q = f'''
+        insert into {EXPERIMENT_METADATA_SCHEMA}.work_queue (experiment_hash, task_key, task_type, priority, payload, depends_on)
+        values (%s, %s, %s, %s, %s::jsonb, %s)
+        on conflict (experiment_hash, task_key) do update
+        set status = case when work_queue.status = 'done' then 'done' else 'pending' end,
+            payload = excluded.payload,
+            depends_on = excluded.depends_on,
+            priority = excluded.priority,
+            error = null
+    '''
+
+    rows = [
+        (experiment_hash, task['task_key'], task['task_type'], task['priority'], json.dumps(task['payload']), task['depends_on'])
+        for task in tasks
+    ]
+
+    with db_engine.begin() as conn:
+        conn.execute(q, rows)
+
+
+def claim_task(db_engine, experiment_hash=None, worker=None):
+    """ Claim the next pending task whose dependencies are done
+
+        `for update skip locked` lets any number of workers claim at the same time without
+        getting the same task or waiting on each other.
+
+        Returns:
+            (dict) the claimed task (task_id, experiment_hash, task_key, task_type, payload), None if nothing can be claimed now
+    """
+    experiment_filter = 'and q.experiment_hash = %(experiment_hash)s' if experiment_hash is not None else ''
+
+    q = f'''
+        with next_task as (
+            select q.task_id
+            from {EXPERIMENT_METADATA_SCHEMA}.work_queue q
+            where q.status = 'pending'
+            {experiment_filter}
+            and not exists (
+                select 1
+                from {EXPERIMENT_METADATA_SCHEMA}.work_queue dep
+                where dep.experiment_hash = q.experiment_hash
+                and dep.task_key = any(q.depends_on)
+                and dep.status <> 'done'
+            )
+            order by q.priority, q.task_id
+            limit 1
+            for update of q skip locked
+        )
+        update {EXPERIMENT_METADATA_SCHEMA}.work_queue q
+        set status = 'running',
+            claimed_by = %(worker)s,
+            claimed_at = now(),
+            heartbeat_at = now(),
+            attempts = q.attempts + 1
+        from next_task
+        where q.task_id = next_task.task_id
+        returning q.task_id, q.experiment_hash, q.task_key, q.task_type, q.payload
+    '''
+
+    with db_engine.begin() as conn:
+        row = conn.execute(q, {'experiment_hash': experiment_hash, 'worker': worker or _worker_name()}).first()
+
+    return dict(row) if row is not None else None
+
+
+def finish_task(db_engine, task_id, error=None, max_attempts=MAX_ATTEMPTS):
+    """ Record the outcome of a claimed task. A failed task is set back to pending until it has been tried `max_attempts` times """
+    if error is None:
+        q = f'''
+            update {EXPERIMENT_METADATA_SCHEMA}.work_queue
+            set status = 'done', finished_at = now(), error = null
+            where task_id = %(task_id)s
+        '''
+    else:
+        q = f'''
+            update {EXPERIMENT_METADATA_SCHEMA}.work_queue
+            set status = case when attempts < %(max_attempts)s then 'pending' else 'failed' end,
+                finished_at = now(),
+                error = %(error)s
+            where task_id = %(task_id)s
+        '''
+
+    with db_engine.begin() as conn:
+        conn.execute(q, {'task_id': task_id, 'error': error, 'max_attempts': max_attempts})
+
+
+def _heartbeat(db_engine, task_id, stop, interval):
+    """ Keep the heartbeat of a running task fresh, so the coordinator knows the worker is alive """
+    while not stop.wait(interval):
+        try:
+            with db_engine.begin() as conn:
+                conn.execute(
+                    f'update {EXPERIMENT_METADATA_SCHEMA}.work_queue set heartbeat_at = now() where task_id = %s',
+                    (task_id,)
+                )
+        except Exception:
+            logging.warning(f'Could not update the heartbeat of task {task_id}', exc_info=True)
+
+
+def queue_progress(db_engine, experiment_hash):
+    """ Number of tasks of the experiment per type and status """
+    q = f'''
+        select task_type, status, count(*) as n_tasks
+        from {EXPERIMENT_METADATA_SCHEMA}.work_queue
+        where experiment_hash = '{experiment_hash}'
+        group by 1, 2
+        order by 1, 2
+    '''
+    return pd.read_sql(q, db_engine)
+
+
+def run_coordinator(experiment, n_local_workers=0, poll_interval=30, stale_after=600, max_attempts=MAX_ATTEMPTS):
+    """ Run an experiment with the matrix builds and model training done by workers through the queue
+
+        The coordinator runs the database steps itself, enqueues the matrix and train tasks, and waits
+        until every task is done or failed. Tasks whose worker stopped sending heartbeats for `stale_after`
+        seconds are put back in the queue, or marked failed once they have been claimed `max_attempts` times
+        (a task that kills its worker, e.g. out of memory, would otherwise be claimed forever).
+
+        Args:
+            experiment: triage experiment (validated)
+            n_local_workers (int): number of worker processes to start on this host
+            poll_interval (int): seconds between checks of the queue
+            stale_after (int): seconds without heartbeat after which a running task is claimed again
+            max_attempts (int): number of claims after which a task without heartbeat is marked failed
+    """
+    db_engine = experiment.db_engine
+    create_work_queue_tables(db_engine)
+
+    with db_engine.begin() as conn:
+        conn.execute(
+            f'''
+            insert into {EXPERIMENT_METADATA_SCHEMA}.work_queue_runs
+                (experiment_hash, run_id, coordinator, project_path, matrix_storage_class, replace, save_predictions, status)
+            values (%s, %s, %s, %s, %s, %s, %s, 'running')
+            on conflict (experiment_hash) do update
+            set run_id = excluded.run_id, coordinator = excluded.coordinator, project_path = excluded.project_path,
+                matrix_storage_class = excluded.matrix_storage_class, replace = excluded.replace,
+                save_predictions = excluded.save_predictions, status = 'running', started_at = now(), finished_at = null
+            ''',
+            (
+                experiment.experiment_hash,
+                experiment.run_id,
+                _worker_name(),
+                str(experiment.project_path),
+                f'{experiment.matrix_storage_engine.matrix_storage_class.__module__}.{experiment.matrix_storage_engine.matrix_storage_class.__name__}',
+                experiment.replace,
+                experiment.save_predictions,
+            )
+        )
+
+    # database steps
+    experiment.generate_labels()
+    experiment.generate_cohort()
+    experiment.generate_preimputation_features()
+    experiment.impute_missing_features()
+
+    matrix_uuids = list(experiment.matrix_build_tasks.keys())
+    associate_matrices_with_experiment(experiment.experiment_hash, matrix_uuids, db_engine)
+    record_matrix_building_started(experiment.run_id, db_engine)
+    enqueue_tasks(db_engine, experiment.experiment_hash, [
+        {'task_key': f'matrix:{matrix_uuid}', 'task_type': 'matrix', 'priority': MATRIX_PRIORITY, 'payload': {'matrix_uuid': matrix_uuid}, 'depends_on': []}
+        for matrix_uuid in matrix_uuids
+    ])
+
+    experiment.generate_subsets()
+    experiment.generate_protected_groups()
+
+    logging.info(f'Queued {len(matrix_uuids)} matrix builds for experiment {experiment.experiment_hash}')
+    record_model_building_started(experiment.run_id, db_engine)
+
+    workers = start_local_workers(n_local_workers, experiment.experiment_hash)
+
+    # the train tasks of a split are generated from its train matrix, so they are queued once its matrices are built
+    waiting_splits = list(experiment.full_matrix_definitions)
+    progress = None
+    while True:
+        waiting_splits = _enqueue_ready_splits(experiment, waiting_splits)
+
+        with db_engine.begin() as conn:
+            # workers that stopped sending heartbeats
+            conn.execute(
+                f'''
+                update {EXPERIMENT_METADATA_SCHEMA}.work_queue
+                set status = case when attempts < %(max_attempts)s then 'pending' else 'failed' end,
+                    error = case
+                        when attempts < %(max_attempts)s then 'requeued: no heartbeat from ' || claimed_by
+                        else 'no heartbeat from ' || claimed_by || ' after ' || attempts || ' attempts'
+                    end
+                where experiment_hash = %(experiment_hash)s and status = 'running'
+                and heartbeat_at < now() - %(stale_after)s * interval '1 second'
+                ''',
+                {'experiment_hash': experiment.experiment_hash, 'stale_after': stale_after, 'max_attempts': max_attempts}
+            )
+            # tasks that can never run
+            conn.execute(
+                f'''
+                update {EXPERIMENT_METADATA_SCHEMA}.work_queue q
+                set status = 'failed', error = 'a matrix it depends on failed'
+                where q.experiment_hash = %s and q.status = 'pending'
+                and exists (
+                    select 1 from {EXPERIMENT_METADATA_SCHEMA}.work_queue dep
+                    where dep.experiment_hash = q.experiment_hash and dep.task_key = any(q.depends_on) and dep.status = 'failed'
+                )
+                ''',
+                (experiment.experiment_hash,)
+            )
+
+        counts = queue_progress(db_engine, experiment.experiment_hash)
+        if not counts.equals(progress):
+            progress = counts
+            logging.info('Work queue: ' + ', '.join(f'{r.task_type} {r.status}: {r.n_tasks}' for r in counts.itertuples()))
+
+        if not waiting_splits and not counts.status.isin(['pending', 'running']).any():
+            break
+
+        if workers and all(worker.poll() is not None for worker in workers):
+            logging.warning('All the local workers exited with tasks left in the queue, waiting for remote workers')
+            workers = []
+
+        time.sleep(poll_interval)
+
+    failed = counts[counts.status == 'failed'].n_tasks.sum()
+    with db_engine.begin() as conn:
+        conn.execute(
+            f"update {EXPERIMENT_METADATA_SCHEMA}.work_queue_runs set status = %s, finished_at = now() where experiment_hash = %s",
+            ('failed' if failed else 'done', experiment.experiment_hash)
+        )
+
+    # as at the end of experiment.run()
+    experiment._summary_report()
+    experiment._log_end_of_run_report()
+
+    if failed:
+        raise RuntimeError(f'{failed} tasks failed, see the error column of {EXPERIMENT_METADATA_SCHEMA}.work_queue for experiment {experiment.experiment_hash}')
+
+
+def _train_tasks(experiment, splits):
+    """ One task per train matrix and model group of the splits, tested on all the test matrices of its split """
+    train_tasks = dict()
+    batches = experiment.model_train_tester.generate_task_batches(
+        splits=splits,
+        grid_config=experiment.config.get('grid_config'),
+        model_comment=experiment.config.get('model_comment', None),
+    )
+    for batch in batches:
+        for task in batch.tasks:
+            model_hash = task['train_kwargs']['model_hash']
+            train_uuid = task['train_store'].uuid
+            train_task = train_tasks.setdefault(model_hash, {
+                'task_key': f'train:{model_hash}',
+                'task_type': 'train',
+                'priority': batch.key.value,
+                'payload': {
+                    'model_hash': model_hash,
+                    'train_uuid': train_uuid,
+                    'test_uuids': [],
+                    'class_path': task['train_kwargs']['class_path'],
+                    'parameters': task['train_kwargs']['parameters'],
+                    'random_seed': task['train_kwargs']['random_seed'],
+                },
+                'depends_on': [f'matrix:{train_uuid}'],
+            })
+            train_task['payload']['test_uuids'].append(task['test_store'].uuid)
+            train_task['depends_on'].append(f"matrix:{task['test_store'].uuid}")
+
+    return list(train_tasks.values())
+
+
+def _enqueue_ready_splits(experiment, splits):
+    """ Queue the train tasks of the splits whose matrices are built
+
+        Returns:
+            (list) the splits still waiting for their matrices. Splits with a failed matrix are dropped.
+    """
+    statuses = pd.read_sql(
+        f'''
+        select task_key, status
+        from {EXPERIMENT_METADATA_SCHEMA}.work_queue
+        where experiment_hash = '{experiment.experiment_hash}' and task_type = 'matrix'
+        ''',
+        experiment.db_engine
+    ).set_index('task_key').status
+
+    ready, waiting = [], []
+    for split in splits:
+        split_statuses = statuses.reindex([f'matrix:{uuid}' for uuid in [split['train_uuid']] + list(split['test_uuids'])])
+        if (split_statuses == 'failed').any():
+            logging.warning(f"A matrix of the split of train matrix {split['train_uuid']} failed, its models are not trained")
+        elif (split_statuses == 'done').all():
+            ready.append(split)
+        else:
+            waiting.append(split)
+
+    if ready:
+        train_tasks = _train_tasks(experiment, ready)
+        associate_models_with_experiment(experiment.experiment_hash, [task['payload']['model_hash'] for task in train_tasks], experiment.db_engine)
+        enqueue_tasks(experiment.db_engine, experiment.experiment_hash, train_tasks)
+        logging.info(f'Queued {len(train_tasks)} train tasks of {len(ready)} splits for experiment {experiment.experiment_hash}')
+
+    return waiting
+
+
+def start_local_workers(n_workers, experiment_hash):
+    """ Start worker processes on this host for the tasks of one experiment """
+    return [
+        subprocess.Popen(
+            [sys.executable, '-m', 'pipeline.utils.work_queue', '--experiment-hash', experiment_hash],
+            cwd=os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        )
+        for _ in range(n_workers)
+    ]
+
+
+def _run_status(db_engine, experiment_hash):
+    """ The status of the experiment's run in work_queue_runs: running, done or failed (None if it was never started) """
+    status = pd.read_sql(
+        f"select status from {EXPERIMENT_METADATA_SCHEMA}.work_queue_runs where experiment_hash = '{experiment_hash}'",
+        db_engine
+    ).status
+
+    return status.iloc[0] if len(status) else None
+
+
+def _load_experiment(db_engine, experiment_hash):
+    """ The experiment of a queued task, built from the config triage stored and the coordinator's options
+
+        The experiment uses the coordinator's triage run instead of starting one of its own, so the matrices
+        and models the workers build are recorded in that run, and it is instrumented like the coordinator's,
+        so the model fits, predictions and evaluations of the workers are in the ledger.
+    """
+    q = f'''
+        select e.config, r.run_id, r.project_path, r.matrix_storage_class, r.replace, r.save_predictions
+        from triage_metadata.experiments e
+        join {EXPERIMENT_METADATA_SCHEMA}.work_queue_runs r using(experiment_hash)
+        where experiment_hash = '{experiment_hash}'
+    '''
+    run = pd.read_sql(q, db_engine).iloc[0]
+
+    module_name, class_name = run.matrix_storage_class.rsplit('.', 1)
+
+    with mock.patch.object(triage.experiments.base, 'initialize_tracking_and_get_run_id', return_value=int(run.run_id)):
+        experiment = SingleThreadedExperiment(
+            config=run.config,
+            db_engine=db_engine,
+            project_path=run.project_path,
+            matrix_storage_class=getattr(importlib.import_module(module_name), class_name),
+            replace=bool(run.replace),
+            save_predictions=bool(run.save_predictions),
+            skip_validation=True,
+        )
+
+    # triage lists the feature tables of the matrices by planning the imputation again, which reads the
+    # pre-imputation tables the coordinator's imputation dropped: only the names of the imputed tables are needed
+    experiment.feature_imputation_table_tasks = {
+        experiment.feature_generator._clean_table_name(aggregation.get_table_name(imputed=True)): {}
+        for aggregation in experiment.collate_aggregations
+    }
+
+    return record_pruned_features_of(instrument_experiment(experiment))
+
+
+def _run_task(experiment, task):
+    payload = task['payload']
+
+    if task['task_type'] == 'matrix':
+        experiment.matrix_builder.build_matrix(**experiment.matrix_build_tasks[payload['matrix_uuid']])
+
+    elif task['task_type'] == 'train':
+        storage_engine = experiment.matrix_storage_engine
+        train_store = storage_engine.get_store(payload['train_uuid'])
+        train_tasks = experiment.model_train_tester.model_trainer.generate_train_tasks(
+            grid_config=experiment.config.get('grid_config'),
+            misc_db_parameters=dict(test=False, model_comment=experiment.config.get('model_comment', None)),
+            matrix_store=train_store
+        )
+        # the random seeds of new models are drawn in the order the tasks are generated, so the worker's would
+        # differ from the coordinator's: the model is trained with the seed (and so the hash) that was queued
+        train_kwargs = next(
+            t for t in train_tasks
+            if t['class_path'] == payload['class_path'] and t['parameters'] == payload['parameters']
+        )
+        train_kwargs = dict(train_kwargs, model_hash=payload['model_hash'], random_seed=payload['random_seed'])
+        for test_uuid in payload['test_uuids']:
+            experiment.model_train_tester.process_task(
+                test_store=storage_engine.get_store(test_uuid),
+                train_store=train_store,
+                train_kwargs=train_kwargs
+            )
+
+    else:
+        raise ValueError(f"Unknown task type {task['task_type']}")
+
+
+def run_worker(db_engine, experiment_hash=None, poll_interval=10, idle_timeout=600, heartbeat_interval=30):
+    """ Claim and run queued tasks until there is nothing left to do
+
+        Args:
+            db_engine: SQLAlchemy engine
+            experiment_hash (str, optional): only run the tasks of this experiment, and exit when its coordinator is done
+            poll_interval (int): seconds to wait when no task can be claimed
+            idle_timeout (int): exit after this many seconds without claiming a task
+
+        Returns:
+            (int) number of tasks run
+    """
+    create_work_queue_tables(db_engine)
+    worker = _worker_name()
+    experiments = dict()
+    n_tasks = 0
+    idle_since = time.time()
+
+    while True:
+        task = claim_task(db_engine, experiment_hash, worker)
+
+        if task is None:
+            # the coordinator queues more tasks as the matrices are built, the experiment is done when it says so
+            if experiment_hash is not None and _run_status(db_engine, experiment_hash) != 'running':
+                break
+            if time.time() - idle_since > idle_timeout:
+                break
+            time.sleep(poll_interval)
+            continue
+
+        logging.info(f"Worker {worker}: running {task['task_key']} of experiment {task['experiment_hash']}")
+
+        stop = threading.Event()
+        threading.Thread(target=_heartbeat, args=(db_engine, task['task_id'], stop, heartbeat_interval), daemon=True).start()
+        try:
+            if task['experiment_hash'] not in experiments:
+                experiments[task['experiment_hash']] = _load_experiment(db_engine, task['experiment_hash'])
+            _run_task(experiments[task['experiment_hash']], task)
+        except Exception:
+            logging.error(f"Worker {worker}: {task['task_key']} failed", exc_info=True)
+            finish_task(db_engine, task['task_id'], error=traceback.format_exc())
+        else:
+            finish_task(db_engine, task['task_id'])
+        finally:
+            stop.set()
+
+        n_tasks += 1
+        idle_since = time.time()
+
+    logging.info(f'Worker {worker}: ran {n_tasks} tasks, nothing left to claim')
+
+    return n_tasks
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Run the queued matrix builds and model training of experiments")
+
+    parser.add_argument(
+        "-e",
+        "--experiment-hash",
+        type=str,
+        help='Only run the tasks of this experiment (and exit when it is done)',
+        required=False
+    )
+
+    parser.add_argument(
+        "--idle-timeout",
+        type=int,
+        default=600,
+        help='Seconds without a task to claim after which the worker exits'
+    )
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    run_worker(get_db_engine(), experiment_hash=args.experiment_hash, idle_timeout=args.idle_timeout)
@@ -0,0 +1,251 @@
+"""
+Estimators of the grid wrapped with project-side steps that run inside fit and predict.
+
+The wrapper is pickled with the model, so anything it does to the matrix at training time is done
+the same way when the model scores (in the experiment and in predict_forward). The wrapper options
+are hyperparameters, so a wrapped estimator gets its own model group and the options are recorded
+in triage_metadata.model_groups.
+
+There is one wrapper class per estimator (triage imports the grid's class paths). The grid entries
+are rewritten to their wrapped class by the functions at the bottom of this module.
+
+Options:
+    sparse_input (bool): hand the matrix to the estimator as a CSR matrix
+    prune_near_zero_fraction (float): drop the (near) constant columns of the training matrix, see feature_pruning.py
+    prune_duplicates (bool): drop the columns of the training matrix that duplicate another column
+    negative_fraction (float): train on all the positives and this fraction of the negatives of every as_of_date
+"""
+import copy
+import importlib
+import inspect
+import logging
+
+import numpy as np
+import pandas as pd
+from sklearn.base import BaseEstimator, ClassifierMixin
+
+from pipeline.utils.feature_pruning import select_columns
+from pipeline.utils.sparse_matrices import to_csr
+
+
+class WrappedClassifier(BaseEstimator, ClassifierMixin):
+    """ Wraps the estimator at `estimator_class_path`. The options of the wrapper are its named
+        arguments, all the other hyperparameters are passed to the estimator.
+    """
+    estimator_class_path = None
+    accepts_sparse = False
+
+    def __init__(self, sparse_input=False, prune_near_zero_fraction=None, prune_duplicates=False, negative_fraction=None, random_state=None, **params):
+        self.sparse_input = sparse_input
+        self.prune_near_zero_fraction = prune_near_zero_fraction
+        self.prune_duplicates = prune_duplicates
+        self.negative_fraction = negative_fraction
+        self.random_state = random_state
+        self.params = params
+
+    def get_params(self, deep=True):
+        params = super().get_params(deep)
+        params.update(self.params)
+        return params
+
+    def set_params(self, **params):
+        options = super().get_params(deep=False)
+        for key, value in params.items():
+            if key in options:
+                setattr(self, key, value)
+            else:
+                self.params[key] = value
+        return self
+
+    def _make_estimator(self):
+        module_name, class_name = self.estimator_class_path.rsplit('.', 1)
+        cls = getattr(importlib.import_module(module_name), class_name)
+        return cls(random_state=self.random_state, **self.params)
+
+    def _project(self, X):
+        """ The columns kept by the feature pruning """
+        if len(self.kept_columns_) == self.n_input_columns_:
+            return X
+        if isinstance(X, pd.DataFrame):
+            return X.iloc[:, self.kept_columns_]
+        return X[:, self.kept_columns_]
+
+    def _transform(self, X):
+        """ The matrix as the estimator sees it, at fit and predict time """
+        X = self._project(X)
+        if self.sparse_input and self.accepts_sparse:
+            return to_csr(X)
+        return X
+
+    def _downsample_negatives(self, X, y):
+        """ Keep all the positives and `negative_fraction` of the negatives of every as_of_date
+
+            Returns:
+                the rows to train on (boolean mask) and their sample weights (1 / negative_fraction for the negatives)
+        """
+        if not 0 < self.negative_fraction <= 1:
+            raise ValueError(f'negative_fraction should be in (0, 1], got {self.negative_fraction}')
+
+        y = np.asarray(y)
+        rng = np.random.RandomState(self.random_state)
+
+        if isinstance(X, pd.DataFrame) and 'as_of_date' in X.index.names:
+            strata = X.index.get_level_values('as_of_date')
+        else:
+            strata = np.zeros(len(y))
+
+        keep = y == 1
+        for stratum in np.unique(strata):
+            negatives = np.flatnonzero((strata == stratum) & (y == 0))
+            n_keep = int(np.ceil(self.negative_fraction * len(negatives)))
+            keep[rng.choice(negatives, n_keep, replace=False)] = True
+
+        weights = np.where(y[keep] == 1, 1.0, 1.0 / self.negative_fraction)
+
+        logging.info(f'Negative downsampling: training on {keep.sum()} of {len(y)} rows ({(y == 1).sum()} positives)')
+
+        return keep, weights
+
+    def fit(self, X, y):
+        sample_weight = None
+        self.weighted_ = False
+        if self.negative_fraction is not None and self.negative_fraction < 1:
+            keep, sample_weight = self._downsample_negatives(X, y)
+            X = X[keep] if isinstance(X, pd.DataFrame) else X[keep, :]
+            y = y[keep] if isinstance(y, pd.Series) else np.asarray(y)[keep]
+
+        self.n_input_columns_ = X.shape[1]
+        self.kept_columns_ = np.arange(X.shape[1])
+        self.dropped_columns_ = dict()
+        if self.prune_near_zero_fraction is not None or self.prune_duplicates:
+            self.kept_columns_, self.dropped_columns_ = select_columns(X, self.prune_near_zero_fraction, self.prune_duplicates)
+
+        self.estimator_ = self._make_estimator()
+        if sample_weight is not None and 'sample_weight' in inspect.signature(self.estimator_.fit).parameters:
+            self.estimator_.fit(self._transform(X), y, sample_weight=sample_weight)
+            self.weighted_ = True
+        else:
+            self.estimator_.fit(self._transform(X), y)
+        self.classes_ = self.estimator_.classes_
+        return self
+
+    def _unproject(self, values):
+        """ Per-column values of the estimator back to all the input columns (0 for the pruned ones) """
+        values = np.asarray(values)
+        full = np.zeros(values.shape[:-1] + (self.n_input_columns_,), dtype=values.dtype)
+        full[..., self.kept_columns_] = values
+        return full
+
+    def predict_proba(self, X):
+        proba = self.estimator_.predict_proba(self._transform(X))
+
+        # Without sample weights the scores are corrected for the downsampling: the odds of the
+        # downsampled training set are the true odds divided by the fraction of negatives kept
+        if self.negative_fraction is not None and self.negative_fraction < 1 and not self.weighted_:
+            positive = proba[:, 1] * self.negative_fraction / (proba[:, 1] * self.negative_fraction + proba[:, 0])
+            proba = np.column_stack([1 - positive, positive])
+
+        return proba
+
+    def predict(self, X):
+        return self.estimator_.predict(self._transform(X))
+
+    @property
+    def feature_importances_(self):
+        return self._unproject(self.estimator_.feature_importances_)
+
+    @property
+    def coef_(self):
+        return self._unproject(self.estimator_.coef_)
+
+
+class WrappedRandomForestClassifier(WrappedClassifier):
+    estimator_class_path = 'sklearn.ensemble.RandomForestClassifier'
+    accepts_sparse = True
+
+
+class WrappedExtraTreesClassifier(WrappedClassifier):
+    estimator_class_path = 'sklearn.ensemble.ExtraTreesClassifier'
+    accepts_sparse = True
+
+
+class WrappedDecisionTreeClassifier(WrappedClassifier):
+    estimator_class_path = 'sklearn.tree.DecisionTreeClassifier'
+    accepts_sparse = True
+
+
+class WrappedLogisticRegression(WrappedClassifier):
+    estimator_class_path = 'sklearn.linear_model.LogisticRegression'
+    accepts_sparse = True
+
+
+class WrappedScaledLogisticRegression(WrappedClassifier):
+    # its MinMaxScaler needs a dense matrix
+    estimator_class_path = 'triage.component.catwalk.estimators.classifiers.ScaledLogisticRegression'
+    accepts_sparse = False
+
+
+class WrappedLGBMClassifier(WrappedClassifier):
+    estimator_class_path = 'lightgbm.LGBMClassifier'
+    accepts_sparse = True
+
+
+class WrappedXGBClassifier(WrappedClassifier):
+    estimator_class_path = 'xgboost.XGBClassifier'
+    accepts_sparse = True
+
+
+WRAPPED_CLASSES = {
+    cls.estimator_class_path: f'{__name__}.{cls.__name__}'
+    for cls in (
+        WrappedRandomForestClassifier,
+        WrappedExtraTreesClassifier,
+        WrappedDecisionTreeClassifier,
+        WrappedLogisticRegression,
+        WrappedScaledLogisticRegression,
+        WrappedLGBMClassifier,
+        WrappedXGBClassifier,
+    )
+}
+
+
+def _wrapped_class(class_path):
+    module_name, class_name = class_path.rsplit('.', 1)
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def wrap_grid(grid_config, **options):
+    """ Replace the grid entries that have a wrapper by their wrapped class and set the options on them
+
+        Entries that are already wrapped keep their other options. Options the estimator doesn't
+        support (e.g., sparse_input for ScaledLogisticRegression) are not set.
+
+        Args:
+            grid_config (dict): the experiment's grid_config
+            options: wrapper options, e.g. sparse_input=True
+
+        Returns:
+            (dict) a copy of the grid config
+    """
+    grid_config = copy.deepcopy(grid_config)
+
+    for class_path in list(grid_config):
+        if class_path in WRAPPED_CLASSES:
+            wrapped_class_path = WRAPPED_CLASSES[class_path]
+            grid_config[wrapped_class_path] = grid_config.pop(class_path)
+        elif class_path in WRAPPED_CLASSES.values():
+            wrapped_class_path = class_path
+        else:
+            continue
+
+        wrapped_class = _wrapped_class(wrapped_class_path)
+        for option, value in options.items():
+            if option == 'sparse_input' and not wrapped_class.accepts_sparse:
+                continue
+            if option not in WrappedClassifier().get_params():
+                raise ValueError(f'Unknown wrapper option {option}')
+            grid_config[wrapped_class_path][option] = [value]
+
+        logging.info(f'Wrapped {wrapped_class.estimator_class_path} as {wrapped_class_path} with {options}')
+
+    return grid_config